@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Moves old finished task instances out of the task_instance table.
+
+Task instances in a terminal state that ended more than --retention_days ago
+are copied to an archive table with the same columns (created on first use)
+and deleted from task_instance. The table is walked in primary key order in
+batches of --batch_size rows; each batch is copied and deleted in its own
+short transaction, followed by a --sleep pause, so the live table is never
+locked for long. Archive rows that already exist for a key of the batch are
+replaced, so a batch can be archived again without conflicts. After each
+batch the last archived key is saved to --checkpoint_file, and the next run
+resumes from there. The checkpoint is removed once the whole table has been
+walked.
+
+Only SQLAlchemy Core is used and the table is reflected from the DB, so the
+script also runs against a local MySQL or SQLite stand-in.
+
+  Typical usage example:
+
+  python archive_task_instances.py --retention_days 30 --dry_run
+  python archive_task_instances.py \
+      --sql_alchemy_conn sqlite:////tmp/airflow.db --retention_days 7
+"""
+
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+import os
+import tempfile
+import time
+
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import and_
+from sqlalchemy import create_engine
+from sqlalchemy import or_
+from sqlalchemy import select
+
+import checker_core
+
+TASK_INSTANCE_TABLE = 'task_instance'
+ARCHIVE_TABLE = 'task_instance_archive'
+# States a task instance does not leave without a manual clear.
+ARCHIVABLE_STATES = ('success', 'failed', 'skipped', 'upstream_failed')
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def reflect_tables(engine, archive_name=ARCHIVE_TABLE, create_archive=True):
+  """Returns the live and archive tables.
+
+  The archive table gets the columns of the live one and is created if it is
+  missing, unless create_archive is False.
+  """
+  metadata = MetaData()
+  live = Table(TASK_INSTANCE_TABLE, metadata, autoload=True,
+               autoload_with=engine)
+  archive = Table(archive_name, metadata,
+                  *[column.copy() for column in live.columns])
+  if create_archive:
+    archive.create(bind=engine, checkfirst=True)
+  return live, archive
+
+
+def _after_key(key_columns, last_key):
+  """Keyset condition selecting the rows ordered after last_key."""
+  clauses = []
+  for i, column in enumerate(key_columns):
+    equal = [key_columns[j] == last_key[j] for j in range(i)]
+    clauses.append(and_(*(equal + [column > last_key[i]])))
+  return or_(*clauses)
+
+
+def _is_archivable(ti, cutoff):
+  return and_(
+      ti.state.in_(ARCHIVABLE_STATES),
+      or_(ti.end_date < cutoff,
+          and_(ti.end_date.is_(None), ti.execution_date < cutoff)))
+
+
+def _key_matches(key_columns, keys):
+  return or_(*[and_(*[column == value
+                      for column, value in zip(key_columns, key)])
+               for key in keys])
+
+
+def read_checkpoint(path):
+  """Returns the last archived key saved at path, or None."""
+  try:
+    with open(path) as checkpoint_file:
+      key = json.load(checkpoint_file)['last_key']
+  except (IOError, OSError, ValueError, KeyError):
+    return None
+  dag_id, task_id, execution_date = key
+  return dag_id, task_id, datetime.strptime(execution_date, DATETIME_FORMAT)
+
+
+def write_checkpoint(path, last_key):
+  dag_id, task_id, execution_date = last_key
+  fd, tmp_path = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(path)), prefix='.archive')
+  with os.fdopen(fd, 'w') as tmp_file:
+    json.dump({'last_key': [dag_id, task_id,
+                            execution_date.strftime(DATETIME_FORMAT)]},
+              tmp_file)
+  os.rename(tmp_path, path)
+
+
+class Archiver(object):
+  """Moves archivable task instances to the archive table in batches.
+
+  Attributes:
+    engine: Engine of the Airflow database.
+    cutoff: Task instances that ended before this datetime are archived.
+    batch_size: Rows moved per transaction.
+    sleep: Seconds to pause between two batches.
+    dry_run: Only count the rows that would be moved, without writing
+      anything, not even the archive table or the checkpoint.
+  """
+
+  def __init__(self, engine, cutoff, batch_size=500, sleep=0.5,
+               dry_run=False):
+    self.engine = engine
+    self.cutoff = cutoff
+    self.batch_size = batch_size
+    self.sleep = sleep
+    self.dry_run = dry_run
+    self.live, self.archive = reflect_tables(
+        engine, create_archive=not dry_run)
+    ti = self.live.c
+    self.key_columns = [ti.dag_id, ti.task_id, ti.execution_date]
+
+  def _select_batch(self, connection, last_key):
+    condition = _is_archivable(self.live.c, self.cutoff)
+    if last_key is not None:
+      condition = and_(condition, _after_key(self.key_columns, last_key))
+    return connection.execute(
+        select([self.live]).where(condition)
+        .order_by(*self.key_columns).limit(self.batch_size)).fetchall()
+
+  def archive_batch(self, last_key):
+    """Moves one batch after last_key.
+
+    The copy and the delete run in one transaction. Archive rows with a key
+    of the batch, e.g. left by an earlier partial run, are replaced by the
+    live rows. If a row of the batch changed in between (e.g. it was
+    cleared), the transaction is rolled back and (0, last_key) is returned so
+    the batch is retried.
+
+    Returns:
+      (rows moved, last key of the batch), or None if no row is left.
+    """
+    with self.engine.connect() as connection:
+      transaction = connection.begin()
+      try:
+        rows = self._select_batch(connection, last_key)
+        if not rows:
+          transaction.rollback()
+          return None
+        keys = [tuple(row[column.name] for column in self.key_columns)
+                for row in rows]
+        if not self.dry_run:
+          archive_key_columns = [self.archive.c[column.name]
+                                 for column in self.key_columns]
+          connection.execute(self.archive.delete().where(
+              _key_matches(archive_key_columns, keys)))
+          connection.execute(self.archive.insert(), [dict(row) for row in rows])
+          deleted = connection.execute(self.live.delete().where(and_(
+              _key_matches(self.key_columns, keys),
+              _is_archivable(self.live.c, self.cutoff)))).rowcount
+          if deleted != len(rows):
+            logging.warning('Batch after {} changed while being archived, '
+                            'retrying it.'.format(last_key))
+            transaction.rollback()
+            return 0, last_key
+        transaction.commit()
+      except:
+        transaction.rollback()
+        raise
+    return len(rows), keys[-1]
+
+  def run(self, last_key=None, checkpoint_file=None, max_batches=None):
+    """Archives batches until none is left or max_batches were moved.
+
+    Returns a summary dict.
+    """
+    start_t = time.time()
+    moved = 0
+    batches = 0
+    finished = False
+    while max_batches is None or batches < max_batches:
+      batch = self.archive_batch(last_key)
+      if batch is None:
+        finished = True
+        break
+      count, last_key = batch
+      if count:
+        moved += count
+        batches += 1
+        if checkpoint_file and not self.dry_run:
+          write_checkpoint(checkpoint_file, last_key)
+      if self.sleep:
+        time.sleep(self.sleep)
+    if (finished and checkpoint_file and not self.dry_run
+        and os.path.exists(checkpoint_file)):
+      os.remove(checkpoint_file)
+    return {
+        'would_archive' if self.dry_run else 'archived': moved,
+        'batches': batches,
+        'finished': finished,
+        'last_key': [str(part) for part in last_key] if last_key else None,
+        'duration': round(time.time() - start_t, 3),
+    }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--sql_alchemy_conn', default=None,
+      help='DB to archive in. Defaults to ${}.'.format(
+          checker_core.AIRFLOW_CONNECTION_ENV_KEY))
+  parser.add_argument(
+      '--retention_days', type=float, default=30,
+      help='Finished task instances older than this are archived.')
+  parser.add_argument('--batch_size', type=int, default=500,
+                      help='Rows moved per transaction.')
+  parser.add_argument('--sleep', type=float, default=0.5,
+                      help='Seconds to pause between two batches.')
+  parser.add_argument('--max_batches', type=int, default=None,
+                      help='Stop after this many batches.')
+  parser.add_argument(
+      '--checkpoint_file', default='/var/tmp/archive_task_instances.json',
+      help='File the last archived key is kept in to resume from.')
+  parser.add_argument('--dry_run', action='store_true',
+                      help='Only count the rows that would be archived.')
+  args = parser.parse_args()
+
+  if args.sql_alchemy_conn:
+    engine = checker_core.use_utc_time_zone(
+        create_engine(args.sql_alchemy_conn))
+  else:
+    engine = checker_core.get_engine()
+  cutoff = datetime.utcnow() - timedelta(days=args.retention_days)
+  archiver = Archiver(engine, cutoff, args.batch_size, args.sleep,
+                      args.dry_run)
+  last_key = read_checkpoint(args.checkpoint_file)
+  if last_key is not None:
+    logging.info('Resuming after {}.'.format(last_key))
+  summary = archiver.run(last_key, args.checkpoint_file, args.max_batches)
+  summary['cutoff'] = cutoff.isoformat()
+  print(json.dumps(summary, sort_keys=True))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Predictive replica controller for the Airflow worker Deployment.
+
+Every interval the controller samples the task_instance table for the current
+load (queued + running tasks) and the arrival and completion counts over a
+sliding window. It projects the load `lookahead` seconds ahead, smooths the
+projection and sizes the worker Deployment so that each worker holds at most
+`tasks_per_worker` tasks. Scale-ups are applied at once; scale-downs only after
+`scale_down_cooldown` seconds without a scale change, and only down to the
+smallest Deployment the load fits at `scale_down_utilization`, which keeps
+bursty DAGs from making the replica count oscillate.
+
+Do not run the controller next to an HPA targeting the same Deployment.
+
+  Typical usage example:
+
+  python autoscaler.py --namespace $NAMESPACE --dry_run
+  python autoscaler.py --namespace $NAMESPACE --record /tmp/trace.jsonl
+  python autoscaler.py --simulate /tmp/trace.jsonl
+"""
+
+import argparse
+from datetime import timedelta
+import json
+import logging
+import math
+import time
+
+import instrumentation
+
+WORKER_DEPLOYMENT_NAME = 'airflow-worker'
+
+
+class ScalingPolicy(object):
+  """Computes the desired worker replica count from task flow samples.
+
+  Attributes:
+    min_replicas: Lower bound of the replica count.
+    max_replicas: Upper bound of the replica count.
+    tasks_per_worker: Tasks a single worker is expected to hold.
+    lookahead: Seconds the load is projected into the future.
+    smoothing: Weight of the newest projection in the exponential moving
+      average, between 0 (ignore new samples) and 1 (no smoothing).
+    scale_down_cooldown: Seconds since the last scale change before the policy
+      is allowed to remove workers.
+    scale_down_utilization: Utilization the smaller Deployment must stay
+      under for a scale-down to happen.
+  """
+
+  def __init__(self, min_replicas=1, max_replicas=5, tasks_per_worker=8,
+               lookahead=60, smoothing=0.5, scale_down_cooldown=300,
+               scale_down_utilization=0.8):
+    self.min_replicas = min_replicas
+    self.max_replicas = max_replicas
+    self.tasks_per_worker = tasks_per_worker
+    self.lookahead = lookahead
+    self.smoothing = smoothing
+    self.scale_down_cooldown = scale_down_cooldown
+    self.scale_down_utilization = scale_down_utilization
+    self.smoothed_load = None
+    self.last_change = None
+
+  def projected_load(self, sample):
+    """Projects queued + running tasks `lookahead` seconds ahead."""
+    window = float(sample['window']) or 1.0
+    net_rate = (sample['arrivals'] - sample['completions']) / window
+    load = sample['queued'] + sample['running']
+    return max(0.0, load + net_rate * self.lookahead)
+
+  def _bounded(self, replicas):
+    return max(self.min_replicas, min(self.max_replicas, replicas))
+
+  def desired_replicas(self, sample, current, now):
+    """Returns the replica count to apply given the current one."""
+    load = self.projected_load(sample)
+    if self.smoothed_load is None:
+      self.smoothed_load = load
+    else:
+      self.smoothed_load += self.smoothing * (load - self.smoothed_load)
+    # Never size below what is already running or waiting right now.
+    demand = max(self.smoothed_load, sample['queued'] + sample['running'])
+    target = self._bounded(int(math.ceil(demand / self.tasks_per_worker)))
+
+    desired = current
+    if target > current:
+      desired = target
+    elif target < current:
+      cooled_down = (self.last_change is None
+                     or now - self.last_change >= self.scale_down_cooldown)
+      # Smallest Deployment the load fits at scale_down_utilization.
+      fitting = self._bounded(max(target, int(math.ceil(
+          demand / (self.tasks_per_worker * self.scale_down_utilization)))))
+      if cooled_down and fitting < current:
+        desired = fitting
+    desired = self._bounded(desired)
+    if desired != current:
+      self.last_change = now
+    return desired
+
+
+def baseline_replicas(sample, tasks_per_worker, min_replicas, max_replicas):
+  """Replica count the static queue-length HPA would choose."""
+  replicas = int(math.ceil(sample['queued'] / float(tasks_per_worker)))
+  return max(min_replicas, min(max_replicas, replicas))
+
+
+def simulate(samples, policy):
+  """Replays recorded samples through the policy and the static baseline.
+
+  Each sample is a dict with 'time', 'queued', 'running', 'arrivals',
+  'completions' and 'window' keys, as written by --record. Returns summary
+  statistics for both strategies.
+  """
+  results = {}
+  strategies = {
+      'policy': lambda sample, current: policy.desired_replicas(
+          sample, current, sample['time']),
+      'baseline': lambda sample, current: baseline_replicas(
+          sample, policy.tasks_per_worker, policy.min_replicas,
+          policy.max_replicas),
+  }
+  for name, decide in sorted(strategies.items()):
+    current = policy.min_replicas
+    changes = 0
+    worker_seconds = 0.0
+    overloaded_seconds = 0.0
+    peak = current
+    previous_time = None
+    for sample in samples:
+      if previous_time is not None:
+        elapsed = sample['time'] - previous_time
+        worker_seconds += current * elapsed
+        if (sample['queued'] + sample['running'] >
+            current * policy.tasks_per_worker):
+          overloaded_seconds += elapsed
+      previous_time = sample['time']
+      desired = decide(sample, current)
+      if desired != current:
+        changes += 1
+        current = desired
+      peak = max(peak, current)
+    results[name] = {
+        'scale_changes': changes,
+        'peak_replicas': peak,
+        'worker_seconds': round(worker_seconds, 1),
+        'overloaded_seconds': round(overloaded_seconds, 1),
+    }
+  results['samples'] = len(samples)
+  return results
+
+
+def _load_kube_config():
+  from kubernetes import config as k8s_config
+  try:
+    k8s_config.load_incluster_config()
+  except k8s_config.ConfigException:
+    k8s_config.load_kube_config()
+
+
+def run(args, policy):
+  # import before use so the simulator runs without airflow or kubernetes.
+  import checker_lib
+
+  apps_api = None
+  if not args.dry_run:
+    from kubernetes import client as k8s_client
+    _load_kube_config()
+    apps_api = k8s_client.AppsV1Api()
+  window = timedelta(seconds=args.window)
+  current = policy.min_replicas
+  instrumentation.flush_periodically()
+  while True:
+    started = time.time()
+    try:
+      sample = checker_lib.task_rates(window)
+      sample['time'] = started
+      if args.record:
+        with open(args.record, 'a') as trace_file:
+          trace_file.write(json.dumps(sample) + '\n')
+      if apps_api is not None:
+        current = apps_api.read_namespaced_deployment_scale(
+            args.deployment, args.namespace).spec.replicas
+      desired = policy.desired_replicas(sample, current, started)
+      if desired != current:
+        logging.info('Scaling {} from {} to {} replicas. Sample: {}'.format(
+            args.deployment, current, desired, sample))
+        if apps_api is not None:
+          apps_api.patch_namespaced_deployment_scale(
+              args.deployment, args.namespace,
+              {'spec': {'replicas': desired}})
+        current = desired
+      elif args.dry_run:
+        print('Keeping {} replicas. Sample: {}'.format(current, sample))
+    except Exception:
+      logging.exception('Autoscaler iteration failed.')
+    time.sleep(max(0, args.interval - (time.time() - started)))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--namespace', default='default')
+  parser.add_argument('--deployment', default=WORKER_DEPLOYMENT_NAME)
+  parser.add_argument('--min_replicas', type=int, default=1)
+  parser.add_argument('--max_replicas', type=int, default=5)
+  parser.add_argument(
+      '--tasks_per_worker', type=float, default=8,
+      help='Tasks a single worker should hold.')
+  parser.add_argument(
+      '--lookahead', type=float, default=60,
+      help='Seconds the load is projected ahead.')
+  parser.add_argument(
+      '--smoothing', type=float, default=0.5,
+      help='Weight of the newest sample in the moving average.')
+  parser.add_argument(
+      '--scale_down_cooldown', type=float, default=300,
+      help='Seconds after a scale change before scaling down.')
+  parser.add_argument(
+      '--window', type=float, default=120,
+      help='Seconds over which arrivals and completions are counted.')
+  parser.add_argument(
+      '--interval', type=float, default=15,
+      help='Seconds between two controller iterations.')
+  parser.add_argument(
+      '--dry_run', action='store_true',
+      help='Print the decisions instead of patching the Deployment.')
+  parser.add_argument(
+      '--record', default=None, help='Append every sample to this file.')
+  parser.add_argument(
+      '--simulate', default=None,
+      help='Replay samples recorded with --record and print a summary.')
+  args = parser.parse_args()
+
+  policy = ScalingPolicy(
+      min_replicas=args.min_replicas,
+      max_replicas=args.max_replicas,
+      tasks_per_worker=args.tasks_per_worker,
+      lookahead=args.lookahead,
+      smoothing=args.smoothing,
+      scale_down_cooldown=args.scale_down_cooldown)
+  if args.simulate:
+    with open(args.simulate) as trace_file:
+      samples = [json.loads(line) for line in trace_file if line.strip()]
+    print(json.dumps(simulate(samples, policy), sort_keys=True))
+    return
+  run(args, policy)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
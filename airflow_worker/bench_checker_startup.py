@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the cold-start cost of the checker_lib backends.
+
+Each run starts a fresh interpreter, as a Kubernetes exec probe does, imports
+checker_lib with CHECKER_BACKEND set and runs one task_count_by_state call.
+Prints one JSON line per backend with the wall-clock timings in seconds.
+
+  Typical usage example:
+
+  AIRFLOW__CORE__SQL_ALCHEMY_CONN=mysql+mysqldb://... \
+      python bench_checker_startup.py --runs 10
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import checker_lib
+
+PROBE_CODE = 'import checker_lib; checker_lib.task_count_by_state()'
+
+
+def time_backend(backend, runs):
+  env = os.environ.copy()
+  env[checker_lib.BACKEND_ENV_KEY] = backend
+  cwd = os.path.dirname(os.path.abspath(__file__))
+  timings = []
+  for _ in range(runs):
+    start_t = time.time()
+    subprocess.check_call([sys.executable, '-c', PROBE_CODE], env=env, cwd=cwd)
+    timings.append(time.time() - start_t)
+  timings.sort()
+  return {
+      'backend': backend,
+      'runs': runs,
+      'min': round(timings[0], 4),
+      'median': round(timings[len(timings) // 2], 4),
+      'max': round(timings[-1], 4),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-n', '--runs', type=int, default=5, help='Probe runs per backend.')
+  parser.add_argument(
+      '-b', '--backends', nargs='+',
+      default=[checker_lib.AIRFLOW_BACKEND, checker_lib.CORE_BACKEND],
+      help='Backends to compare.')
+  args = parser.parse_args()
+  for backend in args.backends:
+    print(json.dumps(time_backend(backend, args.runs)))
+
+
+if __name__ == '__main__':
+  main()
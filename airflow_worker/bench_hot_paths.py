@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the checker and connection-discovery hot paths.
+
+Two benchmarks, both reported as one JSON document so runs can be compared:
+  - checker: fills a local stand-in metadata DB (a SQLite file per size by
+    default, or any --sql_alchemy_conn) with task_instance rows spread over
+    states and hosts, then measures the latency and the number of SQL
+    statements of the checker_lib queries at each size.
+  - scan: starts fake listeners on loopback addresses and times
+    SqlConnectionUtils.find_working_ip_address over that subnet at several
+    concurrency levels.
+
+  Typical usage example:
+
+  python bench_hot_paths.py --sizes 10000 1000000 --output bench.json
+  python bench_hot_paths.py --skip_scan --sizes 10000000 --with_indexes
+"""
+
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+
+DEFAULT_SIZES = [10000, 1000000, 10000000]
+# Share of generated rows per state. Most of the table is finished history.
+STATE_WEIGHTS = (
+    ('success', 0.90),
+    ('failed', 0.04),
+    ('up_for_retry', 0.01),
+    ('scheduled', 0.02),
+    ('queued', 0.02),
+    ('running', 0.01),
+)
+HISTORY_SPAN = timedelta(days=30)
+INSERT_BATCH = 20000
+
+
+def _percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _summary(timings):
+  return {
+      'runs': len(timings),
+      'median_ms': round(_percentile(timings, 0.5) * 1000, 3),
+      'p95_ms': round(_percentile(timings, 0.95) * 1000, 3),
+      'max_ms': round(max(timings) * 1000, 3),
+  }
+
+
+def populate(engine, num_rows, num_hosts, seed=0):
+  """Creates task_instance and fills it with num_rows generated rows."""
+  import checker_core
+  checker_core.metadata.create_all(engine)
+  rng = random.Random(seed)
+  now = datetime.utcnow()
+  hosts = ['airflow-worker-{}'.format(i) for i in range(num_hosts)]
+  span = HISTORY_SPAN.total_seconds()
+  insert = checker_core.task_instance.insert()
+  inserted = 0
+  while inserted < num_rows:
+    rows = []
+    for i in range(inserted, min(num_rows, inserted + INSERT_BATCH)):
+      state = _weighted_choice(rng, STATE_WEIGHTS)
+      queued = now - timedelta(seconds=rng.random() * span)
+      finished = state in ('success', 'failed', 'up_for_retry')
+      rows.append({
+          'task_id': 'task_{}'.format(i % 1000),
+          'dag_id': 'dag_{}'.format(i // 1000),
+          'execution_date': queued,
+          'state': state,
+          'hostname': rng.choice(hosts) if state != 'scheduled' else None,
+          'queued_dttm': queued,
+          'start_date': queued if state != 'queued' else None,
+          'end_date': (queued + timedelta(seconds=rng.random() * 600)
+                       if finished else None),
+      })
+    with engine.begin() as connection:
+      connection.execute(insert, rows)
+    inserted += len(rows)
+
+
+def _weighted_choice(rng, weighted):
+  point = rng.random() * sum(weight for _, weight in weighted)
+  for value, weight in weighted:
+    point -= weight
+    if point <= 0:
+      return value
+  return weighted[-1][0]
+
+
+def bench_checker(args, num_rows):
+  """Measures the checker_lib queries against a table of num_rows rows."""
+  from sqlalchemy import create_engine
+  from sqlalchemy import event
+  from sqlalchemy import func
+  from sqlalchemy import select
+
+  import checker_core
+  import checker_lib
+
+  conn = args.sql_alchemy_conn or 'sqlite:///{}'.format(
+      os.path.join(args.workdir, 'bench_ti_{}.db'.format(num_rows)))
+  engine = create_engine(conn)
+  checker_core.metadata.create_all(engine)
+  existing = engine.execute(
+      select([func.count()]).select_from(checker_core.task_instance)).scalar()
+  if existing != num_rows:
+    if existing:
+      engine.execute(checker_core.task_instance.delete())
+    populate(engine, num_rows, args.hosts)
+  if args.with_indexes:
+    checker_lib.create_checker_indexes(engine, checker_core.task_instance)
+
+  statements = []
+  event.listen(engine, 'before_cursor_execute',
+               lambda *unused: statements.append(1))
+  os.environ[checker_lib.BACKEND_ENV_KEY] = checker_lib.CORE_BACKEND
+  checker_core._engine = engine
+  checker_lib.host_name = 'airflow-worker-0'
+
+  counter = checker_lib.RecentlyDoneCounter()
+  cases = (
+      ('task_count_by_state(host)',
+       lambda: checker_lib.task_count_by_state(True)),
+      ('task_count_by_state(all)',
+       lambda: checker_lib.task_count_by_state(False)),
+      ('task_count_by_state(incremental)',
+       lambda: checker_lib.task_count_by_state(
+           True, recently_done_counter=counter)),
+      ('fleet_task_counts', checker_lib.fleet_task_counts),
+  )
+  results = []
+  for name, call in cases:
+    call()  # Warm up the connection pool and the DB caches.
+    del statements[:]
+    timings = []
+    for _ in range(args.repeat):
+      start_t = time.time()
+      call()
+      timings.append(time.time() - start_t)
+    result = _summary(timings)
+    result.update({'case': name, 'rows': num_rows,
+                   'queries_per_call': len(statements) / float(args.repeat),
+                   'indexes': bool(args.with_indexes)})
+    results.append(result)
+  engine.dispose()
+  return results
+
+
+class FakeSubnet(object):
+  """Loopback listeners standing in for hosts of a SQL subnet.
+
+  Addresses in `listening` accept TCP connections; only `target` completes
+  the (fake) SQL handshake. The other listeners stall the handshake for
+  `handshake_delay` seconds, like a host running some other service.
+  """
+
+  def __init__(self, cidr, listening, target, port, handshake_delay):
+    self.cidr = cidr
+    self.listening = listening
+    self.target = target
+    self.port = port
+    self.handshake_delay = handshake_delay
+    self._sockets = []
+
+  def start(self):
+    for address in self.listening:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.bind((address, self.port))
+      sock.listen(128)
+      self._sockets.append(sock)
+      thread = threading.Thread(target=self._accept, args=(sock,))
+      thread.daemon = True
+      thread.start()
+
+  def _accept(self, sock):
+    while True:
+      try:
+        connection, _ = sock.accept()
+      except (socket.error, OSError):
+        return
+      connection.close()
+
+  def stop(self):
+    for sock in self._sockets:
+      sock.close()
+
+  def utils_class(self):
+    """Returns a SqlConnectionUtils whose handshake talks to this subnet."""
+    import sync_sql_ip
+    subnet = self
+
+    class FakeHandshakeUtils(sync_sql_ip.SqlConnectionUtils):
+
+      def _test_connection(self, conn):
+        address = conn.split('@', 1)[1].split('/', 1)[0]
+        try:
+          socket.create_connection((address, subnet.port),
+                                   self.timeout).close()
+        except (socket.error, socket.timeout):
+          return False
+        if address == subnet.target:
+          return True
+        time.sleep(min(self.timeout, subnet.handshake_delay))
+        return False
+
+    return FakeHandshakeUtils
+
+
+def bench_scan(args):
+  """Times find_working_ip_address over a fake loopback subnet."""
+  import sync_sql_ip
+
+  sync_sql_ip.SQL_PORT = args.scan_port
+  hosts = ['127.0.{}.{}'.format(args.scan_octet, i) for i in range(1, 255)]
+  rng = random.Random(1)
+  listening = rng.sample(hosts, args.scan_listeners)
+  target = hosts[-1] if args.scan_target_last else listening[-1]
+  if target not in listening:
+    listening.append(target)
+  subnet = FakeSubnet('127.0.{}.0/24'.format(args.scan_octet), listening,
+                      target, args.scan_port, args.scan_handshake_delay)
+  subnet.start()
+  utils_class = subnet.utils_class()
+  credentials = sync_sql_ip.SqlCredentials('airflow', 'root', 'password')
+  results = []
+  try:
+    for concurrency in args.scan_concurrency:
+      timings = []
+      for _ in range(args.scan_repeat):
+        utils = utils_class(credentials, concurrency=concurrency,
+                            timeout=args.scan_timeout)
+        start_t = time.time()
+        found = utils.find_working_ip_address(subnet.cidr)
+        timings.append(time.time() - start_t)
+        if found != target:
+          raise Exception('Scan found {} instead of {}.'.format(found, target))
+      result = _summary(timings)
+      result.update({'concurrency': concurrency, 'cidr': subnet.cidr,
+                     'listeners': len(listening),
+                     'target_index': hosts.index(target)})
+      results.append(result)
+  finally:
+    subnet.stop()
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+      help='task_instance row counts to benchmark.')
+  parser.add_argument('--hosts', type=int, default=20,
+                      help='Number of worker host names in generated rows.')
+  parser.add_argument('--repeat', type=int, default=20,
+                      help='Timed calls per checker query.')
+  parser.add_argument(
+      '--sql_alchemy_conn', default=None,
+      help='Stand-in DB to use instead of one SQLite file per size. Its '
+      'task_instance table is refilled for every size.')
+  parser.add_argument('--workdir', default='/tmp',
+                      help='Where the SQLite stand-ins are kept.')
+  parser.add_argument('--with_indexes', action='store_true',
+                      help='Create checker_lib.CHECKER_INDEXES first.')
+  parser.add_argument('--skip_checker', action='store_true')
+  parser.add_argument('--skip_scan', action='store_true')
+  parser.add_argument('--scan_octet', type=int, default=77,
+                      help='Third octet of the fake 127.0.X.0/24 subnet.')
+  parser.add_argument('--scan_port', type=int, default=13306)
+  parser.add_argument('--scan_listeners', type=int, default=8,
+                      help='Fake hosts that accept TCP connections.')
+  parser.add_argument(
+      '--scan_target_last', action='store_true',
+      help='Put the SQL listener on the last address of the subnet.')
+  parser.add_argument('--scan_handshake_delay', type=float, default=0.5,
+                      help='Seconds a non-SQL listener stalls the handshake.')
+  parser.add_argument('--scan_timeout', type=float, default=2)
+  parser.add_argument('--scan_concurrency', type=int, nargs='+',
+                      default=[1, 8, 32])
+  parser.add_argument('--scan_repeat', type=int, default=3)
+  parser.add_argument('--output', default=None,
+                      help='Write the JSON results here instead of stdout.')
+  args = parser.parse_args()
+
+  report = {
+      'started_at': datetime.utcnow().isoformat(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+  }
+  if not args.skip_checker:
+    report['checker'] = []
+    for size in args.sizes:
+      report['checker'].extend(bench_checker(args, size))
+  if not args.skip_scan:
+    report['scan'] = bench_scan(args)
+
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      output_file.write(output + '\n')
+  else:
+    sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,91 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Airflow-free access to the metadata DB for the liveness checkers.
+
+Declares only the task_instance and job columns the checkers read and
+connects with plain SQLAlchemy Core using the same connection string Airflow
+uses, so a probe does not pay for importing airflow.models and
+airflow.settings. Like Airflow's engine, MySQL sessions use the UTC time zone,
+so the naive UTC datetimes the checkers compare with do not depend on the
+server time zone.
+"""
+
+import os
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import create_engine
+from sqlalchemy import event
+
+AIRFLOW_CONNECTION_ENV_KEY = 'AIRFLOW__CORE__SQL_ALCHEMY_CONN'
+
+metadata = MetaData()
+
+task_instance = Table(
+    'task_instance', metadata,
+    Column('task_id', String(250), primary_key=True),
+    Column('dag_id', String(250), primary_key=True),
+    Column('execution_date', DateTime, primary_key=True),
+    Column('state', String(20)),
+    Column('hostname', String(1000)),
+    Column('start_date', DateTime),
+    Column('end_date', DateTime),
+    Column('queued_dttm', DateTime),
+)
+
+job = Table(
+    'job', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('job_type', String(30)),
+    Column('state', String(20)),
+    Column('hostname', String(500)),
+    Column('latest_heartbeat', DateTime),
+)
+
+_engine = None
+
+
+def _set_utc_time_zone(dbapi_connection, unused_connection_record):
+  cursor = dbapi_connection.cursor()
+  cursor.execute("SET time_zone = '+00:00'")
+  cursor.close()
+
+
+def use_utc_time_zone(engine):
+  """Sets the session time zone of new MySQL connections of engine to UTC."""
+  if engine.dialect.name == 'mysql':
+    event.listen(engine, 'connect', _set_utc_time_zone)
+  return engine
+
+
+def get_engine():
+  """Returns the process-wide engine, creating it on first use."""
+  global _engine
+  if _engine is None:
+    conn = os.getenv(AIRFLOW_CONNECTION_ENV_KEY)
+    if conn is None:
+      raise Exception(
+          'Can not found {} env variable.'.format(AIRFLOW_CONNECTION_ENV_KEY))
+    _engine = use_utc_time_zone(create_engine(conn, pool_recycle=1800))
+  return _engine
+
+
+def execute(statement):
+  """Runs a statement on a pooled connection and returns all result rows."""
+  with get_engine().connect() as connection:
+    return connection.execute(statement).fetchall()
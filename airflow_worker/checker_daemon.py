@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Resident liveness checker for workers and schedulers.
+
+Instead of starting a fresh Python process for every Kubernetes probe, this
+daemon imports checker_lib once, refreshes the task counts on a fixed interval
+from a background thread and answers HTTP probes from the cached result.
+
+The probe fails when:
+  - the cached counts are in error state (see checker_lib.declare_error_state).
+  - the last successful refresh is older than --staleness seconds, which means
+    the refresh loop itself is stuck or the DB is unreachable.
+
+  Typical usage example:
+
+  python checker_daemon.py --mode worker --port 8081 --interval 10
+
+  livenessProbe:
+    httpGet:
+      path: /health
+      port: 8081
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+
+import checker_lib
+import instrumentation
+
+MODES = {
+    # mode: (use_host_name, check_scheduled)
+    'worker': (True, False),
+    'scheduler': (False, True),
+}
+
+
+class CountsRefresher(threading.Thread):
+  """Background thread that keeps the latest task counts.
+
+  Attributes:
+    interval: Seconds between two refreshes.
+    counts: The last successfully fetched task counts, or None.
+    refreshed_at: Time of the last successful refresh. Initialized with the
+      start time so that a fresh daemon is not reported stale right away.
+    last_error: The exception raised by the last failed refresh, if any.
+    recently_done_counter: A checker_lib.RecentlyDoneCounter when the
+      recently_done count is maintained incrementally, otherwise None.
+  """
+
+  def __init__(self, use_host_name, interval, incremental=False):
+    super(CountsRefresher, self).__init__()
+    self.daemon = True
+    self.use_host_name = use_host_name
+    self.interval = interval
+    self.recently_done_counter = None
+    if incremental:
+      self.recently_done_counter = checker_lib.RecentlyDoneCounter(
+          use_host_name=use_host_name)
+    self.counts = None
+    self.refreshed_at = time.time()
+    self.last_error = None
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+
+  def fetch(self):
+    return checker_lib.task_count_by_state(
+        self.use_host_name,
+        recently_done_counter=self.recently_done_counter)
+
+  def refresh(self):
+    try:
+      counts = self.fetch()
+    except Exception as e:
+      logging.exception('Failed to refresh task counts.')
+      with self._lock:
+        self.last_error = e
+      return
+    with self._lock:
+      self.counts = counts
+      self.refreshed_at = time.time()
+      self.last_error = None
+
+  def snapshot(self):
+    """Returns (counts, age in seconds, last error) atomically."""
+    with self._lock:
+      return self.counts, time.time() - self.refreshed_at, self.last_error
+
+  def run(self):
+    while not self._stopped.is_set():
+      started = time.time()
+      self.refresh()
+      self._stopped.wait(max(0, self.interval - (time.time() - started)))
+
+  def stop(self):
+    self._stopped.set()
+
+
+def verdict(refresher, staleness, check_scheduled):
+  """Returns (healthy, details) for the refresher's current snapshot."""
+  counts, age, last_error = refresher.snapshot()
+  details = {'host': checker_lib.host_name, 'counts': counts,
+             'age': round(age, 3)}
+  if last_error is not None:
+    details['last_error'] = str(last_error)
+  if age > staleness:
+    details['reason'] = 'task counts are stale'
+    return False, details
+  if counts is not None and checker_lib.declare_error_state(
+      counts, check_scheduled=check_scheduled):
+    details['reason'] = 'queued tasks are not being processed'
+    return False, details
+  return True, details
+
+
+def make_handler(refresher, staleness, check_scheduled):
+  """Builds the HTTP handler class bound to a refresher."""
+
+  class ProbeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      healthy, details = verdict(refresher, staleness, check_scheduled)
+      body = json.dumps(details).encode('utf-8')
+      self.send_response(200 if healthy else 500)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      # Probes arrive every few seconds; do not flood the container log.
+      pass
+
+  return ProbeHandler
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-m', '--mode', choices=sorted(MODES), default='worker',
+      help='Which component this daemon checks.')
+  parser.add_argument(
+      '-p', '--port', type=int, default=8081, help='Port to serve probes on.')
+  parser.add_argument(
+      '-i', '--interval', type=float, default=10,
+      help='Seconds between two task count refreshes.')
+  parser.add_argument(
+      '-s', '--staleness', type=float, default=120,
+      help='Age in seconds after which cached counts fail the probe.')
+  parser.add_argument(
+      '--incremental', action='store_true',
+      help='Count recently finished tasks incrementally between refreshes.')
+  args = parser.parse_args()
+
+  use_host_name, check_scheduled = MODES[args.mode]
+  refresher = CountsRefresher(use_host_name, args.interval, args.incremental)
+  refresher.start()
+  instrumentation.flush_periodically()
+  server = BaseHTTPServer.HTTPServer(
+      ('', args.port), make_handler(refresher, args.staleness, check_scheduled))
+  logging.info('Serving {} probes on port {}.'.format(args.mode, args.port))
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
@@ -0,0 +1,162 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fixed-size on-disk history of task count snapshots.
+
+The history is a ring buffer in a small binary file: a header with the next
+slot and the number of stored snapshots, followed by `capacity` fixed-size
+records. It persists across probe invocations, so each probe costs one read
+of a few kilobytes and one rewrite of the file through a temporary file and a
+rename.
+
+The trend verdicts built on top of it replace the single-snapshot
+checker_lib.declare_error_state:
+  - stuck: the error state held for every snapshot in the last `grace`
+    seconds, which tolerates short pauses such as DAG parsing. The snapshots
+    must cover the whole window without gaps, so a probe that did not run
+    for a while does not fail on its first bad snapshot.
+  - degraded: the queued backlog kept growing across the last `window`
+    seconds while this host kept as many tasks running but finished fewer.
+    The backlog is fleet-wide, so a host with steady throughput is never
+    degraded: a growing backlog alone means the fleet is short of capacity.
+"""
+
+import math
+import os
+import struct
+import time
+
+HEADER = struct.Struct('<4sII')
+RECORD = struct.Struct('<dIIII')
+MAGIC = b'TCH1'
+FIELDS = ('scheduled', 'queued', 'running', 'recently_done')
+# Shortest probe period Kubernetes allows, in seconds.
+MIN_PROBE_PERIOD = 1
+
+
+def capacity_for(window, probe_period=MIN_PROBE_PERIOD):
+  """Returns the capacity holding `window` seconds of snapshots.
+
+  Assumes no two snapshots are taken less than `probe_period` seconds apart.
+  """
+  return int(math.ceil(float(window) / probe_period)) + 1
+
+
+class History(object):
+  """Ring buffer of (timestamp, task counts) snapshots stored in a file.
+
+  Attributes:
+    path: File the history is kept in.
+    capacity: Maximum number of snapshots kept.
+  """
+
+  def __init__(self, path, capacity=64):
+    self.path = path
+    self.capacity = capacity
+
+  def _size(self):
+    return HEADER.size + RECORD.size * self.capacity
+
+  def _read(self):
+    """Returns (next_slot, count, raw records) or an empty history."""
+    try:
+      with open(self.path, 'rb') as history_file:
+        data = history_file.read(self._size())
+    except (IOError, OSError):
+      data = b''
+    if len(data) == self._size():
+      magic, next_slot, count = HEADER.unpack_from(data)
+      if magic == MAGIC and next_slot < self.capacity and (
+          count <= self.capacity):
+        return next_slot, count, data
+    return 0, 0, b'\0' * self._size()
+
+  def snapshots(self):
+    """Returns the stored snapshots, oldest first, as (timestamp, counts)."""
+    next_slot, count, data = self._read()
+    return self._decode(next_slot, count, data)
+
+  def _decode(self, next_slot, count, data):
+    snapshots = []
+    for i in range(count):
+      slot = (next_slot - count + i) % self.capacity
+      record = RECORD.unpack_from(data, HEADER.size + slot * RECORD.size)
+      snapshots.append((record[0], dict(zip(FIELDS, record[1:]))))
+    return snapshots
+
+  def append(self, counts, timestamp=None):
+    """Stores a snapshot and returns all snapshots, oldest first."""
+    next_slot, count, data = self._read()
+    data = bytearray(data)
+    RECORD.pack_into(data, HEADER.size + next_slot * RECORD.size,
+                     timestamp if timestamp is not None else time.time(),
+                     *[max(0, int(counts[field])) for field in FIELDS])
+    next_slot = (next_slot + 1) % self.capacity
+    count = min(count + 1, self.capacity)
+    HEADER.pack_into(data, 0, MAGIC, next_slot, count)
+    tmp_path = '{}.{}'.format(self.path, os.getpid())
+    with open(tmp_path, 'wb') as history_file:
+      history_file.write(data)
+    os.rename(tmp_path, self.path)
+    return self._decode(next_slot, count, bytes(data))
+
+
+def _recent(snapshots, window, now):
+  return [(ts, counts) for ts, counts in snapshots if now - ts <= window]
+
+
+def is_stuck(snapshots, declare_error_state, grace, max_gap=None, now=None,
+             **kwargs):
+  """Returns True iff every snapshot over the last `grace` seconds is in error.
+
+  The snapshots must span the whole window: the last one taken at or before
+  its start and every later one must be in error, with no two consecutive
+  snapshots (nor the newest one and now) more than `max_gap` seconds apart.
+  max_gap defaults to half of grace.
+  """
+  now = now if now is not None else time.time()
+  max_gap = max_gap if max_gap is not None else grace / 2.0
+  start = None
+  for i, (timestamp, _) in enumerate(snapshots):
+    if now - timestamp >= grace:
+      start = i
+  if start is None:
+    return False
+  covering = snapshots[start:]
+  timestamps = [timestamp for timestamp, _ in covering] + [now]
+  if any(later - earlier > max_gap
+         for earlier, later in zip(timestamps, timestamps[1:])):
+    return False
+  return all(declare_error_state(counts, **kwargs) for _, counts in covering)
+
+
+def is_degraded(snapshots, window, min_samples=5, now=None):
+  """Returns True iff the backlog grows while throughput stays flat.
+
+  Looks at the snapshots in the last `window` seconds: the fleet-wide queued
+  count must never shrink and must end higher than it started, while this
+  host is saturated, i.e. ends with at least as many running tasks as it
+  started with, and its recently_done (the completions over the last 10
+  minutes) dropped.
+  """
+  now = now if now is not None else time.time()
+  recent = _recent(snapshots, window, now)
+  if len(recent) < min_samples:
+    return False
+  queued = [counts['queued'] for _, counts in recent]
+  running = [counts['running'] for _, counts in recent]
+  done = [counts['recently_done'] for _, counts in recent]
+  backlog_growing = queued[-1] > queued[0] and all(
+      later >= earlier for earlier, later in zip(queued, queued[1:]))
+  saturated = running[-1] >= running[0] > 0
+  return backlog_growing and saturated and done[-1] < done[0]
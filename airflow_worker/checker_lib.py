@@ -12,48 +12,397 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Utility functions that facilitate worker and scheduler liveness checker."""
+"""Utility functions that facilitate worker and scheduler liveness checker.
 
+Queries go through one of two backends, picked with the CHECKER_BACKEND
+environment variable:
+  - airflow (default): airflow.models and the airflow.settings Session.
+  - core: checker_core, plain SQLAlchemy Core without importing Airflow.
+"""
+
+import calendar
 from datetime import datetime
 from datetime import timedelta
-from six import iteritems
+import json
+import os
 import socket
+import tempfile
+import time
 
-from airflow import models
-from airflow.settings import Session
+import sqlalchemy
+from sqlalchemy import and_
+from sqlalchemy import case
 from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+
+import instrumentation
 
 host_name = socket.gethostname()
 
+PENDING_STATES = ('scheduled', 'queued', 'running')
+DONE_STATES = ('success', 'failed', 'up_for_retry')
+RECENTLY_DONE_WINDOW = timedelta(minutes=10)
+
+# task_instance indexes matching the predicates below, as name: columns.
+# hostname is a VARCHAR(1000) column, so MySQL only indexes a prefix of it to
+# stay within the InnoDB key length limit.
+CHECKER_INDEXES = {
+    'ti_checker_state_hostname_end_date': ('state', 'hostname', 'end_date'),
+    'ti_checker_state_end_date': ('state', 'end_date'),
+    'ti_checker_queued_dttm': ('queued_dttm',),
+}
+HOSTNAME_INDEX_PREFIX = 191
+
+BACKEND_ENV_KEY = 'CHECKER_BACKEND'
+AIRFLOW_BACKEND = 'airflow'
+CORE_BACKEND = 'core'
+
+
+def _use_core_backend():
+  return os.getenv(BACKEND_ENV_KEY, AIRFLOW_BACKEND) == CORE_BACKEND
+
+
+def _task_instance_columns():
+  if _use_core_backend():
+    with instrumentation.timer('import', module='checker_core'):
+      import checker_core
+    return checker_core.task_instance.c
+  with instrumentation.timer('import', module='airflow.models'):
+    from airflow import models
+  return models.TaskInstance.__table__.c
 
-def _check_query_size(task_query):
-  query_statement = task_query.statement.with_only_columns([func.count()])
-  return task_query.session.execute(query_statement).scalar()
 
+def _job_columns():
+  if _use_core_backend():
+    with instrumentation.timer('import', module='checker_core'):
+      import checker_core
+    return checker_core.job.c
+  with instrumentation.timer('import', module='airflow.jobs'):
+    from airflow.jobs import BaseJob
+  return BaseJob.__table__.c
 
-def task_count_by_state(use_host_name=True):
-  ten_minutes_ago = datetime.utcnow() - timedelta(minutes=10)
+
+def _execute(statement, name):
+  """Runs the statement on the configured backend and returns all rows.
+
+  The query is timed under `name` when instrumentation is enabled.
+  """
+  with instrumentation.timer('checker_query', query=name):
+    if _use_core_backend():
+      import checker_core
+      return checker_core.execute(statement)
+    from airflow.settings import Session
+    try:
+      return Session.execute(statement).fetchall()
+    finally:
+      # Hand the connection back to the pool and end the transaction so a
+      # long-lived caller does not keep reading the same snapshot.
+      Session.remove()
+
+
+def _utcnow():
+  if _use_core_backend():
+    return datetime.utcnow()
   try:
     from airflow.utils import timezone
-    ten_minutes_ago = timezone.utcnow() - timedelta(minutes=10)
+    return timezone.utcnow()
   except:
-    pass
-  queries = {
-      state: Session.query(
-          models.TaskInstance).filter(models.TaskInstance.state == state)
-      for state in ('scheduled', 'queued', 'running')
-  }
-  queries['recently_done'] = Session.query(models.TaskInstance).filter(
-      models.TaskInstance.state.in_(['success', 'failed', 'up_for_retry']),
-      models.TaskInstance.end_date > ten_minutes_ago)
+    return datetime.utcnow()
+
+
+def _recently_done_cutoff():
+  return _utcnow() - RECENTLY_DONE_WINDOW
+
 
+def _count_if(condition):
+  return func.sum(case([(condition, 1)], else_=0))
+
+
+def task_count_statement(ti, since, use_host_name=True, hostname=None,
+                         include_recently_done=True):
+  """Builds one query counting scheduled/queued/running/recently_done tasks.
+
+  :param ti: the columns of the task_instance table, e.g.
+      models.TaskInstance.__table__.c
+  :param since: only tasks finished after this time count as recently done
+  :param use_host_name: restrict running and recently_done to `hostname`
+  :param hostname: defaults to the host name of this machine
+  :param include_recently_done: when False, the recently_done column is left
+      out and finished tasks are not read at all
+  """
+  recently_done = and_(ti.state.in_(DONE_STATES), ti.end_date > since)
+  running = ti.state == 'running'
   if use_host_name:
-    for state in ('running', 'recently_done'):
-      queries[state] = queries[state].filter(
-          models.TaskInstance.hostname == host_name)
+    on_host = ti.hostname == (hostname or host_name)
+    running = and_(running, on_host)
+    recently_done = and_(recently_done, on_host)
+  columns = [
+      _count_if(ti.state == 'scheduled').label('scheduled'),
+      _count_if(ti.state == 'queued').label('queued'),
+      _count_if(running).label('running'),
+  ]
+  if not include_recently_done:
+    return select(columns).where(ti.state.in_(PENDING_STATES))
+  columns.append(_count_if(recently_done).label('recently_done'))
+  return select(columns).where(or_(ti.state.in_(PENDING_STATES),
+                                   recently_done))
+
+
+def task_count_by_state(use_host_name=True, recently_done_counter=None,
+                        window=None):
+  """Returns the scheduled/queued/running/recently_done task counts.
+
+  :param use_host_name: restrict running and recently_done to this host
+  :param recently_done_counter: optional RecentlyDoneCounter that supplies
+      recently_done incrementally instead of recounting the whole window
+  :param window: optional timedelta to count recently_done over instead of
+      RECENTLY_DONE_WINDOW; ignored with a recently_done_counter
+  :type window: datetime.timedelta
+  """
+  since = (_recently_done_cutoff() if window is None
+           else _utcnow() - window)
+  statement = task_count_statement(
+      _task_instance_columns(), since, use_host_name,
+      include_recently_done=recently_done_counter is None)
+  row = _execute(statement, 'task_count_by_state')[0]
+  counts = {state: int(row[state] or 0)
+            for state in ('scheduled', 'queued', 'running')}
+  if recently_done_counter is None:
+    counts['recently_done'] = int(row['recently_done'] or 0)
+  else:
+    counts['recently_done'] = recently_done_counter.count()
+  return counts
+
+
+class RecentlyDoneCounter(object):
+  """Counts recently finished tasks incrementally.
+
+  Keeps the number of completions per time bucket in a ring buffer covering
+  RECENTLY_DONE_WINDOW. Each call to count() only fetches the rows that
+  finished after the high-water mark of their state, and buckets that leave
+  the window are dropped. Completions that become visible late (e.g. a commit
+  racing the high-water mark) are picked up by a full resync of the window
+  every `resync_every` calls.
+
+  The window edge has bucket granularity, so the count can differ from the
+  task_count_by_state query by the completions within `bucket_seconds` of the
+  cutoff.
+  """
+
+  def __init__(self, use_host_name=True, bucket_seconds=10, resync_every=30):
+    self.use_host_name = use_host_name
+    self.bucket_seconds = bucket_seconds
+    self.resync_every = resync_every
+    self._num_buckets = int(
+        RECENTLY_DONE_WINDOW.total_seconds() // bucket_seconds) + 1
+    self._bucket_ids = [None] * self._num_buckets
+    self._bucket_counts = [0] * self._num_buckets
+    self._high_water = {}
+    self._calls = 0
+
+  def _bucket_id(self, timestamp):
+    seconds = calendar.timegm(timestamp.utctimetuple())
+    return int(seconds // self.bucket_seconds)
+
+  def _add(self, end_date):
+    bucket_id = self._bucket_id(end_date)
+    slot = bucket_id % self._num_buckets
+    if self._bucket_ids[slot] != bucket_id:
+      if (self._bucket_ids[slot] is not None and
+          self._bucket_ids[slot] > bucket_id):
+        # Older than what this slot already holds: outside the window.
+        return
+      self._bucket_ids[slot] = bucket_id
+      self._bucket_counts[slot] = 0
+    self._bucket_counts[slot] += 1
+
+  def _statement(self, ti, cutoff, full):
+    done_after = []
+    for state in DONE_STATES:
+      since = cutoff if full else max(cutoff, self._high_water.get(
+          state, cutoff))
+      done_after.append(and_(ti.state == state, ti.end_date > since))
+    statement = select([ti.state, ti.end_date]).where(or_(*done_after))
+    if self.use_host_name:
+      statement = statement.where(ti.hostname == host_name)
+    return statement
+
+  def _fetch(self, full):
+    cutoff = _recently_done_cutoff()
+    if full:
+      self._bucket_ids = [None] * self._num_buckets
+      self._bucket_counts = [0] * self._num_buckets
+      self._high_water = {}
+    rows = _execute(self._statement(_task_instance_columns(), cutoff, full),
+                    'recently_done_full' if full else 'recently_done_delta')
+    for row in rows:
+      end_date = row['end_date']
+      self._add(end_date)
+      high_water = self._high_water.get(row['state'])
+      if high_water is None or end_date > high_water:
+        self._high_water[row['state']] = end_date
+    return self._bucket_id(cutoff)
+
+  def count(self):
+    """Fetches new completions and returns the count within the window."""
+    full = self._calls % self.resync_every == 0
+    self._calls += 1
+    first_bucket = self._fetch(full)
+    return sum(count for bucket_id, count in zip(self._bucket_ids,
+                                                  self._bucket_counts)
+               if bucket_id is not None and bucket_id >= first_bucket)
+
+
+def task_rate_statement(ti, since):
+  """Builds one query returning the current load and the flow since `since`.
+
+  arrivals counts tasks queued after `since`, completions counts tasks that
+  finished after `since`.
+  """
+  completed = and_(ti.state.in_(DONE_STATES), ti.end_date > since)
+  return select([
+      _count_if(ti.state == 'queued').label('queued'),
+      _count_if(ti.state == 'running').label('running'),
+      _count_if(ti.queued_dttm > since).label('arrivals'),
+      _count_if(completed).label('completions'),
+  ]).where(or_(ti.state.in_(('queued', 'running')),
+               ti.queued_dttm > since,
+               completed))
+
+
+def task_rates(window):
+  """Returns queued/running counts and arrivals/completions in the window.
+
+  :param window: length of the observation window
+  :type window: datetime.timedelta
+  """
+  since = _utcnow() - window
+  row = _execute(task_rate_statement(_task_instance_columns(), since),
+                 'task_rates')[0]
+  rates = {key: int(row[key] or 0)
+           for key in ('queued', 'running', 'arrivals', 'completions')}
+  rates['window'] = window.total_seconds()
+  return rates
+
+
+def host_count_statement(ti, since):
+  """Builds one GROUP BY hostname query with running/recently_done per host."""
+  recently_done = and_(ti.state.in_(DONE_STATES), ti.end_date > since)
+  running = ti.state == 'running'
+  return select([
+      ti.hostname,
+      _count_if(running).label('running'),
+      _count_if(recently_done).label('recently_done'),
+  ]).where(or_(running, recently_done)).group_by(ti.hostname)
+
+
+def fleet_task_counts():
+  """Returns the global queue counts plus per-host counts for every worker.
+
+  Costs two queries no matter how many workers there are. Hosts without
+  running or recently finished tasks do not appear in 'hosts'.
+  """
+  ti = _task_instance_columns()
+  since = _recently_done_cutoff()
+  totals = _execute(task_count_statement(ti, since, use_host_name=False),
+                    'fleet_totals')[0]
+  hosts = {
+      row['hostname']: {'running': int(row['running'] or 0),
+                        'recently_done': int(row['recently_done'] or 0)}
+      for row in _execute(host_count_statement(ti, since), 'fleet_hosts')
+      if row['hostname']
+  }
+  return {'scheduled': int(totals['scheduled'] or 0),
+          'queued': int(totals['queued'] or 0),
+          'hosts': hosts}
+
+
+def host_task_counts(fleet_counts, hostname=None):
+  """Extracts task_count_by_state-shaped counts for one host."""
+  host_counts = fleet_counts['hosts'].get(hostname or host_name, {})
+  return {'scheduled': fleet_counts['scheduled'],
+          'queued': fleet_counts['queued'],
+          'running': host_counts.get('running', 0),
+          'recently_done': host_counts.get('recently_done', 0)}
+
+
+def write_fleet_status(path, fleet_counts):
+  """Atomically writes the fleet counts and per-host verdicts to path."""
+  status = dict(fleet_counts, generated_at=time.time())
+  status['hosts'] = {
+      hostname: dict(counts, error=declare_error_state(
+          host_task_counts(fleet_counts, hostname)))
+      for hostname, counts in fleet_counts['hosts'].items()
+  }
+  fd, tmp_path = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(path)), prefix='.fleet_status')
+  try:
+    with os.fdopen(fd, 'w') as tmp_file:
+      json.dump(status, tmp_file)
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+
+def read_fleet_status(path, max_age):
+  """Returns the fleet status written by write_fleet_status.
+
+  Returns None if the file is missing, unreadable or older than max_age
+  seconds, in which case callers should query the DB themselves.
+  """
+  try:
+    with open(path) as status_file:
+      status = json.load(status_file)
+  except (IOError, OSError, ValueError):
+    return None
+  if time.time() - status.get('generated_at', 0) > max_age:
+    return None
+  return status
+
+
+def scheduler_heartbeat_statement(job):
+  """Builds the query for the latest heartbeat of a running scheduler."""
+  return select([func.max(job.latest_heartbeat).label('latest_heartbeat')
+                ]).where(and_(job.job_type == 'SchedulerJob',
+                              job.state == 'running'))
+
+
+def latest_scheduler_heartbeat():
+  """Returns the latest running SchedulerJob heartbeat, or None."""
+  row = _execute(scheduler_heartbeat_statement(_job_columns()),
+                 'scheduler_heartbeat')[0]
+  return row['latest_heartbeat']
+
+
+def missing_checker_indexes(engine, table):
+  """Returns the sorted (name, columns) of CHECKER_INDEXES missing on table.
+
+  An index is considered present if one with the same name or the same
+  column list already exists.
+  """
+  existing = sqlalchemy.inspect(engine).get_indexes(table.name)
+  existing_names = set(index['name'] for index in existing)
+  existing_columns = set(tuple(index['column_names']) for index in existing)
+  return [(name, columns) for name, columns in sorted(CHECKER_INDEXES.items())
+          if name not in existing_names
+          and tuple(columns) not in existing_columns]
+
+
+def create_checker_indexes(engine, table):
+  """Creates the CHECKER_INDEXES missing on the task_instance table.
 
-  return {state: _check_query_size(query)
-          for state, query in iteritems(queries)}
+  Calling this again is a no-op. Returns the (name, columns) of the indexes
+  created.
+  """
+  created = missing_checker_indexes(engine, table)
+  for name, columns in created:
+    sqlalchemy.Index(
+        name, *[table.c[column] for column in columns],
+        mysql_length={'hostname': HOSTNAME_INDEX_PREFIX}).create(bind=engine)
+  return created
 
 
 def declare_error_state(task_counts, check_scheduled=False):
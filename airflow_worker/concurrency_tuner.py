@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tunes the Celery pool size of the local worker to its throughput.
+
+Runs next to the worker. Every interval it samples the number of tasks
+running on this host and the tasks it completed during the interval (from
+checker_lib.task_count_by_state), and the CPU and memory pressure of the
+container. The pool is then resized with additive increase / multiplicative
+decrease, within --min_concurrency and --max_concurrency:
+  - memory above its high-water mark: shrink by --decrease_factor. The size
+    that caused the pressure is not tried again for --ceiling_ttl seconds.
+  - the last increase lowered the completion rate: undo it.
+  - every pool slot busy and CPU below its high-water mark: grow by --step.
+A busy CPU only stops the growth: a saturated worker still completes tasks at
+its full rate, and shrinking it would give that throughput up.
+After a change the next one waits --cooldown seconds, so the completion rate
+is measured with the new pool size. The pool is resized through the Celery
+pool_grow and pool_shrink remote control commands.
+
+--simulate runs the control loop against a modelled worker instead, to try
+parameters offline.
+
+  Typical usage example:
+
+  python concurrency_tuner.py --max_concurrency 32 --dry_run
+  python concurrency_tuner.py --simulate --sim_task_cpu 0.2 --sim_steps 200
+"""
+
+import argparse
+from datetime import timedelta
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import time
+
+import instrumentation
+
+
+class ConcurrencyPolicy(object):
+  """Computes the pool size of a worker from throughput and pressure samples.
+
+  Attributes:
+    min_concurrency: Lower bound of the pool size.
+    max_concurrency: Upper bound of the pool size.
+    step: Slots added by an increase.
+    decrease_factor: Factor the pool size is multiplied with under memory
+      pressure.
+    cpu_high: CPU utilization, between 0 and 1, from which the pool stops
+      growing.
+    memory_high: Memory utilization, between 0 and 1, above which the pool
+      shrinks.
+    tolerance: Relative completion rate drop after an increase that is taken
+      as a sign the increase did not help.
+    cooldown: Seconds after a change before the next one.
+    ceiling_ttl: Seconds during which the pool does not grow back to the size
+      that last caused memory pressure.
+  """
+
+  def __init__(self, min_concurrency=1, max_concurrency=32, step=2,
+               decrease_factor=0.9, cpu_high=0.9, memory_high=0.85,
+               tolerance=0.1, cooldown=120, ceiling_ttl=1800):
+    self.min_concurrency = min_concurrency
+    self.max_concurrency = max_concurrency
+    self.step = step
+    self.decrease_factor = decrease_factor
+    self.cpu_high = cpu_high
+    self.memory_high = memory_high
+    self.tolerance = tolerance
+    self.cooldown = cooldown
+    self.ceiling_ttl = ceiling_ttl
+    self.last_change = None
+    self.rate_before_increase = None
+    # (pool size that caused pressure, time it did).
+    self.ceiling = None
+
+  def _bounded(self, concurrency):
+    return max(self.min_concurrency, min(self.max_concurrency, concurrency))
+
+  def desired_concurrency(self, sample, current, now):
+    """Returns the pool size to apply given the current one.
+
+    Args:
+      sample: Dict with the 'running' task count, the 'completion_rate' in
+        tasks per second and the 'cpu' and 'memory' utilization.
+      current: The current pool size.
+      now: Current time in seconds.
+    """
+    if self.last_change is not None and now - self.last_change < self.cooldown:
+      return current
+    rate = sample['completion_rate']
+    if self.ceiling is not None and now - self.ceiling[1] > self.ceiling_ttl:
+      self.ceiling = None
+    desired = current
+    if sample['memory'] > self.memory_high:
+      desired = int(current * self.decrease_factor)
+      self.ceiling = (current, now)
+      self.rate_before_increase = None
+    elif (self.rate_before_increase is not None
+          and rate < self.rate_before_increase * (1 - self.tolerance)):
+      desired = current - self.step
+      self.rate_before_increase = None
+    elif sample['running'] >= current and sample['cpu'] < self.cpu_high and (
+        self.ceiling is None or current + self.step < self.ceiling[0]):
+      desired = current + self.step
+      self.rate_before_increase = rate
+    else:
+      self.rate_before_increase = None
+    desired = self._bounded(desired)
+    if desired != current:
+      self.last_change = now
+    return desired
+
+
+class ResourceSampler(object):
+  """Reads the CPU and memory utilization of the container.
+
+  Uses the cgroup (v2, then v1) accounting files and falls back to the load
+  average and /proc/meminfo of the machine.
+  """
+
+  def __init__(self, cgroup_root='/sys/fs/cgroup'):
+    self.cgroup_root = cgroup_root
+    self._last_usage = None
+
+  def _read(self, *path):
+    try:
+      with open(os.path.join(self.cgroup_root, *path)) as cgroup_file:
+        return cgroup_file.read().strip()
+    except (IOError, OSError):
+      return None
+
+  def _cpu_limit(self):
+    cpu_max = self._read('cpu.max')
+    if cpu_max and not cpu_max.startswith('max'):
+      quota, period = cpu_max.split()
+      return float(quota) / float(period)
+    quota = self._read('cpu', 'cpu.cfs_quota_us')
+    period = self._read('cpu', 'cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+      return float(quota) / float(period)
+    return float(multiprocessing.cpu_count())
+
+  def _cpu_seconds(self):
+    stat = self._read('cpu.stat')
+    if stat:
+      for line in stat.splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'usage_usec':
+          return int(value) / 1e6
+    usage = self._read('cpuacct', 'cpuacct.usage')
+    if usage:
+      return int(usage) / 1e9
+    return None
+
+  def cpu(self):
+    """Returns the CPU utilization since the previous call, between 0 and 1."""
+    usage = self._cpu_seconds()
+    now = time.time()
+    if usage is None:
+      return min(1.0, os.getloadavg()[0] / multiprocessing.cpu_count())
+    last, self._last_usage = self._last_usage, (now, usage)
+    if last is None or now <= last[0]:
+      return 0.0
+    return min(1.0, (usage - last[1]) / (now - last[0]) / self._cpu_limit())
+
+  def memory(self):
+    """Returns the memory utilization, between 0 and 1."""
+    used = self._read('memory.current')
+    limit = self._read('memory.max')
+    if used is None:
+      used = self._read('memory', 'memory.usage_in_bytes')
+      limit = self._read('memory', 'memory.limit_in_bytes')
+    # A v1 limit close to 2^63 means no limit.
+    if used and limit and limit != 'max' and int(limit) < 2 ** 60:
+      return float(used) / float(limit)
+    meminfo = {}
+    with open('/proc/meminfo') as meminfo_file:
+      for line in meminfo_file:
+        key, _, value = line.partition(':')
+        meminfo[key] = int(value.split()[0])
+    return 1 - float(meminfo['MemAvailable']) / meminfo['MemTotal']
+
+
+class CeleryPool(object):
+  """Reads and resizes the pool of the Celery worker on this host."""
+
+  def __init__(self, hostname=None, control=None):
+    self.destination = ['celery@{}'.format(hostname or socket.gethostname())]
+    self._control = control
+
+  @property
+  def control(self):
+    if self._control is None:
+      from airflow.executors.celery_executor import app
+      self._control = app.control
+    return self._control
+
+  def concurrency(self):
+    """Returns the current pool size, or None if the worker did not reply.
+
+    This counts the pool processes: pool_grow and pool_shrink resize the pool
+    but leave its configured max-concurrency unchanged.
+    """
+    stats = self.control.inspect(self.destination).stats() or {}
+    for worker_stats in stats.values():
+      return len(worker_stats['pool']['processes'])
+    return None
+
+  def resize(self, current, desired):
+    if desired > current:
+      self.control.pool_grow(desired - current, destination=self.destination)
+    elif desired < current:
+      self.control.pool_shrink(current - desired, destination=self.destination)
+
+
+class SimulatedWorker(object):
+  """A worker model with a never-empty queue, for --simulate.
+
+  Each task needs `task_cpu` CPUs for `task_seconds` seconds when it has them;
+  tasks slow down proportionally once they need more than `cpus`. Each task
+  takes `task_memory` of the memory on top of `base_memory`; above 100% the
+  worker is OOM-killed and completes nothing in that interval.
+  """
+
+  def __init__(self, cpus=4, task_cpu=0.5, task_seconds=60, task_memory=0.04,
+               base_memory=0.2, noise=0.05, seed=0):
+    self.cpus = cpus
+    self.task_cpu = task_cpu
+    self.task_seconds = task_seconds
+    self.task_memory = task_memory
+    self.base_memory = base_memory
+    self.noise = noise
+    self._rng = random.Random(seed)
+
+  def sample(self, concurrency):
+    demand = concurrency * self.task_cpu
+    slowdown = max(1.0, demand / self.cpus)
+    memory = self.base_memory + concurrency * self.task_memory
+    rate = 0.0 if memory > 1 else concurrency / (self.task_seconds * slowdown)
+    rate *= 1 + self._rng.uniform(-self.noise, self.noise)
+    return {
+        'running': concurrency,
+        'completion_rate': rate,
+        'cpu': min(1.0, demand / self.cpus),
+        'memory': min(1.0, memory),
+    }
+
+
+def simulate(worker, policy, initial, steps, interval):
+  """Runs the policy against the worker model for `steps` intervals.
+
+  Returns the trajectory summary and the throughput a fixed pool of
+  `initial` slots would have had.
+  """
+  current = initial
+  completed = 0.0
+  sizes = []
+  for i in range(steps):
+    sample = worker.sample(current)
+    completed += sample['completion_rate'] * interval
+    sizes.append(current)
+    current = policy.desired_concurrency(sample, current, i * interval)
+  fixed = sum(worker.sample(initial)['completion_rate'] * interval
+              for _ in range(steps))
+  return {
+      'steps': steps,
+      'final_concurrency': current,
+      'mean_concurrency': round(sum(sizes) / float(len(sizes)), 2),
+      'changes': sum(1 for a, b in zip(sizes, sizes[1:]) if a != b),
+      'completed': round(completed, 1),
+      'completed_fixed': round(fixed, 1),
+  }
+
+
+def run(args, policy):
+  # import before use so the simulator runs without airflow.
+  import checker_lib
+
+  pool = CeleryPool()
+  resources = ResourceSampler()
+  resources.cpu()
+  window = timedelta(seconds=args.interval)
+  current = args.concurrency
+  instrumentation.flush_periodically()
+  while True:
+    time.sleep(args.interval)
+    started = time.time()
+    try:
+      current = pool.concurrency() or current
+      counts = checker_lib.task_count_by_state(True, window=window)
+      sample = {
+          'running': counts['running'],
+          'completion_rate': counts['recently_done'] / float(args.interval),
+          'cpu': resources.cpu(),
+          'memory': resources.memory(),
+      }
+      desired = policy.desired_concurrency(sample, current, started)
+      if desired != current:
+        logging.info('Resizing the pool from {} to {}. Sample: {}'.format(
+            current, desired, sample))
+        if not args.dry_run:
+          pool.resize(current, desired)
+        current = desired
+      elif args.dry_run:
+        print('Keeping {} slots. Sample: {}'.format(current, sample))
+    except Exception:
+      logging.exception('Concurrency tuner iteration failed.')
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--min_concurrency', type=int, default=1)
+  parser.add_argument('--max_concurrency', type=int, default=32)
+  parser.add_argument(
+      '--concurrency', type=int, default=16,
+      help='Pool size assumed when the worker does not report its own.')
+  parser.add_argument('--step', type=int, default=2,
+                      help='Slots added by an increase.')
+  parser.add_argument(
+      '--decrease_factor', type=float, default=0.9,
+      help='Factor the pool size is multiplied with under memory pressure.')
+  parser.add_argument(
+      '--cpu_high', type=float, default=0.9,
+      help='CPU utilization from which the pool stops growing.')
+  parser.add_argument('--memory_high', type=float, default=0.85)
+  parser.add_argument(
+      '--tolerance', type=float, default=0.1,
+      help='Relative completion rate drop that reverts an increase.')
+  parser.add_argument('--interval', type=float, default=60,
+                      help='Seconds between two samples.')
+  parser.add_argument('--cooldown', type=float, default=120,
+                      help='Seconds after a change before the next one.')
+  parser.add_argument(
+      '--ceiling_ttl', type=float, default=1800,
+      help='Seconds the pool size that caused pressure is not tried again.')
+  parser.add_argument(
+      '--dry_run', action='store_true',
+      help='Print the decisions instead of resizing the pool.')
+  parser.add_argument(
+      '--simulate', action='store_true',
+      help='Run the control loop against a modelled worker and print a '
+      'summary.')
+  parser.add_argument('--sim_steps', type=int, default=120)
+  parser.add_argument('--sim_cpus', type=float, default=4)
+  parser.add_argument('--sim_task_cpu', type=float, default=0.5,
+                      help='CPUs a modelled task uses when unconstrained.')
+  parser.add_argument('--sim_task_seconds', type=float, default=60)
+  parser.add_argument('--sim_task_memory', type=float, default=0.04,
+                      help='Share of the memory a modelled task takes.')
+  args = parser.parse_args()
+
+  policy = ConcurrencyPolicy(
+      min_concurrency=args.min_concurrency,
+      max_concurrency=args.max_concurrency,
+      step=args.step,
+      decrease_factor=args.decrease_factor,
+      cpu_high=args.cpu_high,
+      memory_high=args.memory_high,
+      tolerance=args.tolerance,
+      cooldown=args.cooldown,
+      ceiling_ttl=args.ceiling_ttl)
+  if args.simulate:
+    worker = SimulatedWorker(cpus=args.sim_cpus, task_cpu=args.sim_task_cpu,
+                             task_seconds=args.sim_task_seconds,
+                             task_memory=args.sim_task_memory)
+    print(json.dumps(simulate(worker, policy, args.concurrency,
+                              args.sim_steps, args.interval), sort_keys=True))
+    return
+  run(args, policy)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
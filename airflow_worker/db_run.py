@@ -18,13 +18,86 @@
 # Wrapper to run program with injected AIRFLOW connection env or use
 # original env as is if no SQL_SUBNET is provided and AIRFLOW connection
 # env already exists.
+#
+# If SQL_RESOLVER_FILE is set, the connection published by sql_resolver.py is
+# used as long as it is fresh; the subnet is only scanned here as a fallback.
+#
+# The resolution time, its source and the scan retries are recorded with the
+# instrumentation module when INSTRUMENTATION_OUTPUT is set.
+#
+# With DB_RUN_SUPERVISE=TRUE the program stays the parent of the command: it
+# forwards signals to it and checks every DB_RUN_HEALTH_INTERVAL seconds that
+# the DB endpoint accepts connections. After DB_RUN_FAILURE_THRESHOLD failed
+# checks in a row the connection is resolved again and, if it changed, the
+# command is stopped (SIGTERM, then SIGKILL after DB_RUN_STOP_TIMEOUT seconds)
+# and restarted with the new connection, without waiting for a pod restart.
 
+import logging
+import signal
+import socket
 import time
 import subprocess, os
 import sys
 
+import instrumentation
+import sql_resolver
+
 RETRY_COUNT = 3
 AIRFLOW_CONNECTION_ENV_KEY = "AIRFLOW__CORE__SQL_ALCHEMY_CONN"
+SCAN_CONCURRENCY_ENV_KEY = "SQL_SCAN_CONCURRENCY"
+ADDRESS_CACHE_ENV_KEY = "SQL_ADDRESS_CACHE"
+SUPERVISE_ENV_KEY = "DB_RUN_SUPERVISE"
+HEALTH_INTERVAL_ENV_KEY = "DB_RUN_HEALTH_INTERVAL"
+FAILURE_THRESHOLD_ENV_KEY = "DB_RUN_FAILURE_THRESHOLD"
+STOP_TIMEOUT_ENV_KEY = "DB_RUN_STOP_TIMEOUT"
+DEFAULT_HEALTH_INTERVAL = 5
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_STOP_TIMEOUT = 60
+HEALTH_CHECK_TIMEOUT = 2
+DEFAULT_SQL_PORT = 3306
+FORWARDED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                     signal.SIGQUIT, signal.SIGUSR1, signal.SIGUSR2)
+
+def _read_resolver_file():
+  """Returns the connection published by sql_resolver.py, if fresh."""
+  resolver_file = os.getenv(sql_resolver.RESOLVER_FILE_ENV_KEY)
+  if not resolver_file:
+    return None
+  con = sql_resolver.read_resolved_connection(
+      resolver_file,
+      float(os.getenv(sql_resolver.RESOLVER_MAX_AGE_ENV_KEY,
+                      sql_resolver.DEFAULT_MAX_AGE)))
+  if con is None:
+    print("SQL resolver file {} is missing or stale.".format(resolver_file))
+  return con
+
+def _make_conn_utils(db_env):
+  with instrumentation.timer("import", module="sync_sql_ip"):
+    import sync_sql_ip
+  return sync_sql_ip.SqlConnectionUtils(
+      sync_sql_ip.SqlCredentials(
+          sql_database=db_env["SQL_DATABASE"],
+          sql_user=db_env["SQL_USER"],
+          sql_password=db_env["SQL_PASSWORD"]),
+      concurrency=int(db_env.get(SCAN_CONCURRENCY_ENV_KEY, 1)),
+      cache_path=db_env.get(ADDRESS_CACHE_ENV_KEY))
+
+def _resolve_again(db_env, sql_net, failing_con):
+  """Resolves the connection once more after failing_con stopped working.
+
+  The resolver file is skipped if it still holds the failing connection.
+  Returns None if no working connection was found.
+  """
+  start_t = time.time()
+  source = "resolver"
+  con = _read_resolver_file()
+  if con is None or con == failing_con:
+    source = "scan"
+    con = _make_conn_utils(db_env).find_working_connection(sql_net)
+  if con is not None:
+    instrumentation.record(
+        "db_failover_resolve", time.time() - start_t, source=source)
+  return con
 
 def _generate_env():
   sql_net = os.getenv("SQL_SUBNET")
@@ -37,33 +110,164 @@ def _generate_env():
     else:
       return db_env
 
-  import sync_sql_ip
-
   start_t = time.time()
 
-  con = None
+  con = _read_resolver_file()
+  if con is not None:
+    delta_t = time.time() - start_t
+    instrumentation.record("db_resolve", delta_t, source="resolver")
+    print("Got DB connection from resolver after {:.3f} seconds".format(
+        delta_t))
+    db_env[AIRFLOW_CONNECTION_ENV_KEY] = con
+    return db_env
+
   i = 0
   while con is None and i < RETRY_COUNT:
-    sql_conn_utils = sync_sql_ip.SqlConnectionUtils(
-        sync_sql_ip.SqlCredentials(
-            sql_database=db_env["SQL_DATABASE"],
-            sql_user=db_env["SQL_USER"],
-            sql_password=db_env["SQL_PASSWORD"]))
-    con = sql_conn_utils.find_working_connection(sql_net)
+    con = _make_conn_utils(db_env).find_working_connection(sql_net)
+    source = "scan"
     if con is None:
+      instrumentation.count("db_resolve_retries")
       time.sleep(90)
       i += 1
+      # The resolver may have come up while this process was scanning.
+      con = _read_resolver_file()
+      source = "resolver"
 
   if con is None:
     raise Exception("Can not connect to airflow database.")
 
   delta_t = time.time() - start_t
+  instrumentation.record("db_resolve", delta_t, source=source)
   print("Connect to DB after {:.3f} seconds".format(delta_t))
 
   db_env[AIRFLOW_CONNECTION_ENV_KEY] = con
   return db_env
 
+class ChildSupervisor(object):
+  """Runs the command and restarts it when the DB endpoint moves.
+
+  Attributes:
+    command: The command to run, as a list of arguments.
+    db_env: The environment of the command, holding the connection string.
+    resolve: Callable taking the failing connection string and returning a
+      working one, or None.
+    health_interval: Seconds between two health checks.
+    failure_threshold: Failed health checks in a row that trigger a new
+      resolution.
+    stop_timeout: Seconds the command gets to exit after SIGTERM.
+  """
+
+  def __init__(self, command, db_env, resolve,
+               health_interval=DEFAULT_HEALTH_INTERVAL,
+               failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+               stop_timeout=DEFAULT_STOP_TIMEOUT):
+    self.command = command
+    self.db_env = db_env
+    self.resolve = resolve
+    self.health_interval = health_interval
+    self.failure_threshold = failure_threshold
+    self.stop_timeout = stop_timeout
+    self.child = None
+    self._stopping = False
+
+  @property
+  def con(self):
+    return self.db_env[AIRFLOW_CONNECTION_ENV_KEY]
+
+  def healthy(self):
+    """Returns True iff the DB endpoint accepts a TCP connection."""
+    from sqlalchemy.engine.url import make_url
+    url = make_url(self.con)
+    try:
+      with instrumentation.timer("db_health_check"):
+        sock = socket.create_connection(
+            (url.host, url.port or DEFAULT_SQL_PORT), HEALTH_CHECK_TIMEOUT)
+    except (socket.error, socket.timeout):
+      return False
+    sock.close()
+    return True
+
+  def start(self):
+    self.child = subprocess.Popen(self.command, env=self.db_env, shell=False)
+
+  def stop_child(self):
+    """Asks the command to exit and kills it after stop_timeout seconds."""
+    self.child.send_signal(signal.SIGTERM)
+    end_t = time.time() + self.stop_timeout
+    while self.child.poll() is None and time.time() < end_t:
+      time.sleep(0.5)
+    if self.child.poll() is None:
+      logging.warning("Command did not exit within {}s, killing it.".format(
+          self.stop_timeout))
+      self.child.kill()
+      self.child.wait()
+
+  def _forward(self, signum, unused_frame):
+    if signum in (signal.SIGTERM, signal.SIGINT):
+      self._stopping = True
+    if self.child is not None and self.child.poll() is None:
+      self.child.send_signal(signum)
+
+  def _failover(self):
+    """Resolves the connection again and restarts the command if it moved."""
+    con = self.resolve(self.con)
+    if con is None:
+      logging.error("Could not find a working DB connection.")
+      return
+    if con == self.con:
+      logging.info("DB endpoint is reachable again.")
+      return
+    logging.warning("DB endpoint moved, restarting the command.")
+    instrumentation.count("db_failovers")
+    self.db_env = dict(self.db_env)
+    self.db_env[AIRFLOW_CONNECTION_ENV_KEY] = con
+    self.stop_child()
+    if not self._stopping:
+      self.start()
+
+  def run(self):
+    """Runs the command until it exits on its own. Returns its exit code."""
+    for signum in FORWARDED_SIGNALS:
+      signal.signal(signum, self._forward)
+    self.start()
+    failures = 0
+    while True:
+      end_t = time.time() + self.health_interval
+      while self.child.poll() is None and time.time() < end_t:
+        time.sleep(min(0.5, max(0, end_t - time.time())))
+      returncode = self.child.poll()
+      if returncode is not None:
+        # A negative code means the command was killed by that signal.
+        return returncode if returncode >= 0 else 128 - returncode
+      if self._stopping:
+        continue
+      if self.healthy():
+        failures = 0
+        continue
+      failures += 1
+      instrumentation.count("db_health_check_failures")
+      logging.warning("DB health check failed {} time(s) in a row.".format(
+          failures))
+      if failures >= self.failure_threshold:
+        failures = 0
+        self._failover()
+
 if __name__ == "__main__":
   db_env = _generate_env()
+  sql_net = os.getenv("SQL_SUBNET")
+  if len(sys.argv) > 1 and sql_net and (
+      os.getenv(SUPERVISE_ENV_KEY, "FALSE").upper() == "TRUE"):
+    logging.basicConfig(level=logging.INFO)
+    instrumentation.flush_periodically()
+    supervisor = ChildSupervisor(
+        sys.argv[1:], db_env,
+        lambda con: _resolve_again(db_env, sql_net, con),
+        health_interval=float(os.getenv(HEALTH_INTERVAL_ENV_KEY,
+                                        DEFAULT_HEALTH_INTERVAL)),
+        failure_threshold=int(os.getenv(FAILURE_THRESHOLD_ENV_KEY,
+                                        DEFAULT_FAILURE_THRESHOLD)),
+        stop_timeout=float(os.getenv(STOP_TIMEOUT_ENV_KEY,
+                                     DEFAULT_STOP_TIMEOUT)))
+    sys.exit(supervisor.run())
   if len(sys.argv) > 1:
     subprocess.check_call(sys.argv[1:], env=db_env, shell=False)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Computes worker liveness for the whole fleet in one pass.
+
+Runs the task count queries once for all workers (one GROUP BY hostname
+query) and publishes the per-host counts and verdicts to a shared file.
+Worker probes started with --fleet_file read their verdict from that file
+instead of querying the DB, so the probe load stays flat as workers are
+added.
+
+  Typical usage example:
+
+  python fleet_checker.py --output /home/airflow/gcs/data/fleet_status.json
+"""
+
+import argparse
+import logging
+import time
+
+import checker_lib
+import instrumentation
+
+
+def publish(output):
+  fleet_counts = checker_lib.fleet_task_counts()
+  checker_lib.write_fleet_status(output, fleet_counts)
+  for hostname in sorted(fleet_counts['hosts']):
+    counts = checker_lib.host_task_counts(fleet_counts, hostname)
+    if checker_lib.declare_error_state(counts):
+      logging.warning('Worker {} seems to be dead. Task counts details:{}'
+                      .format(hostname, counts))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-o', '--output', required=True,
+      help='File the fleet status is written to.')
+  parser.add_argument(
+      '-i', '--interval', type=float, default=10,
+      help='Seconds between two refreshes.')
+  parser.add_argument(
+      '--once', action='store_true', help='Publish once and exit.')
+  args = parser.parse_args()
+
+  if not args.once:
+    instrumentation.flush_periodically()
+  while True:
+    started = time.time()
+    try:
+      publish(args.output)
+    except Exception:
+      if args.once:
+        raise
+      logging.exception('Failed to publish fleet status.')
+    if args.once:
+      return
+    time.sleep(max(0, args.interval - (time.time() - started)))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
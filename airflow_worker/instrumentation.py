@@ -0,0 +1,259 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Lightweight timers and counters for the probes and the DB discovery.
+
+Disabled unless INSTRUMENTATION_OUTPUT is set, in which case every call is a
+dictionary update under a lock and flush() writes the collected values:
+  - json: one JSON line on stderr.
+  - openmetrics: an OpenMetrics textfile named after the component in
+    INSTRUMENTATION_TEXTFILE_DIR, e.g. for the node exporter textfile
+    collector. The file is replaced atomically.
+When disabled, timer() returns a shared no-op context manager and count()
+and record() return at once.
+
+flush() runs at exit. Long-running processes also call flush_periodically(),
+which flushes every INSTRUMENTATION_FLUSH_INTERVAL seconds (60 by default)
+from a daemon thread.
+
+  Typical usage example:
+
+  with instrumentation.timer('checker_query', query='task_count_by_state'):
+    rows = execute(statement)
+  instrumentation.count('sql_probe', address=address, outcome='port_closed')
+  instrumentation.flush()
+"""
+
+import atexit
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+OUTPUT_ENV_KEY = 'INSTRUMENTATION_OUTPUT'
+TEXTFILE_DIR_ENV_KEY = 'INSTRUMENTATION_TEXTFILE_DIR'
+FLUSH_INTERVAL_ENV_KEY = 'INSTRUMENTATION_FLUSH_INTERVAL'
+JSON_OUTPUT = 'json'
+OPENMETRICS_OUTPUT = 'openmetrics'
+DEFAULT_TEXTFILE_DIR = '/var/tmp/metrics'
+DEFAULT_FLUSH_INTERVAL = 60
+METRIC_PREFIX = 'airflow_worker_'
+
+_output = os.getenv(OUTPUT_ENV_KEY) or None
+_textfile_dir = os.getenv(TEXTFILE_DIR_ENV_KEY, DEFAULT_TEXTFILE_DIR)
+_component = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+_lock = threading.Lock()
+# {(name, sorted label items): [count, sum, max]}
+_timers = {}
+# {(name, sorted label items): value}
+_counters = {}
+_flusher = None
+
+
+def configure(output=None, textfile_dir=None, component=None):
+  """Overrides the settings read from the environment."""
+  global _output, _textfile_dir, _component
+  _output = output
+  if textfile_dir is not None:
+    _textfile_dir = textfile_dir
+  if component is not None:
+    _component = component
+
+
+def enabled():
+  return _output is not None
+
+
+class _NoopTimer(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class _Timer(object):
+
+  def __init__(self, key):
+    self._key = key
+    self._start = None
+
+  def __enter__(self):
+    self._start = time.time()
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    _observe(self._key, time.time() - self._start)
+    return False
+
+
+def _key(name, labels):
+  return name, tuple(sorted(labels.items()))
+
+
+def timer(name, **labels):
+  """Returns a context manager recording the duration of its block."""
+  if _output is None:
+    return _NOOP_TIMER
+  return _Timer(_key(name, labels))
+
+
+def record(name, seconds, **labels):
+  """Records a duration measured by the caller."""
+  if _output is None:
+    return
+  _observe(_key(name, labels), seconds)
+
+
+def _observe(key, seconds):
+  with _lock:
+    summary = _timers.setdefault(key, [0, 0.0, 0.0])
+    summary[0] += 1
+    summary[1] += seconds
+    summary[2] = max(summary[2], seconds)
+
+
+def count(name, value=1, **labels):
+  """Adds value to the counter of name and labels."""
+  if _output is None:
+    return
+  key = _key(name, labels)
+  with _lock:
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def _escape(value):
+  return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+          .replace('\n', '\\n'))
+
+
+def _series(name, labels):
+  labels = (('component', _component),) + labels
+  return '{}{}{{{}}}'.format(METRIC_PREFIX, name, ','.join(
+      '{}="{}"'.format(label, _escape(value)) for label, value in labels))
+
+
+def openmetrics_text():
+  """Returns the collected values in the OpenMetrics text format."""
+  lines = []
+  with _lock:
+    timers = sorted(_timers.items())
+    counters = sorted(_counters.items())
+  for family, entries in _by_family(timers):
+    lines.append('# TYPE {}{}_seconds summary'.format(METRIC_PREFIX, family))
+    for (name, labels), (runs, total, _) in entries:
+      lines.append('{} {}'.format(_series(name + '_seconds_count', labels),
+                                  runs))
+      lines.append('{} {:.6f}'.format(_series(name + '_seconds_sum', labels),
+                                      total))
+  for family, entries in _by_family(counters):
+    lines.append('# TYPE {}{} counter'.format(METRIC_PREFIX, family))
+    for (name, labels), value in entries:
+      lines.append('{} {}'.format(_series(name + '_total', labels), value))
+  lines.append('# EOF')
+  return '\n'.join(lines) + '\n'
+
+
+def _by_family(items):
+  families = []
+  for key, value in items:
+    if not families or families[-1][0] != key[0]:
+      families.append((key[0], []))
+    families[-1][1].append((key, value))
+  return families
+
+
+def json_record():
+  """Returns the collected values as one JSON-serializable dict."""
+
+  def series(key):
+    name, labels = key
+    if not labels:
+      return name
+    return '{}{{{}}}'.format(
+        name, ','.join('{}={}'.format(label, value) for label, value in labels))
+
+  with _lock:
+    return {
+        'component': _component,
+        'time': time.time(),
+        'timers': dict((series(key), {'count': runs,
+                                      'sum': round(total, 6),
+                                      'max': round(longest, 6)})
+                       for key, (runs, total, longest) in _timers.items()),
+        'counters': dict((series(key), value)
+                         for key, value in _counters.items()),
+    }
+
+
+def flush():
+  """Writes the collected values to the configured output.
+
+  Called at exit; call it explicitly before os._exit.
+  """
+  if _output is None:
+    return
+  if _output == JSON_OUTPUT:
+    sys.stderr.write(json.dumps(json_record(), sort_keys=True) + '\n')
+    sys.stderr.flush()
+  elif _output == OPENMETRICS_OUTPUT:
+    if not os.path.isdir(_textfile_dir):
+      os.makedirs(_textfile_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=_textfile_dir, prefix='.' + _component)
+    try:
+      with os.fdopen(fd, 'w') as tmp_file:
+        tmp_file.write(openmetrics_text())
+      os.chmod(tmp_path, 0o644)
+      os.rename(tmp_path, os.path.join(_textfile_dir, _component + '.prom'))
+    finally:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+def _flush_and_report():
+  """Flushes, reporting instead of raising when the output is unwritable."""
+  try:
+    flush()
+  except (IOError, OSError) as e:
+    sys.stderr.write('Could not flush instrumentation: {}\n'.format(e))
+
+
+def flush_periodically(interval=None):
+  """Flushes every interval seconds from a daemon thread.
+
+  interval defaults to $INSTRUMENTATION_FLUSH_INTERVAL. Does nothing when
+  instrumentation is disabled or the thread is already running.
+  """
+  global _flusher
+  if _output is None or _flusher is not None:
+    return
+  if interval is None:
+    interval = float(os.getenv(FLUSH_INTERVAL_ENV_KEY, DEFAULT_FLUSH_INTERVAL))
+
+  def loop():
+    while True:
+      time.sleep(interval)
+      _flush_and_report()
+
+  _flusher = threading.Thread(target=loop, name='instrumentation_flush')
+  _flusher.daemon = True
+  _flusher.start()
+
+
+atexit.register(_flush_and_report)
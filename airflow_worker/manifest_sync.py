@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Incremental, manifest-based sync of a bucket prefix to a local directory.
+
+Replaces `gsutil -m rsync -d -r` for the dags and plugins folders. A manifest
+file next to the local tree records the version (GCS generation, or size and
+mtime for local sources) of every object that was synced. Each run lists the
+source once, and only downloads objects whose version differs from the
+manifest, in parallel, writing each one to a temporary file and renaming it
+into place. Objects gone from the source are deleted locally, together with
+their bytecode. The local tree is only listed on the first run (no manifest
+yet), to delete the files the source does not have, as `rsync -d` would;
+later runs only check synced files for existence. Object names that would
+resolve outside the local directory are rejected.
+
+  Typical usage example:
+
+  python manifest_sync.py gs://$GCS_BUCKET/dags /home/airflow/gcs/dags
+  python manifest_sync.py /tmp/source_dags /tmp/local_dags
+
+With --compile the .py files downloaded in the run are byte-compiled
+afterwards (see pyc_warmup.py), so workers start from warm bytecode.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from six.moves import queue
+
+MANIFEST_NAME = '.sync_manifest.json'
+DEFAULT_WORKERS = 16
+BYTECODE_DIR = '__pycache__'
+BYTECODE_SUFFIXES = ('.pyc', '.pyo')
+
+
+def is_safe_path(path):
+  """Returns whether the object name stays inside the local directory."""
+  return (bool(path) and not path.startswith('/') and path != MANIFEST_NAME
+          and '..' not in path.split('/'))
+
+
+def _is_bytecode_of(filename, module):
+  """Returns whether filename in __pycache__ holds the bytecode of module.
+
+  Matches e.g. module.cpython-37.pyc and module.cpython-37.opt-1.pyc.
+  """
+  if not filename.startswith(module + '.'):
+    return False
+  parts = filename[len(module) + 1:].split('.')
+  return (filename.endswith(BYTECODE_SUFFIXES) and 2 <= len(parts) <= 3
+          and (len(parts) == 2 or parts[1].startswith('opt-')))
+
+
+class Storage(object):
+  """Source of objects to sync, keyed by '/'-separated relative path."""
+
+  def list_versions(self):
+    """Returns {relative path: version string} for every object."""
+    raise NotImplementedError()
+
+  def download(self, path, destination):
+    """Writes the object at `path` to the local file `destination`."""
+    raise NotImplementedError()
+
+
+class LocalDirStorage(Storage):
+  """Storage backed by a local directory, e.g. for tests."""
+
+  def __init__(self, root):
+    self.root = root
+
+  def list_versions(self):
+    versions = {}
+    for dirpath, _, filenames in os.walk(self.root):
+      for filename in filenames:
+        full_path = os.path.join(dirpath, filename)
+        stat = os.stat(full_path)
+        path = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+        versions[path] = '{}:{}'.format(stat.st_size, stat.st_mtime)
+    return versions
+
+  def download(self, path, destination):
+    shutil.copyfile(os.path.join(self.root, *path.split('/')), destination)
+
+
+class GcsStorage(Storage):
+  """Storage backed by a GCS bucket prefix; versions are generations."""
+
+  def __init__(self, url):
+    bucket_name, _, prefix = url[len('gs://'):].partition('/')
+    self.prefix = prefix.rstrip('/') + '/' if prefix else ''
+    self._bucket_name = bucket_name
+    self._local = threading.local()
+
+  @property
+  def bucket(self):
+    # google-cloud-storage clients are not thread-safe; keep one per thread.
+    if not hasattr(self._local, 'bucket'):
+      from google.cloud import storage
+      self._local.bucket = storage.Client().bucket(self._bucket_name)
+    return self._local.bucket
+
+  def list_versions(self):
+    versions = {}
+    for blob in self.bucket.list_blobs(prefix=self.prefix):
+      path = blob.name[len(self.prefix):]
+      # Skip the placeholder objects some tools create for folders.
+      if path and not path.endswith('/'):
+        versions[path] = str(blob.generation)
+    return versions
+
+  def download(self, path, destination):
+    self.bucket.blob(self.prefix + path).download_to_filename(destination)
+
+
+def make_storage(source):
+  if source.startswith('gs://'):
+    return GcsStorage(source)
+  return LocalDirStorage(source)
+
+
+class SyncResult(object):
+  """Outcome of one sync run.
+
+  Attributes:
+    changed: Relative paths downloaded in this run.
+    deleted: Relative paths removed in this run.
+    failed: {relative path: error message} of downloads that failed.
+    duration: Seconds the run took.
+  """
+
+  def __init__(self):
+    self.changed = []
+    self.deleted = []
+    self.failed = {}
+    self.duration = 0.0
+
+  def summary(self):
+    return {'changed': len(self.changed), 'deleted': len(self.deleted),
+            'failed': len(self.failed), 'duration': round(self.duration, 3)}
+
+
+class ManifestSync(object):
+  """Syncs a Storage into a local directory using a version manifest.
+
+  Attributes:
+    storage: The Storage to sync from.
+    local_dir: The directory to sync into.
+    workers: Number of parallel downloads.
+  """
+
+  def __init__(self, storage, local_dir, workers=DEFAULT_WORKERS):
+    self.storage = storage
+    self.local_dir = local_dir
+    self.workers = workers
+    self.manifest_path = os.path.join(local_dir, MANIFEST_NAME)
+
+  def read_manifest(self):
+    """Returns {relative path: version}, or None if there is no manifest."""
+    try:
+      with open(self.manifest_path) as manifest_file:
+        return json.load(manifest_file)
+    except (IOError, OSError, ValueError):
+      return None
+
+  def _write_manifest(self, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=self.local_dir, prefix='.manifest')
+    with os.fdopen(fd, 'w') as tmp_file:
+      json.dump(manifest, tmp_file, sort_keys=True)
+    os.rename(tmp_path, self.manifest_path)
+
+  def local_path(self, path):
+    if not is_safe_path(path):
+      raise ValueError('Unsafe object name {!r}.'.format(path))
+    return os.path.join(self.local_dir, *path.split('/'))
+
+  def _fetch(self, path):
+    destination = self.local_path(path)
+    directory = os.path.dirname(destination)
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        if not os.path.isdir(directory):
+          raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.sync')
+    os.close(fd)
+    try:
+      self.storage.download(path, tmp_path)
+      os.chmod(tmp_path, 0o644)
+      os.rename(tmp_path, destination)
+    except:
+      os.remove(tmp_path)
+      raise
+
+  def _fetch_all(self, paths, result):
+    """Downloads paths with a pool of threads; records failures."""
+    pending = queue.Queue()
+    for path in paths:
+      pending.put(path)
+    lock = threading.Lock()
+
+    def worker():
+      while True:
+        try:
+          path = pending.get_nowait()
+        except queue.Empty:
+          return
+        try:
+          self._fetch(path)
+          with lock:
+            result.changed.append(path)
+        except Exception as e:
+          logging.exception('Failed to sync {}.'.format(path))
+          with lock:
+            result.failed[path] = str(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(self.workers, len(paths)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  def _bytecode_paths(self, local_file):
+    """Returns the existing compiled files of a local .py file."""
+    if not local_file.endswith('.py'):
+      return []
+    directory, filename = os.path.split(local_file)
+    module = filename[:-len('.py')]
+    cache_dir = os.path.join(directory, BYTECODE_DIR)
+    try:
+      cached = os.listdir(cache_dir)
+    except OSError:
+      cached = []
+    paths = [os.path.join(cache_dir, name) for name in cached
+             if _is_bytecode_of(name, module)]
+    # Python 2 keeps the bytecode next to the source.
+    paths.extend(os.path.join(directory, module + suffix)
+                 for suffix in BYTECODE_SUFFIXES
+                 if os.path.exists(os.path.join(directory, module + suffix)))
+    return paths
+
+  def _delete(self, path):
+    local_file = self.local_path(path)
+    for stale_path in [local_file] + self._bytecode_paths(local_file):
+      try:
+        os.remove(stale_path)
+      except OSError:
+        pass
+    self._prune(os.path.join(os.path.dirname(local_file), BYTECODE_DIR))
+
+  def _prune(self, directory):
+    """Removes directory and its parents while empty, up to the sync root."""
+    while os.path.abspath(directory) != os.path.abspath(self.local_dir):
+      if os.path.isdir(directory):
+        try:
+          os.rmdir(directory)
+        except OSError:
+          break
+      directory = os.path.dirname(directory)
+
+  def _untracked(self, versions):
+    """Lists the local files the source does not have.
+
+    Returns (relative paths of files, local paths of bytecode whose source
+    is gone). Bytecode of sources that stay is kept.
+    """
+    paths = []
+    orphans = []
+    for dirpath, _, filenames in os.walk(self.local_dir):
+      if os.path.basename(dirpath) == BYTECODE_DIR:
+        parent = os.path.dirname(dirpath)
+        modules = [name[:-len('.py')] for name in os.listdir(parent)
+                   if name.endswith('.py')]
+        orphans.extend(os.path.join(dirpath, name) for name in filenames
+                       if not any(_is_bytecode_of(name, module)
+                                  for module in modules))
+        continue
+      for filename in filenames:
+        full_path = os.path.join(dirpath, filename)
+        path = os.path.relpath(full_path, self.local_dir).replace(os.sep, '/')
+        if path == MANIFEST_NAME or path in versions:
+          continue
+        if filename.endswith(BYTECODE_SUFFIXES) and os.path.exists(
+            full_path[:-1]):
+          continue
+        paths.append(path)
+    return sorted(paths), sorted(orphans)
+
+  def sync(self):
+    """Runs one incremental sync and returns its SyncResult."""
+    start_t = time.time()
+    result = SyncResult()
+    if not os.path.isdir(self.local_dir):
+      os.makedirs(self.local_dir)
+    manifest = self.read_manifest()
+    versions = self.storage.list_versions()
+    for path in sorted(versions):
+      if not is_safe_path(path):
+        logging.error('Skipping object with unsafe name {!r}.'.format(path))
+        result.failed[path] = 'Unsafe object name.'
+        del versions[path]
+
+    changed = sorted(path for path, version in versions.items()
+                     if (manifest or {}).get(path) != version
+                     or not os.path.exists(self.local_path(path)))
+    self._fetch_all(changed, result)
+    if manifest is None:
+      # First run: the local tree may hold files synced by other means.
+      stale, orphans = self._untracked(versions)
+      for orphan in orphans:
+        os.remove(orphan)
+        self._prune(os.path.dirname(orphan))
+    else:
+      stale = sorted(set(manifest) - set(versions))
+    for path in stale:
+      self._delete(path)
+      result.deleted.append(path)
+
+    new_manifest = dict(versions)
+    for path in result.failed:
+      # Retry failed downloads on the next run.
+      if manifest and path in manifest and path in versions:
+        new_manifest[path] = None
+      else:
+        new_manifest.pop(path, None)
+    self._write_manifest(new_manifest)
+    result.changed.sort()
+    result.duration = time.time() - start_t
+    return result
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('source', help='gs://bucket/prefix or a local directory.')
+  parser.add_argument('local_dir', help='Directory to sync into.')
+  parser.add_argument(
+      '--workers', type=int, default=DEFAULT_WORKERS,
+      help='Number of parallel downloads.')
+  parser.add_argument(
+      '--compile', action='store_true',
+      help='Byte-compile the .py files changed by this run.')
+  args = parser.parse_args()
+
+  sync = ManifestSync(make_storage(args.source), args.local_dir, args.workers)
+  result = sync.sync()
+  summary = dict(result.summary(), source=args.source)
+  if args.compile:
+    import pyc_warmup
+    summary['bytecode'] = pyc_warmup.compile_sources(
+        [sync.local_path(path) for path in result.changed])
+  print(json.dumps(summary, sort_keys=True))
+  if result.failed:
+    exit(1)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Exports Airflow task queue metrics in Prometheus text format.
+
+Serves the scheduled, queued and running task counts from the metadata DB,
+refreshed every few seconds, plus the derived queue length (queued +
+scheduled). Unlike the Stackdriver task_queue_length metric these values are
+seconds old, which lets the worker HPA react to bursts quickly.
+
+  Typical usage example:
+
+  CHECKER_BACKEND=core python metrics_exporter.py --port 9102 --interval 5
+
+  curl localhost:9102/metrics
+"""
+
+import argparse
+import logging
+
+from six.moves import BaseHTTPServer
+
+import checker_daemon
+import instrumentation
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+GAUGES = (
+    ('airflow_tasks_scheduled', 'Task instances in scheduled state.',
+     lambda counts: counts['scheduled']),
+    ('airflow_tasks_queued', 'Task instances in queued state.',
+     lambda counts: counts['queued']),
+    ('airflow_tasks_running', 'Task instances in running state.',
+     lambda counts: counts['running']),
+    ('airflow_tasks_recently_done',
+     'Task instances finished in the last 10 minutes.',
+     lambda counts: counts['recently_done']),
+    ('airflow_task_queue_length',
+     'Task instances waiting for a worker (queued + scheduled).',
+     lambda counts: counts['queued'] + counts['scheduled']),
+)
+
+
+def render(counts, age):
+  """Renders the counts and their age in Prometheus text format."""
+  lines = []
+  if counts is not None:
+    for name, help_text, value in GAUGES:
+      lines.append('# HELP {} {}'.format(name, help_text))
+      lines.append('# TYPE {} gauge'.format(name))
+      lines.append('{} {}'.format(name, value(counts)))
+  lines.append('# HELP airflow_task_counts_age_seconds '
+               'Seconds since the task counts were last refreshed.')
+  lines.append('# TYPE airflow_task_counts_age_seconds gauge')
+  lines.append('airflow_task_counts_age_seconds {:.3f}'.format(age))
+  return '\n'.join(lines) + '\n'
+
+
+def make_handler(refresher):
+  """Builds the HTTP handler class bound to a refresher."""
+
+  class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      if self.path.split('?')[0] != '/metrics':
+        self.send_error(404)
+        return
+      counts, age, _ = refresher.snapshot()
+      body = render(counts, age).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', CONTENT_TYPE)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass
+
+  return MetricsHandler
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-p', '--port', type=int, default=9102, help='Port to serve metrics on.')
+  parser.add_argument(
+      '-i', '--interval', type=float, default=5,
+      help='Seconds between two task count refreshes.')
+  parser.add_argument(
+      '--incremental', action='store_true',
+      help='Count recently finished tasks incrementally between refreshes.')
+  args = parser.parse_args()
+
+  refresher = checker_daemon.CountsRefresher(
+      False, args.interval, args.incremental)
+  refresher.start()
+  instrumentation.flush_periodically()
+  server = BaseHTTPServer.HTTPServer(('', args.port), make_handler(refresher))
+  logging.info('Serving task queue metrics on port {}.'.format(args.port))
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Byte-compiles synced DAG and plugin files ahead of the workers.
+
+Compiles the given .py files, or every .py file under the given directories
+whose bytecode is missing or older than the source, with a process pool. Each
+.pyc is written to a temporary file and renamed into place, so a worker never
+imports a half-written file. Compile errors (usually broken DAG files) are
+reported in the summary and do not fail the run.
+
+The bytecode is only reused by workers running the same Python version as
+this script, so run it with the workers' interpreter.
+
+  Typical usage example:
+
+  python pyc_warmup.py /home/airflow/gcs/dags /home/airflow/gcs/plugins
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import py_compile
+import struct
+import sys
+import time
+
+DEFAULT_PROCESSES = multiprocessing.cpu_count()
+
+
+def cache_path(source):
+  """Returns where the interpreter looks for the bytecode of source."""
+  try:
+    from importlib.util import cache_from_source
+  except ImportError:
+    # Python 2 keeps the bytecode next to the source.
+    return source + 'c'
+  return cache_from_source(source)
+
+
+def _magic_number():
+  try:
+    from importlib.util import MAGIC_NUMBER
+    return MAGIC_NUMBER
+  except ImportError:
+    import imp
+    return imp.get_magic()
+
+
+def is_stale(source):
+  """Returns whether the bytecode of source is missing or out of date.
+
+  The source mtime recorded in the .pyc header is compared instead of file
+  mtimes, as a sync may give an updated source an older mtime than its .pyc.
+  """
+  # Python 3.7+ has a 4-byte flags field between the magic and the mtime.
+  mtime_offset = 8 if sys.version_info >= (3, 7) else 4
+  try:
+    with open(cache_path(source), 'rb') as cfile:
+      header = cfile.read(mtime_offset + 4)
+    source_mtime = int(os.stat(source).st_mtime) & 0xFFFFFFFF
+  except (IOError, OSError):
+    return True
+  if len(header) < mtime_offset + 4 or header[:4] != _magic_number():
+    return True
+  return struct.unpack('<I', header[mtime_offset:])[0] != source_mtime
+
+
+def stale_sources(directories):
+  """Returns the .py files under directories that need compiling."""
+  sources = []
+  for directory in directories:
+    for dirpath, _, filenames in os.walk(directory):
+      for filename in filenames:
+        if filename.endswith('.py'):
+          source = os.path.join(dirpath, filename)
+          if is_stale(source):
+            sources.append(source)
+  return sorted(sources)
+
+
+def compile_one(source):
+  """Compiles one file atomically. Returns (source, error message or None)."""
+  cfile = cache_path(source)
+  tmp_path = '{}.{}.tmp'.format(cfile, os.getpid())
+  try:
+    cache_dir = os.path.dirname(cfile)
+    if cache_dir and not os.path.isdir(cache_dir):
+      try:
+        os.makedirs(cache_dir)
+      except OSError:
+        if not os.path.isdir(cache_dir):
+          raise
+    py_compile.compile(source, cfile=tmp_path, doraise=True)
+    os.rename(tmp_path, cfile)
+    return source, None
+  except (py_compile.PyCompileError, IOError, OSError) as e:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    return source, str(e).strip()
+
+
+def compile_sources(sources, processes=DEFAULT_PROCESSES):
+  """Compiles sources in parallel and returns a summary dict."""
+  start_t = time.time()
+  sources = [source for source in sources if source.endswith('.py')]
+  if len(sources) > 1 and processes > 1:
+    pool = multiprocessing.Pool(min(processes, len(sources)))
+    try:
+      results = pool.map(compile_one, sources)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = [compile_one(source) for source in sources]
+  errors = dict((source, error) for source, error in results if error)
+  return {
+      'compiled': len(results) - len(errors),
+      'errors': errors,
+      'duration': round(time.time() - start_t, 3),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      'paths', nargs='+',
+      help='Directories to scan for stale bytecode, or .py files to compile.')
+  parser.add_argument(
+      '--processes', type=int, default=DEFAULT_PROCESSES,
+      help='Number of compiler processes.')
+  args = parser.parse_args()
+
+  directories = [path for path in args.paths if os.path.isdir(path)]
+  files = [path for path in args.paths if not os.path.isdir(path)]
+  summary = compile_sources(
+      files + stale_sources(directories), args.processes)
+  print(json.dumps(summary, sort_keys=True))
+
+
+if __name__ == '__main__':
+  main()
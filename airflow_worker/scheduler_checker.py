@@ -18,25 +18,42 @@ The check logic concludes that a scheduler is in bad state if:
   - number of queued/scheduled tasks > 0 (tasks waiting to be processed).
   - number of running tasks == 0 (no work has been assigned).
   - number of recently completed task is 0.
-In addition, the liveness prober also queries the timestamp of airflow scheduler
-stackdriver logs. If the timestamp is too old, the probe is deemed failed.
+In addition, the liveness prober checks how recently the scheduler was last
+active. If that timestamp is too old, the probe is deemed failed. The
+timestamp comes from one of the freshness sources:
+  - stackdriver (default): the latest airflow-scheduler log entry, read with
+    an in-process Logging API client. The log ingestion exclusion lookup is
+    cached on disk for --exclusion_ttl seconds. If the Logging API can't be
+    reached, freshness is unknown and the check is skipped. The client lives
+    only as long as the probe process, so every probe still imports the
+    logging library, builds the client and makes one API call.
+  - job: the latest heartbeat of a running SchedulerJob in the job table.
+  - file: the modification time of a heartbeat file.
+Only the job and file sources keep a freshness check within milliseconds.
+
+The freshness check and the task count queries run concurrently under one
+--deadline budget. Per-stage timings are printed with the result, and are
+also recorded with the instrumentation module together with the timings of
+the Logging API calls and DB queries. If a stage
+has not finished when the budget runs out, the probe passes or fails
+according to --on_timeout instead of being killed by Kubernetes mid-run.
 """
 
 import argparse
 import datetime
+import json
 import os
-from subprocess import PIPE
-from subprocess import Popen
-from subprocess import STDOUT
 import sys
+import tempfile
+import threading
+import time
 
-import iso8601
-
-from google.cloud import logging_v2
+import instrumentation
 
 GCP_PROJECT = 'GCP_PROJECT'
 COMPOSER_LOCATION = 'COMPOSER_LOCATION'
 COMPOSER_ENVIRONMENT = 'COMPOSER_ENVIRONMENT'
+EXCLUSION_CACHE_PATH = '/tmp/scheduler_checker_exclusion.json'
 
 
 def _check_env_vars():
@@ -47,22 +64,6 @@ def _check_env_vars():
     sys.exit('Missing environment variable(s): %s' % missing)
 
 
-def _is_log_ingestion_disabled():
-  """Determines heuristically whether or not log ingestion is disabled.
-
-  Returns True iff we are able to retrieve a logging exclusion named
-  'google-ui-logs-ingestion-off' that is not disabled.
-  """
-  client = logging_v2.ConfigServiceV2Client()
-  exclusion_name = client.exclusion_path(os.environ.get(GCP_PROJECT),
-                                         'google-ui-logs-ingestion-off')
-  try:
-    exclusion = client.get_exclusion(exclusion_name)
-    return not exclusion.disabled
-  except:
-    return False
-
-
 def _get_log_filter():
   format_string = 'resource.type="cloud_composer_environment" AND ' + \
       'resource.labels.location="{}" AND ' + \
@@ -74,38 +75,228 @@ def _get_log_filter():
       os.environ.get(GCP_PROJECT))
 
 
-def check_freshness(args):
-  _check_env_vars()
-  if _is_log_ingestion_disabled():
-    return
-  filter_string = _get_log_filter()
-  p = Popen(
-      [
-          'gcloud', 'logging', 'read', filter_string, '--limit', '1',
-          '--format', 'get(timestamp)', '--project',
-          os.environ.get(GCP_PROJECT)
-      ],
-      stdout=PIPE,
-      stderr=STDOUT)
-  (res, _) = p.communicate()
-  # Only check Stackdriver freshness if there was a result, and the call
-  # succeeded.
-  if res and not p.returncode:
+class FreshnessSource(object):
+  """Reports when the scheduler was last seen active."""
+
+  def latest_timestamp(self):
+    """Returns a naive UTC datetime, or None if freshness can't be judged."""
+    raise NotImplementedError()
+
+
+class StackdriverSource(FreshnessSource):
+  """Reads the latest scheduler log entry with an in-process API client.
+
+  The clients are created once per process, i.e. once per probe, so each
+  probe pays for importing the Logging library and building a client. The
+  result of the log ingestion exclusion lookup is cached in a file for
+  `exclusion_ttl` seconds, so repeated probes do not pay for the second API
+  call. Use the job or file source for a check within milliseconds.
+  """
+
+  def __init__(self, exclusion_cache_path=EXCLUSION_CACHE_PATH,
+               exclusion_ttl=600):
+    _check_env_vars()
+    self.project = os.environ.get(GCP_PROJECT)
+    self.exclusion_cache_path = exclusion_cache_path
+    self.exclusion_ttl = exclusion_ttl
+    self._logging_client = None
+    self._config_client = None
+
+  def _read_cached_exclusion(self):
+    try:
+      with open(self.exclusion_cache_path) as cache_file:
+        entry = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+      return None
+    if time.time() - entry.get('checked_at', 0) > self.exclusion_ttl:
+      return None
+    return entry.get('disabled')
+
+  def _write_cached_exclusion(self, disabled):
+    try:
+      fd, tmp_path = tempfile.mkstemp(
+          dir=os.path.dirname(os.path.abspath(self.exclusion_cache_path)))
+      with os.fdopen(fd, 'w') as tmp_file:
+        json.dump({'disabled': disabled, 'checked_at': time.time()}, tmp_file)
+      os.rename(tmp_path, self.exclusion_cache_path)
+    except (IOError, OSError):
+      pass
+
+  def _is_log_ingestion_disabled(self):
+    """Determines heuristically whether or not log ingestion is disabled.
+
+    Returns True iff we are able to retrieve a logging exclusion named
+    'google-ui-logs-ingestion-off' that is not disabled.
+    """
+    disabled = self._read_cached_exclusion()
+    if disabled is not None:
+      instrumentation.count('exclusion_cache', outcome='hit')
+      return disabled
+    instrumentation.count('exclusion_cache', outcome='miss')
+    with instrumentation.timer('import', module='google.cloud.logging_v2'):
+      from google.cloud import logging_v2
+    if self._config_client is None:
+      self._config_client = logging_v2.ConfigServiceV2Client()
+    exclusion_name = self._config_client.exclusion_path(
+        self.project, 'google-ui-logs-ingestion-off')
+    try:
+      with instrumentation.timer('gcloud_call', method='get_exclusion'):
+        exclusion = self._config_client.get_exclusion(exclusion_name)
+      disabled = not exclusion.disabled
+    except:
+      disabled = False
+    self._write_cached_exclusion(disabled)
+    return disabled
+
+  def latest_timestamp(self):
+    # An outage of the Logging API must not restart the scheduler; treat it as
+    # unknown freshness, like a failed gcloud call.
     try:
-      dt = iso8601.parse_date(res)
-    except iso8601.iso8601.ParseError:
-      # Python3-compatibility
-      dt = iso8601.parse_date(res.decode('UTF-8'))
+      return self._latest_log_timestamp()
+    except Exception as e:
+      instrumentation.count('freshness_errors', source='stackdriver')
+      print('Could not read the latest scheduler log entry, skipping the '
+            'freshness check: {!r}'.format(e))
+      return None
+
+  def _latest_log_timestamp(self):
+    # Skip the check if composer stackdriver is disabled.
+    if self._is_log_ingestion_disabled():
+      return None
+    with instrumentation.timer('import', module='google.cloud.logging_v2'):
+      from google.cloud import logging_v2
+    if self._logging_client is None:
+      self._logging_client = logging_v2.LoggingServiceV2Client()
+    with instrumentation.timer('gcloud_call', method='list_log_entries'):
+      entries = self._logging_client.list_log_entries(
+          ['projects/{}'.format(self.project)],
+          filter_=_get_log_filter(),
+          order_by='timestamp desc',
+          page_size=1)
+      # The first page is only fetched when the iterator is consumed.
+      entry = next(iter(entries), None)
+    if entry is None:
+      return None
+    timestamp = entry.timestamp
+    if hasattr(timestamp, 'ToDatetime'):
+      timestamp = timestamp.ToDatetime()
+    return timestamp.replace(tzinfo=None)
+
+
+class JobTableSource(FreshnessSource):
+  """Reads the latest running SchedulerJob heartbeat from the job table."""
+
+  def latest_timestamp(self):
+    # import before use so airflow installation is not needed to run the test.
+    import checker_lib
+    heartbeat = checker_lib.latest_scheduler_heartbeat()
+    if heartbeat is None:
+      return None
+    if heartbeat.tzinfo is not None:
+      heartbeat = heartbeat.replace(tzinfo=None) - heartbeat.utcoffset()
+    return heartbeat
+
+
+class HeartbeatFileSource(FreshnessSource):
+  """Uses the modification time of a file the scheduler touches."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def latest_timestamp(self):
+    try:
+      return datetime.datetime.utcfromtimestamp(os.path.getmtime(self.path))
+    except OSError:
+      return None
+
 
-    # If the log entry is 300 seconds old, we consider that the scheduler is
-    # temporarily down.
-    if (datetime.datetime.utcnow() -
-        dt.replace(tzinfo=None)).seconds > args['staleness']:
-      exit(1)
+def make_source(args):
+  if args['source'] == 'job':
+    return JobTableSource()
+  if args['source'] == 'file':
+    return HeartbeatFileSource(args['heartbeat_file'])
+  return StackdriverSource(exclusion_ttl=args['exclusion_ttl'])
+
+
+def is_fresh(source, staleness):
+  """Returns False iff the source reports activity older than staleness."""
+  timestamp = source.latest_timestamp()
+  # Only check freshness if the source could tell when the scheduler was last
+  # active.
+  if timestamp is None:
+    return True
+  # If the latest activity is more than `staleness` seconds old, we consider
+  # that the scheduler is temporarily down.
+  age = datetime.datetime.utcnow() - timestamp
+  return age.total_seconds() <= staleness
+
+
+class Stage(threading.Thread):
+  """Runs one probe stage in a daemon thread and records its outcome.
+
+  Attributes:
+    result: The return value of the stage function.
+    error: The exception raised by the stage function, if any, including
+      SystemExit.
+    duration: Seconds the stage took, or None while it is still running.
+  """
+
+  def __init__(self, name, target):
+    super(Stage, self).__init__(name=name)
+    self.daemon = True
+    self._target_fn = target
+    self.result = None
+    self.error = None
+    self.duration = None
+
+  def run(self):
+    started = time.time()
+    try:
+      with instrumentation.timer('probe_stage', stage=self.name):
+        self.result = self._target_fn()
+    except BaseException as e:
+      # SystemExit is swallowed by the thread otherwise; main re-raises it.
+      self.error = e
+    finally:
+      self.duration = time.time() - started
+
+
+def run_stages(stages, deadline):
+  """Starts all stages and waits for them until `deadline` seconds pass.
+
+  Returns the names of the stages that did not finish in time.
+  """
+  end_t = time.time() + deadline
+  for stage in stages:
+    stage.start()
+  for stage in stages:
+    stage.join(max(0, end_t - time.time()))
+  return [stage.name for stage in stages if stage.is_alive()]
+
+
+def _stage_timings(stages):
+  return {stage.name: (round(stage.duration, 3)
+                       if stage.duration is not None else 'timeout')
+          for stage in stages}
+
+
+def _exit_now(code):
+  # Stages that are still running may hold non-daemon resources (gRPC,
+  # DB connections); do not wait for them on the way out. os._exit skips the
+  # atexit hooks, so flush the instrumentation here.
+  instrumentation.flush()
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os._exit(code)
+
+
+def _task_counts():
+  # import before use so airflow installation is not needed to run the test.
+  import checker_lib
+  return checker_lib.task_count_by_state(False)
 
 
 def main():
-  # Skip the check if composer stackdriver is disabled.
   parser = argparse.ArgumentParser()
   parser.add_argument(
       '-s',
@@ -113,13 +304,60 @@ def main():
       type=int,
       default=300,
       help='Age threshold when a log entry is considered staled.')
-  check_freshness(vars(parser.parse_args()))
+  parser.add_argument(
+      '--source',
+      choices=['stackdriver', 'job', 'file'],
+      default='stackdriver',
+      help='Where the latest scheduler activity is read from.')
+  parser.add_argument(
+      '--heartbeat_file',
+      default=None,
+      help='File touched by the scheduler, used with --source=file.')
+  parser.add_argument(
+      '--exclusion_ttl',
+      type=float,
+      default=600,
+      help='Seconds the log ingestion exclusion lookup is cached for.')
+  parser.add_argument(
+      '-d',
+      '--deadline',
+      type=float,
+      default=25,
+      help='Overall time budget in seconds for all probe stages.')
+  parser.add_argument(
+      '--on_timeout',
+      choices=['pass', 'fail'],
+      default='fail',
+      help='Probe result when a stage is still running at the deadline.')
+  parsed_args = parser.parse_args()
+  if parsed_args.source == 'file' and not parsed_args.heartbeat_file:
+    parser.error('--heartbeat_file is required with --source=file.')
+  args = vars(parsed_args)
+  if args['source'] == 'stackdriver':
+    _check_env_vars()
 
-  # import before use so airflow installation is not needed to run the test.
+  freshness = Stage(
+      'freshness', lambda: is_fresh(make_source(args), args['staleness']))
+  task_counts = Stage('task_counts', _task_counts)
+  stages = [freshness, task_counts]
+  timed_out = run_stages(stages, args['deadline'])
+  print('Stage timings: {}'.format(_stage_timings(stages)))
+
+  if timed_out:
+    for name in timed_out:
+      instrumentation.count('probe_stage_timeouts', stage=name)
+    print('Stage(s) {} did not finish within {}s; probe will {}.'.format(
+        ', '.join(timed_out), args['deadline'], args['on_timeout']))
+    _exit_now(0 if args['on_timeout'] == 'pass' else 1)
+
+  for stage in stages:
+    if stage.error is not None:
+      raise stage.error
+  if not freshness.result:
+    exit(1)
   import checker_lib
-  task_counts = checker_lib.task_count_by_state(False)
-  print('Task count details: {}'.format(task_counts))
-  if checker_lib.declare_error_state(task_counts, check_scheduled=True):
+  print('Task count details: {}'.format(task_counts.result))
+  if checker_lib.declare_error_state(task_counts.result, check_scheduled=True):
     raise Exception('Scheduler seems to be dead.')
 
 
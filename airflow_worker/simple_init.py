@@ -19,6 +19,17 @@ Namely, does the following:
   * Initializes GCP-related Airflow Connections so that their project
     fields point to the GCP project in which the Airflow deployment was
     created. Creates any missing connections.
+  * Creates the task_instance indexes the liveness and autoscaling queries in
+    checker_lib rely on, if they are missing.
+
+The work is split into steps with dependencies (see _init_steps). Steps whose
+dependencies are met run concurrently, and a step is skipped when a cheap
+check shows it is already done, e.g. the schema is at the latest migration,
+so restarting the init container does not rerun `airflow initdb`. A timing
+report is printed for every step at the end.
+
+Run with --verify_indexes to EXPLAIN the checker_lib queries and report
+whether they use those indexes, without changing anything.
 """
 # Import subprocess and fix symlink to airflow configs before airflow modules
 # are imported.
@@ -39,12 +50,23 @@ def _symlink_airflow_cfg():
 
 _symlink_airflow_cfg()
 
+import argparse
+from datetime import datetime
+from datetime import timedelta
 import json
+import logging
 import os
+import re
+import sys
+import threading
+import time
 
+import airflow
 from airflow import models
 from airflow import settings
 
+import checker_lib
+
 GCS_BUCKET_ENV = 'GCS_BUCKET'
 GCP_PROJECT_ENV = 'GCP_PROJECT'
 CONNECTION_PROJECT_EXTRA_KEY = 'extra__google_cloud_platform__project'
@@ -52,26 +74,76 @@ GCP_CONN_IDS = ['google_cloud_default',
                 'bigquery_default',
                 'google_cloud_datastore_default',
                 'google_cloud_storage_default']
+AIRFLOW_DB_CONN_ID = 'airflow_db'
+GCS_MOUNT_DIR = '/home/airflow/gcs'
+GCS_SUBDIRECTORIES = ['dags', 'data', 'logs', 'plugins']
+# Index a SQLite EXPLAIN QUERY PLAN row searches or scans.
+SQLITE_INDEX_RE = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+
+
+def _alembic_heads():
+  """Returns the latest migration revisions shipped with Airflow."""
+  from alembic.config import Config
+  from alembic.script import ScriptDirectory
+  package_dir = os.path.dirname(os.path.abspath(airflow.__file__))
+  config = Config(os.path.join(package_dir, 'alembic.ini'))
+  config.set_main_option(
+      'script_location',
+      os.path.join(package_dir, 'migrations').replace('%', '%%'))
+  return set(ScriptDirectory.from_config(config).get_heads())
+
+
+def _airflow_db_is_current(engine):
+  """Returns whether the schema revision of the DB is the latest one."""
+  from alembic.migration import MigrationContext
+  with engine.connect() as connection:
+    current = set(MigrationContext.configure(connection).get_current_heads())
+  return bool(current) and current == _alembic_heads()
+
 
 def _init_airflow_db():
-  """Initializes Airflow database."""
-  subprocess.call(['airflow', 'initdb'])
+  """Initializes Airflow database.
+
+  Raises CalledProcessError if initdb fails, so the steps depending on the
+  schema do not run.
+  """
+  subprocess.check_call(['airflow', 'initdb'])
+
+
+def _gcs_directories_exist():
+  return all(os.path.isdir(os.path.join(GCS_MOUNT_DIR, directory))
+             for directory in GCS_SUBDIRECTORIES)
 
 
 def _init_gcs_directories(bucket):
   """Creates GCS bucket subdirectories."""
-  # we check the existence of ../data first before mounting the gcs bucket and
-  # creating sub-directories, this allow simple_init script to be called
-  # anytime.
-  if not os.path.exists('/home/airflow/gcs/data'):
-    subprocess.call(['gcsfuse', bucket, '/home/airflow/gcs'])
-    subprocess.call(['mkdir', '-p', '/home/airflow/gcs/dags'])
-    subprocess.call(['mkdir', '-p', '/home/airflow/gcs/data'])
-    subprocess.call(['mkdir', '-p', '/home/airflow/gcs/logs'])
-    subprocess.call(['mkdir', '-p', '/home/airflow/gcs/plugins'])
-
-
-def _init_conn_id(session, conn_id, project):
+  # we check the existence of ../data first before mounting the gcs bucket,
+  # this allow simple_init script to be called anytime.
+  if not os.path.exists(os.path.join(GCS_MOUNT_DIR, 'data')):
+    subprocess.call(['gcsfuse', bucket, GCS_MOUNT_DIR])
+  for directory in GCS_SUBDIRECTORIES:
+    path = os.path.join(GCS_MOUNT_DIR, directory)
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+
+def _query_connections(session, conn_ids):
+  """Fetches the Connections of all conn_ids with a single IN query.
+
+  :param session: the DB session
+  :type session: sqlalchemy.orm.session.Session
+  :param conn_ids: the conn_id's of connections to fetch
+  :type conn_ids: list of strings
+  :return: dict of conn_id to the (possibly empty) list of its Connections
+  """
+  conns = dict((conn_id, []) for conn_id in conn_ids)
+  for conn in (session.query(models.Connection).filter(
+      models.Connection.conn_id.in_(conn_ids))):
+    conns[conn.conn_id].append(conn)
+  return conns
+
+
+def _init_conn_id(session, conns, conn_id, project):
   """Initializes the GCP project extra field of Airflow Connections.
 
   Airflow allows multiple Connections to share the same conn_id field.
@@ -83,29 +155,27 @@ def _init_conn_id(session, conn_id, project):
 
   :param session: the DB session
   :type session: sqlalchemy.orm.session.Session
+  :param conns: the existing connections with the given conn_id
+  :type conns: list of models.Connection
   :param conn_id: the conn_id of connections to modify
   :type conn_id: string
   :param project: the project name or ID to associate with the
       connection(s)
   :type project: string
   """
-
-  num_conns = 0
-  for conn in (session.query(
-      models.Connection).filter(models.Connection.conn_id == conn_id)):
-    num_conns += 1
+  for conn in conns:
     extras = conn.extra_dejson
     extras[CONNECTION_PROJECT_EXTRA_KEY] = project
     conn.extra = json.dumps(extras)
 
-  if not num_conns:
+  if not conns:
     extras = json.dumps({CONNECTION_PROJECT_EXTRA_KEY: project})
     conn = models.Connection(
         conn_id=conn_id, conn_type='google_cloud_platform', extra=extras)
     session.add(conn)
 
 
-def _init_connections(session, conn_ids, project):
+def _init_connections(session, conns, conn_ids, project):
   """Sets the project extra field in GCP-related Airflow Connections.
 
   Creates a Connection with the given project field for conn_id's
@@ -113,6 +183,8 @@ def _init_connections(session, conn_ids, project):
 
   :param session: the DB session
   :type session: sqlalchemy.orm.session.Session
+  :param conns: the existing connections, as returned by _query_connections
+  :type conns: dict of conn_id to list of models.Connection
   :param conn_ids: the conn_id's of connections to modify
   :type conn_ids: list of strings
   :param project: the project name or ID to associate with the
@@ -120,10 +192,10 @@ def _init_connections(session, conn_ids, project):
   :type project: string
   """
   for conn_id in conn_ids:
-    _init_conn_id(session, conn_id, project)
+    _init_conn_id(session, conns[conn_id], conn_id, project)
 
 
-def _update_airflow_db_connection(session):
+def _update_airflow_db_connection(session, conns):
   """Updates airflow_db connection to contain the proper host and schema.
 
   Updates airflow_db connection to contain the airflow-sqlproxy-service's
@@ -132,13 +204,13 @@ def _update_airflow_db_connection(session):
 
   :param session: the DB session
   :type session: sqlalchemy.orm.session.Session
+  :param conns: the existing airflow_db connections
+  :type conns: list of models.Connection
   """
-  airflow_db_conn = (
-      session.query(models.Connection).filter(
-          models.Connection.conn_id == 'airflow_db').first())
+  airflow_db_conn = conns[0] if conns else None
   if not airflow_db_conn:
     airflow_db_conn = models.Connection(
-        conn_id='airflow_db', conn_type='mysql', login='root',
+        conn_id=AIRFLOW_DB_CONN_ID, conn_type='mysql', login='root',
         password=os.environ.get('SQL_PASSWORD'))
     session.add(airflow_db_conn)
   else:
@@ -147,14 +219,13 @@ def _update_airflow_db_connection(session):
   airflow_db_conn.schema = os.environ.get('SQL_DATABASE')
 
 
-def main():
-  _init_airflow_db()
-  _init_gcs_directories(os.getenv(GCS_BUCKET_ENV))
-
+def _init_all_connections(project):
+  """Updates the GCP and airflow_db connections in a single transaction."""
   session = settings.Session()
   try:
-    _init_connections(session, GCP_CONN_IDS, os.getenv(GCP_PROJECT_ENV))
-    _update_airflow_db_connection(session)
+    conns = _query_connections(session, GCP_CONN_IDS + [AIRFLOW_DB_CONN_ID])
+    _init_connections(session, conns, GCP_CONN_IDS, project)
+    _update_airflow_db_connection(session, conns[AIRFLOW_DB_CONN_ID])
     session.commit()
   except:
     session.rollback()
@@ -163,5 +234,195 @@ def main():
     session.close()
 
 
+def _init_checker_indexes(engine):
+  """Creates the checker_lib.CHECKER_INDEXES missing on task_instance.
+
+  :param engine: the engine of the Airflow database
+  :type engine: sqlalchemy.engine.Engine
+  """
+  for name, columns in checker_lib.create_checker_indexes(
+      engine, models.TaskInstance.__table__):
+    print('Created index {} on task_instance{}.'.format(name, columns))
+
+
+class Step(object):
+  """One step of the init pipeline.
+
+  Attributes:
+    name: Name of the step in the report and in the deps of other steps.
+    run: Callable doing the work of the step.
+    deps: Names of the steps that must complete before this one starts.
+    is_done: Optional callable returning True if the work is already done,
+      in which case run is not called.
+    status: One of 'pending', 'running', 'done', 'skipped', 'failed' or
+      'blocked' (a dependency failed).
+    duration: Seconds the step took, including the is_done check.
+  """
+
+  def __init__(self, name, run, deps=(), is_done=None):
+    self.name = name
+    self.run = run
+    self.deps = list(deps)
+    self.is_done = is_done
+    self.status = 'pending'
+    self.duration = 0.0
+    self.error = None
+
+  def execute(self):
+    start_t = time.time()
+    try:
+      if self.is_done is not None and self.is_done():
+        self.status = 'skipped'
+      else:
+        self.run()
+        self.status = 'done'
+    except Exception as e:
+      logging.exception('Init step {} failed.'.format(self.name))
+      self.error = str(e)
+      self.status = 'failed'
+    self.duration = time.time() - start_t
+
+
+def run_steps(steps):
+  """Runs each step once its deps are done, independent steps concurrently.
+
+  Steps depending on a failed step are not run. Returns True iff no step
+  failed or was blocked.
+  """
+  by_name = dict((step.name, step) for step in steps)
+  finished = threading.Condition()
+
+  def execute(step):
+    step.execute()
+    with finished:
+      finished.notify()
+
+  with finished:
+    while True:
+      progress = True
+      while progress:
+        progress = False
+        for step in steps:
+          if step.status != 'pending':
+            continue
+          deps = [by_name[name].status for name in step.deps]
+          if any(status in ('failed', 'blocked') for status in deps):
+            step.status = 'blocked'
+            progress = True
+          elif all(status in ('done', 'skipped') for status in deps):
+            step.status = 'running'
+            threading.Thread(target=execute, args=(step,)).start()
+            progress = True
+      if not any(step.status in ('pending', 'running') for step in steps):
+        break
+      finished.wait()
+  return all(step.status in ('done', 'skipped') for step in steps)
+
+
+def _print_report(steps, duration):
+  for step in steps:
+    print('{:<20} {:<8} {:8.3f}s{}'.format(
+        step.name, step.status, step.duration,
+        ' ' + step.error if step.error else ''))
+  print('{:<20} {:<8} {:8.3f}s'.format('total', '', duration))
+
+
+def _init_steps():
+  """Returns the steps of a full initialization."""
+  engine = settings.engine
+  return [
+      Step('airflow_db', _init_airflow_db,
+           is_done=lambda: _airflow_db_is_current(engine)),
+      Step('gcs_directories',
+           lambda: _init_gcs_directories(os.getenv(GCS_BUCKET_ENV)),
+           is_done=_gcs_directories_exist),
+      Step('checker_indexes', lambda: _init_checker_indexes(engine),
+           deps=['airflow_db'],
+           is_done=lambda: not checker_lib.missing_checker_indexes(
+               engine, models.TaskInstance.__table__)),
+      Step('connections',
+           lambda: _init_all_connections(os.getenv(GCP_PROJECT_ENV)),
+           deps=['airflow_db']),
+  ]
+
+
+def _checker_statements():
+  ti = models.TaskInstance.__table__.c
+  since = datetime.utcnow() - timedelta(minutes=10)
+  return {
+      'task_count_by_state(host)': checker_lib.task_count_statement(
+          ti, since, use_host_name=True),
+      'task_count_by_state(all)': checker_lib.task_count_statement(
+          ti, since, use_host_name=False),
+      'fleet_task_counts': checker_lib.host_count_statement(ti, since),
+      'task_rates': checker_lib.task_rate_statement(ti, since),
+  }
+
+
+def _explain(connection, statement):
+  """Returns the EXPLAIN output of a statement as a list of dicts."""
+  compiled = statement.compile(dialect=connection.dialect)
+  if compiled.positional:
+    params = [compiled.params[key] for key in compiled.positiontup]
+  else:
+    params = compiled.params
+  prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else (
+      'EXPLAIN ')
+  result = connection.execute(prefix + str(compiled), params)
+  return [dict(zip(result.keys(), row)) for row in result]
+
+
+def _used_indexes(dialect, plan):
+  """Returns the indexes an EXPLAIN plan chose, as a set of names.
+
+  Only the chosen indexes count: MySQL also lists the candidates it rejected
+  in possible_keys, which a full scan reports as well.
+  """
+  used = set()
+  for row in plan:
+    if dialect == 'sqlite':
+      used.update(SQLITE_INDEX_RE.findall(row.get('detail') or ''))
+    elif row.get('key'):
+      used.update(row['key'].split(','))
+  return used
+
+
+def _verify_checker_indexes(engine):
+  """EXPLAINs the checker_lib queries and reports the indexes they use.
+
+  Returns True iff every query uses at least one of the checker indexes.
+  """
+  all_used = True
+  with engine.connect() as connection:
+    for name, statement in sorted(_checker_statements().items()):
+      plan = _explain(connection, statement)
+      used = sorted(_used_indexes(connection.dialect.name, plan) &
+                    set(checker_lib.CHECKER_INDEXES))
+      all_used = all_used and bool(used)
+      print('{}: {} {}'.format(
+          name, 'uses ' + ', '.join(used) if used else 'uses NO checker index',
+          json.dumps(plan, default=str)))
+  return all_used
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--verify_indexes',
+      action='store_true',
+      help='Only report whether the checker queries use their indexes.')
+  args = parser.parse_args()
+  if args.verify_indexes:
+    sys.exit(0 if _verify_checker_indexes(settings.engine) else 1)
+
+  start_t = time.time()
+  steps = _init_steps()
+  succeeded = run_steps(steps)
+  _print_report(steps, time.time() - start_t)
+  if not succeeded:
+    sys.exit(1)
+
+
 if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
   main()
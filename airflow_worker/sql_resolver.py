@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared SQL connection resolver for the processes started by db_run.py.
+
+Runs as one daemon per node (or pod) and owns SQL address discovery: it
+resolves the working address with SqlConnectionUtils, revalidates it with a
+single probe every --interval seconds, rescanning the subnet only when it
+stops working, and atomically writes the resulting SQL Alchemy connection
+string to a file on a shared volume. The address also survives restarts when
+SQL_ADDRESS_CACHE names a cache file. db_run.py reads that file when
+SQL_RESOLVER_FILE is set and only scans the subnet itself if the file is
+missing or older than SQL_RESOLVER_MAX_AGE seconds.
+
+  Typical usage example:
+
+  SQL_SUBNET=... SQL_DATABASE=... SQL_USER=... SQL_PASSWORD=... \
+      python sql_resolver.py --output /var/run/airflow-sql/connection.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+import instrumentation
+
+RESOLVER_FILE_ENV_KEY = "SQL_RESOLVER_FILE"
+RESOLVER_MAX_AGE_ENV_KEY = "SQL_RESOLVER_MAX_AGE"
+DEFAULT_MAX_AGE = 180
+
+
+def read_resolved_connection(path, max_age=DEFAULT_MAX_AGE):
+  """Returns the connection string published by the resolver, or None.
+
+  None is returned if the file is missing, unreadable or was last verified
+  more than max_age seconds ago.
+  """
+  try:
+    with open(path) as resolved_file:
+      entry = json.load(resolved_file)
+  except (IOError, OSError, ValueError):
+    return None
+  if time.time() - entry.get("verified_at", 0) > max_age:
+    return None
+  return entry.get("conn")
+
+
+def write_resolved_connection(path, conn, address):
+  """Atomically publishes the connection string for the clients."""
+  fd, tmp_path = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(path)), prefix=".sql_resolver")
+  try:
+    with os.fdopen(fd, "w") as tmp_file:
+      json.dump({"conn": conn, "address": address,
+                 "verified_at": time.time()}, tmp_file)
+    os.rename(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      "--output", required=True,
+      help="File the resolved connection string is published to.")
+  parser.add_argument(
+      "--interval", type=float, default=30,
+      help="Seconds between two revalidations of the address.")
+  parser.add_argument(
+      "--concurrency", type=int, default=32,
+      help="Number of addresses probed in parallel during a scan.")
+  args = parser.parse_args()
+
+  # import before use so clients of this module do not need kubernetes.
+  import sync_sql_ip
+  instrumentation.flush_periodically()
+  utils = sync_sql_ip.SqlConnectionUtils(
+      sync_sql_ip.SqlCredentials(
+          sql_database=os.environ["SQL_DATABASE"],
+          sql_user=os.environ["SQL_USER"],
+          sql_password=os.environ["SQL_PASSWORD"]),
+      concurrency=args.concurrency,
+      cache_path=os.getenv("SQL_ADDRESS_CACHE"))
+  sql_net = os.environ["SQL_SUBNET"]
+  while True:
+    started = time.time()
+    try:
+      address = utils.find_working_ip_address(sql_net)
+      if address:
+        write_resolved_connection(
+            args.output, utils.create_db_conn_string(address), address)
+      else:
+        logging.error("Could not find valid SQL connection in provided subnet")
+    except Exception:
+      logging.exception("Resolving the SQL connection failed.")
+    time.sleep(max(0, args.interval - (time.time() - started)))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  main()
@@ -9,22 +9,54 @@ independently.
       --cidr $SQL_SUBNET \
       --sql_database $SQL_DATABASE \
       --sql_user $SQL_USER \
-      --sql_password $SQL_PASSWORD
+      --sql_password $SQL_PASSWORD \
+      --concurrency 32
 
   Given the SQL Subnet and the credentials, this program will
   find the valid IP address of the SQL instance and update the
   "airflow-sqlproxy-service".
+
+  With --concurrency greater than 1 the subnet is scanned by a pool of
+  threads. Each address is first pre-probed with a plain TCP connect to the
+  MySQL port and only addresses that accept it get the full driver handshake.
+  The scan returns as soon as one address works.
+
+  The last working address is kept together with the time it was last
+  verified, in memory and, with --cache_file, on disk. Later lookups
+  revalidate that address with a single probe and only fall back to a full
+  scan when it stops working.
+
+  The Service is only patched when its external name differs from the
+  working address. With --watch the program stays resident, watches the
+  Service and reconciles it whenever it changes, and at least once per
+  --watch_timeout seconds.
 """
 
+from ipaddress import ip_address as to_ip_address
 from ipaddress import ip_network
+import json
+import os
+import socket
+import tempfile
+import time
+import threading
+import six
+from six.moves import queue
 import sqlalchemy
 from sqlalchemy import create_engine
 import argparse
 import logging
 from kubernetes import client as k8s_client, config as k8s_config
+from kubernetes import watch as k8s_watch
+
+import instrumentation
 
 CONNECT_TIMEOUT = 2
+SQL_PORT = 3306
+DEFAULT_CONCURRENCY = 1
 AIRFLOW_SQLPROXY_SERVICE_NAME = "airflow-sqlproxy-service"
+AIRFLOW_SQLPROXY_SERVICE_NAMESPACE = "default"
+WATCH_TIMEOUT = 300
 # This template needs to be formatted with the user, password, address, and
 # database in that order.
 SQL_ALCHEMY_CONN_TEMPLATE = "mysql+mysqldb://{}:{}@{}/{}"
@@ -46,16 +78,123 @@ class SqlCredentials(object):
     self.sql_password = sql_password
 
 
+class ServiceReconciler(object):
+  """Keeps the SQL Proxy Service pointed at the SQL instance address.
+
+  Holds a single Kubernetes API client for its lifetime and only patches the
+  Service when its external name differs from the wanted address.
+
+  Attributes:
+    name: Name of the Service to reconcile.
+    namespace: Namespace of the Service.
+  """
+
+  def __init__(self, api=None, name=AIRFLOW_SQLPROXY_SERVICE_NAME,
+               namespace=AIRFLOW_SQLPROXY_SERVICE_NAMESPACE):
+    """Instantiates the reconciler; api defaults to a CoreV1Api."""
+    self._api = api
+    self.name = name
+    self.namespace = namespace
+
+  @property
+  def api(self):
+    if self._api is None:
+      k8s_config.load_kube_config()
+      self._api = k8s_client.CoreV1Api()
+    return self._api
+
+  def current_address(self):
+    """Returns the external name the Service currently points to."""
+    service = self.api.read_namespaced_service(self.name, self.namespace)
+    return service.spec.external_name if service.spec else None
+
+  def reconcile(self, ip_address, current_address=None):
+    """Patches the Service if needed. Returns True iff it was patched."""
+    if current_address is None:
+      current_address = self.current_address()
+    if current_address == ip_address:
+      logging.info("{} already points to {}.".format(self.name, ip_address))
+      return False
+    logging.info("Updating {} from {} to {}.".format(
+        self.name, current_address, ip_address))
+    self.api.patch_namespaced_service(
+        self.name,
+        self.namespace,
+        body=self._get_body_for_service_update(ip_address))
+    return True
+
+  def watch(self, find_address, timeout_seconds=WATCH_TIMEOUT):
+    """Reconciles the Service whenever it changes. Never returns.
+
+    Args:
+      find_address: Callable returning the working SQL address, or None.
+      timeout_seconds: Length of a single watch request. The Service is also
+        reconciled each time a watch request ends, so a SQL address change
+        is noticed even when nobody touches the Service.
+    """
+    while True:
+      try:
+        self._reconcile_found(find_address)
+        for event in k8s_watch.Watch().stream(
+            self.api.list_namespaced_service,
+            self.namespace,
+            field_selector="metadata.name={}".format(self.name),
+            timeout_seconds=timeout_seconds):
+          if event["type"] == "DELETED":
+            logging.warning("{} was deleted.".format(self.name))
+            continue
+          service = event["object"]
+          self._reconcile_found(
+              find_address,
+              current_address=service.spec.external_name if service.spec
+              else None)
+      except Exception:
+        logging.exception("Reconciling {} failed.".format(self.name))
+        time.sleep(CONNECT_TIMEOUT)
+
+  def _reconcile_found(self, find_address, current_address=None):
+    ip_address = find_address()
+    if ip_address:
+      self.reconcile(ip_address, current_address=current_address)
+    else:
+      logging.error("Could not find valid SQL connection in provided subnet")
+
+  def _get_body_for_service_update(self, ip_address):
+    body = k8s_client.V1Service(kind="Service", api_version="v1")
+    body.metadata = k8s_client.V1ObjectMeta(
+        name=self.name,
+        namespace=self.namespace,
+    )
+    body.spec = k8s_client.V1ServiceSpec(
+        type="ExternalName",
+        external_name=ip_address)
+    return body
+
+
 class SqlConnectionUtils(object):
   """Utility object that finds SQL connections and updates the SQL Proxy Service.
 
   Attributes:
     credentials: A SqlCredentials object for the target SQL instance.
+    concurrency: Number of addresses probed in parallel during a scan. A value
+      of 1 keeps the sequential scan.
+    timeout: Timeout in seconds for both the TCP pre-probe and the driver
+      handshake.
+    cache_path: Optional path of a JSON file holding the last known good
+      address and the time it was last verified. Without it the address is
+      only kept in memory, for the lifetime of the object.
+    reconciler: The ServiceReconciler used to update the SQL Proxy Service.
   """
 
-  def __init__(self, credentials):
+  def __init__(self, credentials, concurrency=DEFAULT_CONCURRENCY,
+               timeout=CONNECT_TIMEOUT, cache_path=None, reconciler=None):
     """Instantiates the SqlConnectionUtils with credentials"""
     self.credentials = credentials
+    self.concurrency = max(1, concurrency)
+    self.timeout = timeout
+    self.cache_path = cache_path
+    self.reconciler = reconciler or ServiceReconciler()
+    self._cached_entry = None
 
   def create_db_conn_string(self, address):
     """Creates a SQL Alchemy connection string with a given IP Address"""
@@ -66,23 +205,159 @@ class SqlConnectionUtils(object):
 
   def _test_connection(self, conn):
     engine = create_engine(
-        conn, connect_args={"connect_timeout": CONNECT_TIMEOUT})
+        conn, connect_args={"connect_timeout": int(max(1, self.timeout))})
     try:
       connection = engine.connect()
       connection.close()
       return True
     except sqlalchemy.exc.OperationalError:
       return False
+    finally:
+      engine.dispose()
+
+  def _probe_port(self, address):
+    """Returns True iff the address accepts a TCP connection on SQL_PORT."""
+    try:
+      with instrumentation.timer("sql_port_probe"):
+        sock = socket.create_connection((str(address), SQL_PORT), self.timeout)
+    except (socket.error, socket.timeout):
+      return False
+    sock.close()
+    return True
+
+  def _handshake(self, address):
+    """Runs the driver handshake and records its outcome."""
+    with instrumentation.timer("sql_handshake"):
+      working = self._test_connection(self.create_db_conn_string(address))
+    instrumentation.count("sql_probe", address=str(address),
+                          outcome="ok" if working else "handshake_failed")
+    return working
+
+  def _is_working_address(self, address):
+    """Pre-probes the address over TCP, then runs the driver handshake."""
+    if not self._probe_port(address):
+      instrumentation.count("sql_probe", address=str(address),
+                            outcome="port_closed")
+      return False
+    return self._handshake(address)
+
+  def read_cache(self):
+    """Returns the cached {"address", "verified_at"} entry, or None."""
+    if not self.cache_path:
+      return self._cached_entry
+    try:
+      with open(self.cache_path) as cache_file:
+        entry = json.load(cache_file)
+      return entry if entry.get("address") else None
+    except (IOError, OSError, ValueError, AttributeError):
+      return None
+
+  def write_cache(self, address):
+    """Atomically records the address as verified now."""
+    self._cached_entry = {"address": address, "verified_at": time.time()}
+    if not self.cache_path:
+      return
+    cache_dir = os.path.dirname(os.path.abspath(self.cache_path))
+    tmp_path = None
+    try:
+      fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".sql_cache")
+      with os.fdopen(fd, "w") as tmp_file:
+        json.dump({"address": address, "verified_at": time.time()}, tmp_file)
+      os.rename(tmp_path, self.cache_path)
+      tmp_path = None
+    except (IOError, OSError) as e:
+      logging.warning("Could not write SQL address cache {}: {}".format(
+          self.cache_path, e))
+    finally:
+      if tmp_path is not None and os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+  def _revalidate_cached_address(self, ip_range):
+    entry = self.read_cache()
+    if entry is None:
+      instrumentation.count("sql_address_cache", outcome="miss")
+      return None
+    address = entry["address"]
+    try:
+      if to_ip_address(six.text_type(address)) not in ip_range:
+        instrumentation.count("sql_address_cache", outcome="out_of_range")
+        return None
+    except ValueError:
+      instrumentation.count("sql_address_cache", outcome="out_of_range")
+      return None
+    logging.info("Revalidating cached SQL IP {}.".format(address))
+    if self._is_working_address(address):
+      instrumentation.count("sql_address_cache", outcome="valid")
+      return address
+    instrumentation.count("sql_address_cache", outcome="invalid")
+    logging.info("Cached SQL IP {} is no longer valid.".format(address))
+    return None
 
   def find_working_ip_address(self, cidr_block):
-    """Finds a working IP address for the SQL instance."""
-    ip_range = ip_network(unicode(cidr_block))
+    """Finds a working IP address for the SQL instance.
+
+    The cached address, if any, is tried first; the subnet is only scanned
+    when it fails to revalidate.
+    """
+    ip_range = ip_network(six.text_type(cidr_block))
+    with instrumentation.timer("sql_discovery", phase="cache"):
+      address = self._revalidate_cached_address(ip_range)
+    if address is None:
+      with instrumentation.timer("sql_discovery", phase="scan"):
+        address = self._scan(ip_range)
+    if address is not None:
+      self.write_cache(address)
+    return address
+
+  def _scan(self, ip_range):
+    if self.concurrency > 1:
+      return self._scan_parallel(ip_range)
     for address in ip_range:
       logging.info("Testing SQL connection for IP {}.".format(address))
-      conn = self.create_db_conn_string(address)
-      if self._test_connection(conn):
+      if self._handshake(address):
         return str(address)
 
+  def _scan_parallel(self, ip_range):
+    """Scans the addresses with a bounded pool of threads.
+
+    Returns the first address that passes both the TCP pre-probe and the
+    driver handshake. Remaining workers stop picking up new addresses as soon
+    as one is found; the ones still inside a probe are daemon threads and are
+    left to time out on their own.
+    """
+    addresses = queue.Queue()
+    for address in ip_range:
+      addresses.put(address)
+    results = queue.Queue()
+    found = threading.Event()
+
+    def worker():
+      try:
+        while not found.is_set():
+          try:
+            address = addresses.get_nowait()
+          except queue.Empty:
+            return
+          logging.info("Testing SQL connection for IP {}.".format(address))
+          if self._is_working_address(address) and not found.is_set():
+            found.set()
+            results.put(str(address))
+      finally:
+        results.put(None)
+
+    num_workers = min(self.concurrency, addresses.qsize())
+    for _ in range(num_workers):
+      thread = threading.Thread(target=worker)
+      thread.daemon = True
+      thread.start()
+
+    finished = 0
+    while finished < num_workers:
+      result = results.get()
+      if result is not None:
+        return result
+      finished += 1
+
   def find_working_connection(self, cidr_block):
     """Finds a working SQL Alchemy connection for the SQL instance."""
     address = self.find_working_ip_address(cidr_block)
@@ -90,24 +365,8 @@ class SqlConnectionUtils(object):
       return self.create_db_conn_string(address)
 
   def update_sql_ip_address(self, ip_address):
-    """Updates the SQL Proxy service with the new IP address."""
-    k8s_config.load_kube_config()
-    k8s_api = k8s_client.CoreV1Api()
-    k8s_api.patch_namespaced_service(
-        AIRFLOW_SQLPROXY_SERVICE_NAME,
-        "default",
-        body=self._get_body_for_service_update(ip_address))
-
-  def _get_body_for_service_update(self, ip_address):
-    body = k8s_client.V1Service(kind="Service", api_version="v1")
-    body.metadata = k8s_client.V1ObjectMeta(
-        name=AIRFLOW_SQLPROXY_SERVICE_NAME,
-        namespace="default",
-    )
-    body.spec = k8s_client.V1ServiceSpec(
-        type="ExternalName",
-        external_name=ip_address)
-    return body
+    """Updates the SQL Proxy service with the new IP address, if it changed."""
+    return self.reconciler.reconcile(ip_address)
 
 
 def main():
@@ -129,6 +388,29 @@ def main():
       required=True)
   parser.add_argument(
       "--sql_password", help="The SQL user's password.", nargs=1, required=True)
+  parser.add_argument(
+      "--concurrency",
+      help="Number of addresses probed in parallel.",
+      type=int,
+      default=DEFAULT_CONCURRENCY)
+  parser.add_argument(
+      "--timeout",
+      help="Connect timeout in seconds for each probed address.",
+      type=float,
+      default=CONNECT_TIMEOUT)
+  parser.add_argument(
+      "--cache_file",
+      help="File that keeps the last known good address between runs.",
+      default=None)
+  parser.add_argument(
+      "--watch",
+      help="Stay resident and reconcile the Service whenever it changes.",
+      action="store_true")
+  parser.add_argument(
+      "--watch_timeout",
+      help="Seconds between two reconciliations when nothing changes.",
+      type=int,
+      default=WATCH_TIMEOUT)
   args = parser.parse_args()
 
   cidr_block = args.cidr[0]
@@ -136,7 +418,16 @@ def main():
       sql_database=args.sql_database[0],
       sql_user=args.sql_user[0],
       sql_password=args.sql_password[0])
-  utils = SqlConnectionUtils(credentials)
+  utils = SqlConnectionUtils(
+      credentials,
+      concurrency=args.concurrency,
+      timeout=args.timeout,
+      cache_path=args.cache_file)
+  if args.watch:
+    instrumentation.flush_periodically()
+    utils.reconciler.watch(
+        lambda: utils.find_working_ip_address(cidr_block),
+        timeout_seconds=args.watch_timeout)
   ip_address = utils.find_working_ip_address(cidr_block)
   if ip_address:
     utils.update_sql_ip_address(ip_address)
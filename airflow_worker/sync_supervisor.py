@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs the syncd jobs as independent periodic jobs.
+
+Each job is a command with its own interval, so a slow job (e.g. the tenant
+bucket sync) no longer delays the others (e.g. the DAG sync). A job never
+overlaps with itself: its next run starts `interval` seconds (plus a random
+jitter) after the previous one started, or right after it finished if it took
+longer. A run exceeding the job timeout is terminated together with its child
+processes. The last start, duration, exit code and success time of every job
+are written to --status_file after each run.
+
+  Typical usage example:
+
+  python sync_supervisor.py --status_file /var/tmp/syncd_status.json \
+      --job dags 10 3600 'sync.sh /home/airflow/gcs gsutil_sync' \
+      --job kube_config 3600 300 '/var/local/init_kube.sh'
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shlex
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+# Seconds between SIGTERM and SIGKILL when a run is stopped.
+KILL_GRACE = 10
+
+
+class Job(object):
+  """A command run periodically, never overlapping with itself.
+
+  Attributes:
+    name: Name of the job in logs and in the status file.
+    command: The command to run, as a list of arguments.
+    interval: Seconds between the starts of two runs.
+    timeout: Seconds after which a run is terminated.
+    jitter: Fraction of the interval added at random to each delay.
+  """
+
+  def __init__(self, name, command, interval, timeout, jitter=0.1):
+    self.name = name
+    self.command = command
+    self.interval = interval
+    self.timeout = timeout
+    self.jitter = jitter
+    self._lock = threading.Lock()
+    self._process = None
+    self.runs = 0
+    self.failures = 0
+    self.last_start = None
+    self.last_duration = None
+    self.last_exit_code = None
+    self.last_success = None
+
+  def status(self):
+    with self._lock:
+      return {
+          'running': self._process is not None,
+          'runs': self.runs,
+          'failures': self.failures,
+          'last_start': self.last_start,
+          'last_duration': self.last_duration,
+          'last_exit_code': self.last_exit_code,
+          'last_success': self.last_success,
+      }
+
+  def _signal(self, process, signum):
+    try:
+      # The command runs in its own process group; signal all of it.
+      os.killpg(process.pid, signum)
+    except OSError:
+      pass
+
+  def terminate(self):
+    """Stops the current run, if any."""
+    with self._lock:
+      process = self._process
+    if process is not None:
+      self._signal(process, signal.SIGTERM)
+      killer = threading.Timer(
+          KILL_GRACE, self._signal, [process, signal.SIGKILL])
+      killer.daemon = True
+      killer.start()
+
+  def run_once(self):
+    """Runs the command once and returns its exit code."""
+    started = time.time()
+    process = subprocess.Popen(self.command, preexec_fn=os.setsid)
+    with self._lock:
+      self._process = process
+      self.last_start = started
+    timer = threading.Timer(self.timeout, self._on_timeout)
+    timer.daemon = True
+    timer.start()
+    try:
+      exit_code = process.wait()
+    finally:
+      timer.cancel()
+    finished = time.time()
+    with self._lock:
+      self._process = None
+      self.runs += 1
+      self.last_duration = round(finished - started, 3)
+      self.last_exit_code = exit_code
+      if exit_code == 0:
+        self.last_success = finished
+      else:
+        self.failures += 1
+    if exit_code:
+      logging.warning('Job {} exited with {} after {:.1f}s.'.format(
+          self.name, exit_code, finished - started))
+    return exit_code
+
+  def _on_timeout(self):
+    logging.error('Job {} timed out after {}s, terminating it.'.format(
+        self.name, self.timeout))
+    self.terminate()
+
+  def loop(self, stop, on_finished=None):
+    """Runs the job every interval until stop is set."""
+    while not stop.is_set():
+      started = time.time()
+      try:
+        self.run_once()
+      except Exception:
+        logging.exception('Job {} could not be started.'.format(self.name))
+      if on_finished is not None:
+        on_finished(self)
+      delay = self.interval * (1 + random.uniform(0, self.jitter))
+      stop.wait(max(0, delay - (time.time() - started)))
+
+
+class Supervisor(object):
+  """Runs every job in its own thread and publishes their status."""
+
+  def __init__(self, jobs, status_file=None):
+    self.jobs = jobs
+    self.status_file = status_file
+    self.stop = threading.Event()
+    self._status_lock = threading.Lock()
+
+  def write_status(self, unused_job=None):
+    """Writes the status of every job, logging instead of raising."""
+    if not self.status_file:
+      return
+    with self._status_lock:
+      status = dict((job.name, job.status()) for job in self.jobs)
+      tmp_path = None
+      try:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.status_file)),
+            prefix='.syncd_status')
+        with os.fdopen(fd, 'w') as tmp_file:
+          json.dump(status, tmp_file, sort_keys=True)
+        os.rename(tmp_path, self.status_file)
+      except (IOError, OSError) as e:
+        logging.warning('Could not write status file {}: {}'.format(
+            self.status_file, e))
+      finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+          os.remove(tmp_path)
+
+  def run(self):
+    """Starts the jobs and blocks until stop is set, then stops them."""
+    threads = []
+    for job in self.jobs:
+      thread = threading.Thread(
+          target=job.loop, args=(self.stop, self.write_status))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    while not self.stop.is_set():
+      # A timeout keeps the main thread responsive to signals on Python 2.
+      self.stop.wait(1)
+    for job in self.jobs:
+      job.terminate()
+    for thread in threads:
+      thread.join(KILL_GRACE + 1)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--job', nargs=4, action='append', required=True,
+      metavar=('NAME', 'INTERVAL', 'TIMEOUT', 'COMMAND'),
+      help='A periodic job; COMMAND is split like a shell command line.')
+  parser.add_argument(
+      '--jitter', type=float, default=0.1,
+      help='Fraction of the interval added at random to each delay.')
+  parser.add_argument(
+      '--status_file', default=None,
+      help='File the status of every job is written to after each run.')
+  args = parser.parse_args()
+
+  jobs = [Job(name, shlex.split(command), float(interval), float(timeout),
+              args.jitter)
+          for name, interval, timeout, command in args.job]
+  supervisor = Supervisor(jobs, args.status_file)
+
+  def handle_signal(signum, unused_frame):
+    logging.info('Received signal {}, stopping the jobs.'.format(signum))
+    supervisor.stop.set()
+
+  signal.signal(signal.SIGTERM, handle_signal)
+  signal.signal(signal.SIGINT, handle_signal)
+  supervisor.run()
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
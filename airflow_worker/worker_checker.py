@@ -18,14 +18,93 @@ The check logic concludes that a worker is in bad state if:
   - number of queued tasks > 0 (tasks waiting to be processed).
   - number of running tasks in this worker == 0 (worker doesn't take task).
   - number of recently completed task is 0.
+
+With --fleet_file the counts are read from the status published by
+fleet_checker.py; the DB is only queried if that file is missing or stale.
+
+With --history_file each probe appends its counts to an on-disk history and
+the verdict is based on the trend instead of a single snapshot: the worker is
+dead only if the error state held for --grace seconds, with no probe missing
+for more than --max_gap seconds, and it is degraded if the queued backlog kept
+growing over --degraded_window seconds while this worker kept as many tasks
+running but finished fewer of them. The history keeps enough snapshots to
+cover both windows at --probe_period.
 """
 
+import argparse
+
+import checker_history
 import checker_lib
 
 
+def _task_counts(args):
+  if args.fleet_file:
+    fleet_status = checker_lib.read_fleet_status(
+        args.fleet_file, args.fleet_max_age)
+    if fleet_status is not None:
+      return checker_lib.host_task_counts(fleet_status)
+  return checker_lib.task_count_by_state()
+
+
 def main():
-  task_counts = checker_lib.task_count_by_state()
-  if checker_lib.declare_error_state(task_counts):
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--fleet_file',
+      default=None,
+      help='Fleet status file written by fleet_checker.py.')
+  parser.add_argument(
+      '--fleet_max_age',
+      type=float,
+      default=60,
+      help='Age in seconds after which the fleet status file is ignored.')
+  parser.add_argument(
+      '--history_file',
+      default=None,
+      help='File keeping recent task count snapshots between probes.')
+  parser.add_argument(
+      '--grace',
+      type=float,
+      default=300,
+      help='Seconds the error state must persist before the worker is dead.')
+  parser.add_argument(
+      '--max_gap',
+      type=float,
+      default=None,
+      help='Longest interval in seconds between two snapshots within the '
+      'grace period. Defaults to half of --grace.')
+  parser.add_argument(
+      '--degraded_window',
+      type=float,
+      default=0,
+      help='Seconds of growing backlog during which this worker runs as many '
+      'tasks but finishes fewer that fail the probe. The backlog is '
+      'fleet-wide, so a worker with steady throughput passes. 0 disables the '
+      'check.')
+  parser.add_argument(
+      '--probe_period',
+      type=float,
+      default=checker_history.MIN_PROBE_PERIOD,
+      help='Shortest interval in seconds between two probes, used to size '
+      'the history.')
+  args = parser.parse_args()
+
+  task_counts = _task_counts(args)
+  if args.history_file:
+    capacity = checker_history.capacity_for(
+        max(args.grace, args.degraded_window), args.probe_period)
+    snapshots = checker_history.History(
+        args.history_file, capacity).append(task_counts)
+    if checker_history.is_stuck(snapshots, checker_lib.declare_error_state,
+                                args.grace, args.max_gap):
+      raise Exception('Worker {} seems to be dead for {}s. Task counts '
+                      'details:{}'.format(checker_lib.host_name, args.grace,
+                                          task_counts))
+    if args.degraded_window and checker_history.is_degraded(
+        snapshots, args.degraded_window):
+      raise Exception('Worker {} is not keeping up with the queue. Task '
+                      'counts details:{}'.format(checker_lib.host_name,
+                                                 task_counts))
+  elif checker_lib.declare_error_state(task_counts):
     raise Exception('Worker {} seems to be dead. Task counts details:{}'.format(
         checker_lib.host_name, task_counts))
   print('Worker {} is alive with task count details{}'.format(
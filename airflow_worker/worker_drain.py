@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Makes scale-downs of the worker Deployment remove idle workers first.
+
+Every interval the worker pods are ranked by the number of tasks running on
+them, from the per-host counts of checker_lib.fleet_task_counts (or the
+status file written by fleet_checker.py). Each pod gets that number as its
+controller.kubernetes.io/pod-deletion-cost annotation, so when the HPA lowers
+the replica count the ReplicaSet deletes the least loaded pods first.
+
+With --cordon N the workers a scale-down is about to remove additionally
+stop consuming the Celery queue, so they drain instead of picking up new
+tasks. A scale-down is expected when the queued and running tasks fit fewer
+workers at --tasks_per_worker (the HPA target) than are running; up to N of
+the least loaded workers beyond that count are cordoned. When the demand
+rises again they start consuming again. The cordon annotation is reconciled
+with the queues the workers actually consume (Celery active_queues), so a
+cordoned worker that restarted is cordoned again.
+
+  Typical usage example:
+
+  python worker_drain.py --namespace $NAMESPACE --dry_run --once
+  python worker_drain.py --namespace $NAMESPACE --cordon 2
+"""
+
+import argparse
+import json
+import logging
+import math
+import time
+
+import instrumentation
+
+DELETION_COST_ANNOTATION = 'controller.kubernetes.io/pod-deletion-cost'
+CORDON_ANNOTATION = 'airflow-worker/cordoned'
+DEFAULT_SELECTOR = 'run=airflow-worker'
+DEFAULT_QUEUE = 'default'
+# Seconds to wait for the workers to report the queues they consume.
+INSPECT_TIMEOUT = 5
+
+
+def _pod_name(hostname):
+  # Task instances may record the FQDN; the pod name is its first label.
+  return hostname.split('.', 1)[0]
+
+
+def plan(pods, fleet_counts, cordon=0, tasks_per_worker=8, min_replicas=1):
+  """Ranks the worker pods by in-flight tasks, least loaded first.
+
+  Args:
+    pods: Names of the worker pods.
+    fleet_counts: Per-host counts as returned by
+      checker_lib.fleet_task_counts.
+    cordon: Maximum number of pods to stop consuming new tasks. Only pods a
+      scale-down is about to remove are cordoned.
+    tasks_per_worker: Queued and running tasks a worker is sized for.
+    min_replicas: Lower bound of the worker count.
+
+  Returns:
+    A list of dicts with the 'pod', its 'running' task count, the
+    'deletion_cost' to annotate and whether to 'cordon' it.
+  """
+  running = dict((pod, 0) for pod in pods)
+  for hostname, counts in fleet_counts['hosts'].items():
+    pod = _pod_name(hostname)
+    if pod in running:
+      running[pod] += counts['running']
+  demand = fleet_counts['queued'] + sum(running.values())
+  needed = max(min_replicas,
+               int(math.ceil(demand / float(tasks_per_worker))))
+  removed = min(cordon, max(0, len(running) - needed))
+  ranked = sorted(running.items(), key=lambda item: (item[1], item[0]))
+  return [{'pod': pod, 'running': count, 'deletion_cost': count,
+           'cordon': rank < removed}
+          for rank, (pod, count) in enumerate(ranked)]
+
+
+class WorkerDrainer(object):
+  """Applies a drain plan to the worker pods.
+
+  Holds a single Kubernetes API client for its lifetime and only patches a
+  pod when its annotations differ from the plan.
+
+  Attributes:
+    namespace: Namespace of the worker pods.
+    selector: Label selector matching the worker pods.
+    queue: Celery queue the workers consume.
+  """
+
+  def __init__(self, api=None, namespace='default', selector=DEFAULT_SELECTOR,
+               queue=DEFAULT_QUEUE, celery_control=None):
+    """Instantiates the drainer.
+
+    api defaults to a CoreV1Api and celery_control to the control interface
+    of the Airflow Celery app; both are created on first use.
+    """
+    self._api = api
+    self._celery_control = celery_control
+    self.namespace = namespace
+    self.selector = selector
+    self.queue = queue
+
+  @property
+  def api(self):
+    if self._api is None:
+      from kubernetes import client as k8s_client
+      from kubernetes import config as k8s_config
+      try:
+        k8s_config.load_incluster_config()
+      except k8s_config.ConfigException:
+        k8s_config.load_kube_config()
+      self._api = k8s_client.CoreV1Api()
+    return self._api
+
+  @property
+  def celery_control(self):
+    if self._celery_control is None:
+      from airflow.executors.celery_executor import app
+      self._celery_control = app.control
+    return self._celery_control
+
+  def list_workers(self):
+    """Returns {pod name: annotations} of the running worker pods."""
+    pods = self.api.list_namespaced_pod(
+        self.namespace, label_selector=self.selector)
+    return dict((pod.metadata.name, pod.metadata.annotations or {})
+                for pod in pods.items
+                if pod.status.phase == 'Running'
+                and pod.metadata.deletion_timestamp is None)
+
+  def consumers(self):
+    """Returns {pod name: whether it consumes the queue}.
+
+    Workers that did not reply within INSPECT_TIMEOUT are left out.
+    """
+    replies = self.celery_control.inspect(
+        timeout=INSPECT_TIMEOUT).active_queues() or {}
+    return dict((_pod_name(node.split('@', 1)[-1]),
+                 any(queue['name'] == self.queue for queue in queues or []))
+                for node, queues in replies.items())
+
+  def _set_consuming(self, pod, consuming):
+    destination = ['celery@{}'.format(pod)]
+    if consuming:
+      self.celery_control.add_consumer(self.queue, destination=destination)
+    else:
+      self.celery_control.cancel_consumer(self.queue, destination=destination)
+
+  def apply(self, drain_plan, annotations, consumers=None):
+    """Patches the pods whose annotations differ from the plan.
+
+    Workers whose consumer state differs from the plan start or stop
+    consuming the queue first.
+
+    Args:
+      drain_plan: The list returned by plan().
+      annotations: {pod name: annotations}, as returned by list_workers().
+      consumers: {pod name: whether it consumes the queue}, as returned by
+        consumers(). Pods missing from it are assumed to match their cordon
+        annotation.
+
+    Returns:
+      The names of the pods that were patched.
+    """
+    consumers = consumers or {}
+    patched = []
+    for entry in drain_plan:
+      pod = entry['pod']
+      current = annotations.get(pod, {})
+      wanted = {DELETION_COST_ANNOTATION: str(entry['deletion_cost'])}
+      cordoned = current.get(CORDON_ANNOTATION) == 'true'
+      consuming = consumers.get(pod, not cordoned)
+      if consuming == cordoned:
+        logging.warning('{} is {}consuming {} but annotated as {}cordoned.'
+                        .format(pod, '' if consuming else 'not ', self.queue,
+                                '' if cordoned else 'not '))
+      if consuming == entry['cordon']:
+        self._set_consuming(pod, not entry['cordon'])
+      if entry['cordon'] != cordoned:
+        # null removes the annotation in a merge patch.
+        wanted[CORDON_ANNOTATION] = 'true' if entry['cordon'] else None
+      if all(current.get(key) == value for key, value in wanted.items()):
+        continue
+      logging.info('Updating {}: {}'.format(pod, wanted))
+      self.api.patch_namespaced_pod(
+          pod, self.namespace, {'metadata': {'annotations': wanted}})
+      patched.append(pod)
+    return patched
+
+
+def _fleet_counts(args):
+  # import before use so the module loads without airflow installed.
+  import checker_lib
+  if args.fleet_file:
+    fleet_status = checker_lib.read_fleet_status(
+        args.fleet_file, args.fleet_max_age)
+    if fleet_status is not None:
+      return fleet_status
+  return checker_lib.fleet_task_counts()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--namespace', default='default')
+  parser.add_argument(
+      '--selector', default=DEFAULT_SELECTOR,
+      help='Label selector of the worker pods.')
+  parser.add_argument(
+      '--queue', default=DEFAULT_QUEUE,
+      help='Celery queue cordoned workers stop consuming.')
+  parser.add_argument(
+      '--cordon', type=int, default=0,
+      help='Maximum number of workers about to be removed by a scale-down '
+      'to stop taking new tasks.')
+  parser.add_argument(
+      '--tasks_per_worker', type=float, default=8,
+      help='Queued and running tasks a worker is sized for, i.e. the HPA '
+      'target.')
+  parser.add_argument('--min_replicas', type=int, default=1)
+  parser.add_argument(
+      '--fleet_file', default=None,
+      help='Fleet status file written by fleet_checker.py.')
+  parser.add_argument(
+      '--fleet_max_age', type=float, default=60,
+      help='Age in seconds after which the fleet status file is ignored.')
+  parser.add_argument(
+      '--interval', type=float, default=30,
+      help='Seconds between two rankings.')
+  parser.add_argument(
+      '--dry_run', action='store_true',
+      help='Print the plan instead of patching the pods.')
+  parser.add_argument('--once', action='store_true', help='Run once and exit.')
+  args = parser.parse_args()
+
+  drainer = WorkerDrainer(namespace=args.namespace, selector=args.selector,
+                          queue=args.queue)
+  if not args.once:
+    instrumentation.flush_periodically()
+  while True:
+    started = time.time()
+    try:
+      annotations = drainer.list_workers()
+      drain_plan = plan(annotations, _fleet_counts(args), args.cordon,
+                        args.tasks_per_worker, args.min_replicas)
+      if args.dry_run:
+        print(json.dumps(drain_plan, sort_keys=True))
+      else:
+        consumers = None
+        if args.cordon or any(
+            pod_annotations.get(CORDON_ANNOTATION) == 'true'
+            for pod_annotations in annotations.values()):
+          consumers = drainer.consumers()
+        drainer.apply(drain_plan, annotations, consumers)
+    except Exception:
+      if args.once:
+        raise
+      logging.exception('Failed to rank the workers.')
+    if args.once:
+      return
+    time.sleep(max(0, args.interval - (time.time() - started)))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
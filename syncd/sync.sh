@@ -1,30 +1,61 @@
 #!/bin/bash
-MAX_TIME_ELAPSED_VALUE=1000000
 SQL_IP_SEARCH_FREQUENCY=60
+GCS_SYNC_FREQUENCY=10
+SQL_SCAN_CONCURRENCY=${SQL_SCAN_CONCURRENCY:-32}
+SQL_ADDRESS_CACHE=${SQL_ADDRESS_CACHE:-/var/tmp/sql_address_cache.json}
 KUBE_CREDENTIALS_REFRESH_FREQUENCY=3600 # 1 hour.
-GCS_TENANT_BUCKET_EXISTS="FALSE"
+SYNCD_STATUS_FILE=${SYNCD_STATUS_FILE:-/var/tmp/syncd_status.json}
+# Jobs run as separate processes; state they share between runs lives here.
+SYNC_STATE_DIR=${SYNC_STATE_DIR:-/var/tmp/syncd}
+# Set to "manifest" to sync dags and plugins with manifest_sync.py, which only
+# downloads objects changed since the previous run, instead of gsutil rsync.
+SYNC_ENGINE=${SYNC_ENGINE:-gsutil}
+# Set to "TRUE" to byte-compile changed dags and plugins after each sync.
+PYC_WARMUP=${PYC_WARMUP:-FALSE}
 
 # Timeout after 1h to prevent the extremely rare situation where gsutil process
 # is stuck. Note that gsutil syncs 1000 objects at once with an average speed of
 # O(10MBPS), 1h should be a very safe upper-bound.
 GSUTIL_SYNC_TIMEOUT=60m
+# Timeout of a whole job run in sync_supervisor.py, in seconds. Leaves room for
+# the two gsutil_sync calls and for the kill grace of timeout_sync.
+JOB_TIMEOUT=7500
 timeout_sync() {
   timeout --preserve-status -k 10 ${GSUTIL_SYNC_TIMEOUT} $@
 }
 
 gsutil_sync() {
+  if [[ "${SYNC_ENGINE}" == "manifest" ]]; then
+    compile_flag=""
+    if [[ "${PYC_WARMUP}" == "TRUE" ]]; then
+      compile_flag="--compile"
+    fi
+    timeout_sync python /var/local/manifest_sync.py ${compile_flag} "gs://${GCS_BUCKET}/dags" "${base_dir}/dags"
+    timeout_sync python /var/local/manifest_sync.py ${compile_flag} "gs://${GCS_BUCKET}/plugins" "${base_dir}/plugins"
+    return
+  fi
+  if [[ "${PYC_WARMUP}" == "TRUE" ]]; then
+    # Keep rsync -d from deleting the bytecode, which is not in the bucket.
+    timeout_sync gsutil -m rsync -d -r -x '(.*/)?__pycache__/.*|.*\.pyc$' "gs://${GCS_BUCKET}/dags" "${base_dir}/dags"
+    timeout_sync gsutil -m rsync -d -r -x '(.*/)?__pycache__/.*|.*\.pyc$' "gs://${GCS_BUCKET}/plugins" "${base_dir}/plugins"
+    python /var/local/pyc_warmup.py "${base_dir}/dags" "${base_dir}/plugins"
+    return
+  fi
   timeout_sync gsutil -m rsync -d -r "gs://${GCS_BUCKET}/dags" "${base_dir}/dags"
   timeout_sync gsutil -m rsync -d -r "gs://${GCS_BUCKET}/plugins" "${base_dir}/plugins"
 }
 
 tenant_bucket_exists() {
-  if [[ "${GCS_TENANT_BUCKET_EXISTS}" != "TRUE" ]]; then
+  # Once the bucket exists it is not listed again until syncd restarts.
+  marker="${SYNC_STATE_DIR}/tenant_bucket_exists_${GCS_TENANT_BUCKET}"
+  if [[ ! -f "${marker}" ]]; then
     timeout_sync gsutil ls "gs://${GCS_TENANT_BUCKET}" > /dev/null 2>&1
     if [[ $? -eq 0 ]]; then
-      GCS_TENANT_BUCKET_EXISTS="TRUE"
+      mkdir -p "${SYNC_STATE_DIR}" && touch "${marker}"
+    else
+      return 1
     fi
   fi
-  [[ "${GCS_TENANT_BUCKET_EXISTS}" == "TRUE" ]]
 }
 
 gsutil_sync_to_tenant() {
@@ -36,15 +67,15 @@ gsutil_sync_to_tenant() {
 }
 
 sync_sql_ip_address() {
-  # We run this in the background because it can be a long running task. We do
-  # not want it to slow down gsutil_sync.
   if [[ ${SQL_SUBNET} ]]; then
     echo "Searching for SQL IP Address."
     python /var/local/sync_sql_ip.py \
       --cidr $SQL_SUBNET \
       --sql_database $SQL_DATABASE \
       --sql_user $SQL_USER \
-      --sql_password=$SQL_PASSWORD &
+      --sql_password=$SQL_PASSWORD \
+      --concurrency $SQL_SCAN_CONCURRENCY \
+      --cache_file $SQL_ADDRESS_CACHE
   fi
 }
 
@@ -52,12 +83,30 @@ get_kube_config() {
     /var/local/init_kube.sh
 }
 
-if [[ $# -ne 1 ]]; then
-  echo "Usage: sync.sh airflow-local-base-dir"
+if [[ $# -lt 1 || $# -gt 2 ]]; then
+  echo "Usage: sync.sh airflow-local-base-dir [job]"
   exit 1
 fi
 base_dir=$1
+
+# sync_supervisor.py calls back into this script to run a single job.
+if [[ $# -eq 2 ]]; then
+  case "$2" in
+    gsutil_sync|gsutil_sync_to_tenant|get_kube_config|sync_sql_ip_address)
+      "$2"
+      exit $?
+      ;;
+    *)
+      echo "Unknown job: $2"
+      exit 1
+      ;;
+  esac
+fi
+
 echo "Using base dir: ${base_dir}"
+# Start from a clean job state, e.g. if the container restarted.
+mkdir -p "${SYNC_STATE_DIR}"
+rm -f "${SYNC_STATE_DIR}"/tenant_bucket_exists_*
 folders=("dags" "plugins")
 # Create local directories if not exist.
 for folder in "${folders[@]}"; do
@@ -69,22 +118,16 @@ for folder in "${folders[@]}"; do
 done
 
 # Periodically rsync gcs bucket to local drive (and to tenant bucket, if
-# configured). If needed, update SQL IP address.
-TIME_ELAPSED=0
-while true; do
-  echo "Syncing GCS bucket."
-  gsutil_sync
-  if [[ ! -z "${GCS_TENANT_BUCKET}" ]]; then
-    echo "Syncing to GCS tenant bucket."
-    gsutil_sync_to_tenant
-  fi
-  if ! (($TIME_ELAPSED % $KUBE_CREDENTIALS_REFRESH_FREQUENCY)); then
-    get_kube_config
-  fi
-  if ! (($TIME_ELAPSED % $SQL_IP_SEARCH_FREQUENCY)); then
-    sync_sql_ip_address
-  fi
-  # Sleep and increment timer.
-  sleep 10
-  TIME_ELAPSED=$(((TIME_ELAPSED+10) % MAX_TIME_ELAPSED_VALUE))
-done
+# configured), refresh the kube config and, if needed, update SQL IP address.
+# Every job runs on its own schedule, so a slow tenant sync or SQL scan does not
+# delay the DAG sync, and a job never overlaps with itself.
+self="$(cd "$(dirname "$0")" && pwd)/$(basename "$0")"
+jobs=(--job gcs_sync ${GCS_SYNC_FREQUENCY} ${JOB_TIMEOUT} "${self} ${base_dir} gsutil_sync")
+if [[ ! -z "${GCS_TENANT_BUCKET}" ]]; then
+  jobs+=(--job tenant_sync ${GCS_SYNC_FREQUENCY} ${JOB_TIMEOUT} "${self} ${base_dir} gsutil_sync_to_tenant")
+fi
+jobs+=(--job kube_config ${KUBE_CREDENTIALS_REFRESH_FREQUENCY} 300 "${self} ${base_dir} get_kube_config")
+if [[ ${SQL_SUBNET} ]]; then
+  jobs+=(--job sql_ip ${SQL_IP_SEARCH_FREQUENCY} 600 "${self} ${base_dir} sync_sql_ip_address")
+fi
+exec python /var/local/sync_supervisor.py --status_file "${SYNCD_STATUS_FILE}" "${jobs[@]}"
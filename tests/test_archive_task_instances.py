@@ -0,0 +1,126 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for archive_task_instances against a SQLite task_instance table."""
+
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import create_engine
+from sqlalchemy import inspect
+from sqlalchemy import select
+
+import archive_task_instances
+
+NOW = datetime(2019, 6, 1)
+CUTOFF = NOW - timedelta(days=30)
+OLD = NOW - timedelta(days=60)
+
+
+@pytest.fixture
+def engine(tmpdir):
+  engine = create_engine('sqlite:///{}'.format(tmpdir.join('airflow.db')))
+  Table('task_instance', MetaData(),
+        Column('task_id', String(250), primary_key=True),
+        Column('dag_id', String(250), primary_key=True),
+        Column('execution_date', DateTime, primary_key=True),
+        Column('start_date', DateTime),
+        Column('end_date', DateTime),
+        Column('state', String(20)),
+        Column('try_number', Integer)).create(bind=engine)
+  return engine
+
+
+def _insert(engine, rows):
+  table = archive_task_instances.reflect_tables(engine, create_archive=False)[0]
+  engine.execute(table.insert(), [
+      {'dag_id': dag_id, 'task_id': task_id, 'execution_date': execution_date,
+       'end_date': end_date, 'state': state, 'try_number': 1}
+      for dag_id, task_id, execution_date, end_date, state in rows])
+
+
+def _keys(engine, table_name):
+  table = Table(table_name, MetaData(), autoload=True, autoload_with=engine)
+  return sorted((row['dag_id'], row['task_id'])
+                for row in engine.execute(select([table])))
+
+
+def _old_tasks(count, state='success'):
+  return [('dag', 'task_{:02d}'.format(i), OLD + timedelta(hours=i),
+           OLD + timedelta(hours=i, minutes=5), state) for i in range(count)]
+
+
+def test_archives_only_old_finished_tasks(engine):
+  _insert(engine, _old_tasks(3) + [
+      ('dag', 'running', OLD, None, 'running'),
+      ('dag', 'recent', NOW, NOW, 'success'),
+      ('dag', 'no_end_date', OLD, None, 'upstream_failed')])
+  summary = archive_task_instances.Archiver(
+      engine, CUTOFF, batch_size=2, sleep=0).run()
+  assert summary['archived'] == 4
+  assert summary['batches'] == 2
+  assert summary['finished']
+  assert _keys(engine, 'task_instance') == [('dag', 'recent'),
+                                            ('dag', 'running')]
+  assert len(_keys(engine, 'task_instance_archive')) == 4
+
+
+def test_resumes_from_the_checkpoint(engine, tmpdir):
+  checkpoint = str(tmpdir.join('checkpoint.json'))
+  _insert(engine, _old_tasks(5))
+  archiver = archive_task_instances.Archiver(
+      engine, CUTOFF, batch_size=2, sleep=0)
+  summary = archiver.run(checkpoint_file=checkpoint, max_batches=1)
+  assert summary['archived'] == 2
+  assert not summary['finished']
+  last_key = archive_task_instances.read_checkpoint(checkpoint)
+  assert last_key[:2] == ('dag', 'task_01')
+
+  summary = archiver.run(last_key, checkpoint_file=checkpoint)
+  assert summary['archived'] == 3
+  assert summary['finished']
+  assert not tmpdir.join('checkpoint.json').exists()
+  assert not _keys(engine, 'task_instance')
+
+
+def test_rows_already_in_the_archive_do_not_block(engine):
+  _insert(engine, _old_tasks(3))
+  archiver = archive_task_instances.Archiver(
+      engine, CUTOFF, batch_size=10, sleep=0)
+  # As after a run that copied a row but did not delete it.
+  live = archiver.live
+  engine.execute(archiver.archive.insert(), [
+      dict(row) for row in engine.execute(
+          select([live]).where(live.c.task_id == 'task_01'))])
+  assert archiver.run()['archived'] == 3
+  assert archiver.run()['archived'] == 0
+  assert len(_keys(engine, 'task_instance_archive')) == 3
+
+
+def test_dry_run_writes_nothing(engine, tmpdir):
+  checkpoint = str(tmpdir.join('checkpoint.json'))
+  _insert(engine, _old_tasks(3))
+  summary = archive_task_instances.Archiver(
+      engine, CUTOFF, batch_size=2, sleep=0, dry_run=True).run(
+          checkpoint_file=checkpoint)
+  assert summary['would_archive'] == 3
+  assert len(_keys(engine, 'task_instance')) == 3
+  assert 'task_instance_archive' not in inspect(engine).get_table_names()
+  assert not tmpdir.join('checkpoint.json').exists()
@@ -0,0 +1,51 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for autoscaler.ScalingPolicy."""
+
+import pytest
+
+import autoscaler
+
+
+def _steady(load):
+  return {'queued': 0, 'running': load, 'arrivals': 0, 'completions': 0,
+          'window': 60}
+
+
+def _settle(policy, load, current, steps=20, period=60):
+  for step in range(steps):
+    current = policy.desired_replicas(_steady(load), current, step * period)
+  return current
+
+
+@pytest.mark.parametrize('load,expected', [(8, 2), (15, 3), (0, 1)])
+def test_scales_down_to_the_smallest_fitting_deployment(load, expected):
+  policy = autoscaler.ScalingPolicy(max_replicas=5, tasks_per_worker=8,
+                                    scale_down_cooldown=300,
+                                    scale_down_utilization=0.8)
+  assert _settle(policy, load, current=5) == expected
+
+
+def test_scale_down_waits_for_the_cooldown():
+  policy = autoscaler.ScalingPolicy(max_replicas=5, tasks_per_worker=8,
+                                    scale_down_cooldown=300)
+  assert policy.desired_replicas(_steady(40), 1, 0) == 5
+  assert policy.desired_replicas(_steady(8), 5, 60) == 5
+  assert policy.desired_replicas(_steady(8), 5, 299) == 5
+  assert policy.desired_replicas(_steady(8), 5, 300) == 2
+
+
+def test_scales_up_at_once():
+  policy = autoscaler.ScalingPolicy(max_replicas=5, tasks_per_worker=8)
+  assert policy.desired_replicas(_steady(20), 1, 0) == 3
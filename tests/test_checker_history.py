@@ -0,0 +1,91 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for checker_history."""
+
+import checker_history
+
+BAD = {'scheduled': 0, 'queued': 3, 'running': 0, 'recently_done': 0}
+GOOD = {'scheduled': 0, 'queued': 3, 'running': 1, 'recently_done': 0}
+
+
+def _in_error(counts):
+  return counts['queued'] > 0 and counts['running'] == 0
+
+
+def _probe(tmpdir, grace, period, duration, counts=BAD):
+  history = checker_history.History(
+      str(tmpdir.join('history')), checker_history.capacity_for(grace, period))
+  snapshots = []
+  for step in range(int(duration / period) + 1):
+    snapshots = history.append(counts, timestamp=step * period)
+  return snapshots, step * period
+
+
+def test_short_probe_period_still_covers_grace(tmpdir):
+  snapshots, now = _probe(tmpdir, grace=300, period=2, duration=310)
+  assert checker_history.is_stuck(snapshots, _in_error, 300, now=now)
+
+
+def test_not_stuck_before_grace_elapsed(tmpdir):
+  snapshots, now = _probe(tmpdir, grace=300, period=2, duration=290)
+  assert not checker_history.is_stuck(snapshots, _in_error, 300, now=now)
+
+
+def test_not_stuck_when_any_snapshot_is_healthy(tmpdir):
+  snapshots, now = _probe(tmpdir, grace=300, period=10, duration=400)
+  snapshots[-5] = (snapshots[-5][0], GOOD)
+  assert not checker_history.is_stuck(snapshots, _in_error, 300, now=now)
+
+
+def test_single_bad_snapshot_after_a_gap_is_not_stuck():
+  snapshots = [(0, GOOD), (1000, BAD)]
+  assert not checker_history.is_stuck(snapshots, _in_error, 300, now=1000)
+
+
+def test_gap_within_the_window_is_not_stuck():
+  snapshots = [(0, BAD), (10, BAD), (250, BAD), (300, BAD)]
+  assert not checker_history.is_stuck(snapshots, _in_error, 300,
+                                      max_gap=60, now=300)
+  assert checker_history.is_stuck(snapshots, _in_error, 300,
+                                   max_gap=240, now=300)
+
+
+def test_history_keeps_capacity_snapshots(tmpdir):
+  history = checker_history.History(str(tmpdir.join('history')), 3)
+  for step in range(5):
+    snapshots = history.append(BAD, timestamp=step)
+  assert [timestamp for timestamp, _ in snapshots] == [2, 3, 4]
+  assert history.snapshots() == snapshots
+
+
+def _trend(queued, running, recently_done):
+  return [(float(i), {'scheduled': 0, 'queued': q, 'running': r,
+                      'recently_done': d})
+          for i, (q, r, d) in enumerate(zip(queued, running, recently_done))]
+
+
+def test_growing_backlog_with_steady_throughput_is_not_degraded():
+  snapshots = _trend([10, 20, 30, 40, 50], [8] * 5, [100] * 5)
+  assert not checker_history.is_degraded(snapshots, 10, now=4)
+
+
+def test_saturated_host_finishing_fewer_tasks_is_degraded():
+  snapshots = _trend([10, 20, 30, 40, 50], [8] * 5, [100, 90, 80, 70, 60])
+  assert checker_history.is_degraded(snapshots, 10, now=4)
+
+
+def test_host_running_fewer_tasks_is_not_degraded():
+  snapshots = _trend([10, 20, 30, 40, 50], [8, 6, 4, 2, 1],
+                     [100, 90, 80, 70, 60])
+  assert not checker_history.is_degraded(snapshots, 10, now=4)
@@ -0,0 +1,165 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the checker_lib task counts on the core backend."""
+
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import and_
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import select
+
+import checker_core
+import checker_lib
+
+# On a bucket boundary, so that the window edges are bucket edges too.
+NOW = datetime(2018, 6, 1, 12, 0, 0)
+OTHER_HOST = 'airflow-worker-other'
+
+
+class Clock(object):
+
+  def __init__(self):
+    self.now = NOW
+
+  def __call__(self):
+    return self.now
+
+
+class TaskInstances(object):
+  """Inserts task instances and holds the clock checker_lib reads."""
+
+  def __init__(self, engine, clock):
+    self.engine = engine
+    self.clock = clock
+    self._tasks = 0
+
+  def add(self, state, hostname=None, end_date=None):
+    self._tasks += 1
+    self.engine.execute(checker_core.task_instance.insert().values(
+        task_id='task_{}'.format(self._tasks), dag_id='dag',
+        execution_date=NOW, state=state,
+        hostname=hostname or checker_lib.host_name, end_date=end_date))
+
+
+@pytest.fixture
+def db(monkeypatch):
+  engine = create_engine('sqlite://')
+  checker_core.metadata.create_all(engine)
+  monkeypatch.setenv(checker_lib.BACKEND_ENV_KEY, checker_lib.CORE_BACKEND)
+  monkeypatch.setattr(checker_core, '_engine', engine)
+  clock = Clock()
+  monkeypatch.setattr(checker_lib, '_utcnow', clock)
+  return TaskInstances(engine, clock)
+
+
+def per_state_counts(engine, since, use_host_name):
+  """Counts each state with its own COUNT(*) query."""
+  ti = checker_core.task_instance.c
+  on_host = [ti.hostname == checker_lib.host_name] if use_host_name else []
+
+  def count(*conditions):
+    return engine.execute(
+        select([func.count()]).where(and_(*conditions))).scalar()
+
+  return {
+      'scheduled': count(ti.state == 'scheduled'),
+      'queued': count(ti.state == 'queued'),
+      'running': count(ti.state == 'running', *on_host),
+      'recently_done': count(ti.state.in_(checker_lib.DONE_STATES),
+                             ti.end_date > since, *on_host),
+  }
+
+
+def aggregated_counts(engine, since, use_host_name):
+  row = engine.execute(checker_lib.task_count_statement(
+      checker_core.task_instance.c, since, use_host_name)).fetchone()
+  return dict(row)
+
+
+def add_mixed_tasks(db):
+  for state in ('scheduled', 'queued', 'queued', 'up_for_reschedule'):
+    db.add(state)
+  db.add('running')
+  db.add('running', hostname=OTHER_HOST)
+  for minutes, state, hostname in ((2, 'success', None),
+                                   (5, 'failed', None),
+                                   (8, 'up_for_retry', OTHER_HOST),
+                                   (30, 'success', None),
+                                   (45, 'failed', OTHER_HOST)):
+    db.add(state, hostname=hostname,
+           end_date=NOW - timedelta(minutes=minutes, seconds=5))
+
+
+@pytest.mark.parametrize('use_host_name', [True, False])
+def test_aggregated_counts_match_per_state_counts(db, use_host_name):
+  add_mixed_tasks(db)
+  since = NOW - checker_lib.RECENTLY_DONE_WINDOW
+  expected = per_state_counts(db.engine, since, use_host_name)
+  assert aggregated_counts(db.engine, since, use_host_name) == expected
+  assert checker_lib.task_count_by_state(use_host_name) == expected
+
+
+@pytest.mark.parametrize('use_host_name', [True, False])
+def test_no_matching_rows_count_as_zero(db, use_host_name):
+  since = NOW - checker_lib.RECENTLY_DONE_WINDOW
+  zeros = {'scheduled': 0, 'queued': 0, 'running': 0, 'recently_done': 0}
+  # Empty table: the SUMs of no rows are NULL.
+  assert set(aggregated_counts(
+      db.engine, since, use_host_name).values()) == set([None])
+  assert checker_lib.task_count_by_state(use_host_name) == zeros
+  db.add('success', end_date=NOW - timedelta(hours=1))
+  assert checker_lib.task_count_by_state(use_host_name) == zeros
+  assert per_state_counts(db.engine, since, use_host_name) == zeros
+
+
+def test_recently_done_counter_matches_the_query(db):
+  add_mixed_tasks(db)
+  counter = checker_lib.RecentlyDoneCounter(resync_every=3)
+
+  def expected():
+    return checker_lib.task_count_by_state(True)['recently_done']
+
+  # Full fetch.
+  assert counter.count() == expected() == 2
+  # New completions, fetched above the high-water marks.
+  db.clock.now = NOW + timedelta(seconds=10)
+  db.add('success', end_date=NOW + timedelta(seconds=5))
+  db.add('up_for_retry', end_date=NOW + timedelta(seconds=6))
+  db.add('success', hostname=OTHER_HOST, end_date=NOW + timedelta(seconds=7))
+  assert counter.count() == expected() == 4
+  # The completion 5m5s ago leaves the window, its bucket expires.
+  db.clock.now = NOW + timedelta(minutes=5, seconds=10)
+  assert counter.count() == expected() == 3
+  # A completion that becomes visible below the high-water mark is only
+  # picked up by the resync.
+  db.add('success', end_date=NOW - timedelta(minutes=1, seconds=5))
+  assert counter.count() == expected() == 4
+
+
+def test_failed_fleet_status_write_leaves_no_temporary_file(tmpdir):
+  fleet_counts = {'scheduled': 0, 'queued': 1, 'hosts': {
+      OTHER_HOST: {'running': 0, 'recently_done': 0}}}
+  status_path = tmpdir.join('fleet_status.json')
+  checker_lib.write_fleet_status(str(status_path), fleet_counts)
+  assert checker_lib.read_fleet_status(str(status_path), 60)['hosts'][
+      OTHER_HOST]['error']
+  # Renaming a file onto a non-empty directory fails.
+  status_path.remove()
+  status_path.mkdir().join('keep').write('')
+  with pytest.raises(OSError):
+    checker_lib.write_fleet_status(str(status_path), fleet_counts)
+  assert tmpdir.listdir() == [status_path]
@@ -0,0 +1,85 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for concurrency_tuner."""
+
+import pytest
+
+import concurrency_tuner
+
+
+@pytest.mark.parametrize('task_cpu', [0.1, 0.2, 0.5, 1.0])
+def test_defaults_keep_up_with_a_fixed_pool(task_cpu):
+  summary = concurrency_tuner.simulate(
+      concurrency_tuner.SimulatedWorker(task_cpu=task_cpu),
+      concurrency_tuner.ConcurrencyPolicy(), initial=16, steps=120,
+      interval=60)
+  assert summary['completed'] >= 0.99 * summary['completed_fixed']
+
+
+def test_backs_off_before_running_out_of_memory():
+  summary = concurrency_tuner.simulate(
+      concurrency_tuner.SimulatedWorker(task_memory=0.06),
+      concurrency_tuner.ConcurrencyPolicy(), initial=16, steps=120,
+      interval=60)
+  assert summary['completed_fixed'] == 0
+  assert summary['completed'] > 0
+  assert summary['final_concurrency'] < 14
+
+
+def test_busy_cpu_stops_growth_without_shrinking():
+  policy = concurrency_tuner.ConcurrencyPolicy(cooldown=0)
+  sample = {'running': 8, 'completion_rate': 1.0, 'cpu': 1.0, 'memory': 0.5}
+  assert policy.desired_concurrency(sample, 8, 0) == 8
+  sample['cpu'] = 0.5
+  assert policy.desired_concurrency(sample, 8, 60) == 10
+
+
+class FakeControl(object):
+  """A Celery control for one prefork worker, configured with 4 slots."""
+
+  def __init__(self, processes=4):
+    self.processes = processes
+
+  def inspect(self, destination):
+    control = self
+
+    class Inspect(object):
+
+      def stats(self):
+        return {destination[0]: {'pool': {
+            'max-concurrency': 4,
+            'processes': list(range(control.processes)),
+        }}}
+
+    return Inspect()
+
+  def pool_grow(self, n, destination):
+    self.processes += n
+
+  def pool_shrink(self, n, destination):
+    self.processes -= n
+
+
+def test_pool_reads_the_resized_pool():
+  control = FakeControl()
+  pool = concurrency_tuner.CeleryPool(hostname='worker-1', control=control)
+  policy = concurrency_tuner.ConcurrencyPolicy(max_concurrency=8, cooldown=0)
+  for i in range(10):
+    current = pool.concurrency()
+    sample = {'running': current, 'completion_rate': float(current),
+              'cpu': 0.5, 'memory': 0.5}
+    pool.resize(current, policy.desired_concurrency(sample, current, i * 60))
+  assert pool.concurrency() == control.processes == 8
+  pool.resize(8, 5)
+  assert pool.concurrency() == 5
@@ -0,0 +1,62 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the connection resolution of db_run."""
+
+import pytest
+
+import db_run
+import instrumentation
+
+
+class FakeConnUtils(object):
+
+  def __init__(self, results):
+    self.results = results
+
+  def find_working_connection(self, unused_cidr_block):
+    return self.results.pop(0)
+
+
+@pytest.fixture
+def resolution(monkeypatch):
+  monkeypatch.setenv('SQL_SUBNET', '10.0.0.0/29')
+  monkeypatch.setattr(db_run.time, 'sleep', lambda seconds: None)
+  instrumentation.configure(instrumentation.JSON_OUTPUT)
+  monkeypatch.setattr(instrumentation, '_timers', {})
+  yield monkeypatch
+  instrumentation.configure(None)
+
+
+def _resolve_sources():
+  return sorted(key for key in instrumentation.json_record()['timers']
+                if key.startswith('db_resolve{'))
+
+
+def test_scan_after_a_missing_resolver_file_is_labelled_scan(resolution):
+  utils = FakeConnUtils([None, 'mysql://10.0.0.3/airflow'])
+  resolution.setattr(db_run, '_make_conn_utils', lambda db_env: utils)
+  resolution.setattr(db_run, '_read_resolver_file', lambda: None)
+  db_env = db_run._generate_env()
+  assert db_env[db_run.AIRFLOW_CONNECTION_ENV_KEY] == 'mysql://10.0.0.3/airflow'
+  assert _resolve_sources() == ['db_resolve{source=scan}']
+
+
+def test_resolver_file_after_a_failed_scan_is_labelled_resolver(resolution):
+  published = iter([None, 'mysql://10.0.0.4/airflow'])
+  resolution.setattr(db_run, '_make_conn_utils',
+                     lambda db_env: FakeConnUtils([None]))
+  resolution.setattr(db_run, '_read_resolver_file', lambda: next(published))
+  db_env = db_run._generate_env()
+  assert db_env[db_run.AIRFLOW_CONNECTION_ENV_KEY] == 'mysql://10.0.0.4/airflow'
+  assert _resolve_sources() == ['db_resolve{source=resolver}']
@@ -0,0 +1,49 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the openmetrics output of instrumentation."""
+
+import os
+
+import pytest
+
+import instrumentation
+
+
+@pytest.fixture
+def textfile_dir(tmpdir, monkeypatch):
+  monkeypatch.setattr(instrumentation, '_textfile_dir',
+                      instrumentation._textfile_dir)
+  monkeypatch.setattr(instrumentation, '_counters', {})
+  instrumentation.configure(instrumentation.OPENMETRICS_OUTPUT,
+                            textfile_dir=str(tmpdir), component='probe')
+  instrumentation.count('sql_probe', outcome='ok')
+  yield tmpdir
+  instrumentation.configure(None)
+
+
+def test_flush_writes_the_textfile(textfile_dir):
+  instrumentation.flush()
+  assert os.listdir(str(textfile_dir)) == ['probe.prom']
+  assert 'sql_probe' in textfile_dir.join('probe.prom').read()
+
+
+def test_failed_flush_at_exit_is_reported(textfile_dir, monkeypatch, capsys):
+
+  def rename(unused_src, unused_dst):
+    raise OSError('read-only file system')
+
+  monkeypatch.setattr(instrumentation.os, 'rename', rename)
+  instrumentation._flush_and_report()
+  assert 'read-only file system' in capsys.readouterr().err
+  assert not os.listdir(str(textfile_dir))
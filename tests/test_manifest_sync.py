@@ -0,0 +1,135 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for manifest_sync.ManifestSync against local directories."""
+
+import os
+
+import manifest_sync
+import pyc_warmup
+
+
+def _write(root, path, content):
+  full_path = root.join(*path.split('/'))
+  full_path.write(content, ensure=True)
+  return str(full_path)
+
+
+def _files(root):
+  files = []
+  for dirpath, _, filenames in os.walk(str(root)):
+    for filename in filenames:
+      files.append(os.path.relpath(os.path.join(dirpath, filename),
+                                   str(root)).replace(os.sep, '/'))
+  return sorted(files)
+
+
+def _sync(src, dst, storage=None):
+  return manifest_sync.ManifestSync(
+      storage or manifest_sync.LocalDirStorage(str(src)), str(dst)).sync()
+
+
+def test_downloads_only_changed_objects(tmpdir):
+  src, dst = tmpdir.join('src'), tmpdir.join('dst')
+  _write(src, 'a.py', 'a = 1\n')
+  _write(src, 'sub/b.py', 'b = 1\n')
+  assert _sync(src, dst).changed == ['a.py', 'sub/b.py']
+
+  _write(src, 'sub/b.py', 'b = 22\n')
+  result = _sync(src, dst)
+  assert result.changed == ['sub/b.py']
+  assert dst.join('sub', 'b.py').read() == 'b = 22\n'
+  assert not _sync(src, dst).changed
+
+
+def test_restores_locally_removed_files(tmpdir):
+  src, dst = tmpdir.join('src'), tmpdir.join('dst')
+  _write(src, 'a.py', 'a = 1\n')
+  _sync(src, dst)
+  dst.join('a.py').remove()
+  assert _sync(src, dst).changed == ['a.py']
+
+
+def test_deletes_removed_objects_with_their_bytecode(tmpdir):
+  src, dst = tmpdir.join('src'), tmpdir.join('dst')
+  _write(src, 'a.py', 'a = 1\n')
+  _write(src, 'sub/b.py', 'b = 1\n')
+  _sync(src, dst)
+  pyc_warmup.compile_sources(
+      [str(dst.join('a.py')), str(dst.join('sub', 'b.py'))], processes=1)
+
+  src.join('sub', 'b.py').remove()
+  result = _sync(src, dst)
+  assert result.deleted == ['sub/b.py']
+  assert not dst.join('sub').exists()
+  assert _files(dst) == sorted([
+      manifest_sync.MANIFEST_NAME, 'a.py',
+      os.path.relpath(pyc_warmup.cache_path(str(dst.join('a.py'))),
+                      str(dst)).replace(os.sep, '/')])
+
+
+def test_first_run_deletes_files_missing_from_the_source(tmpdir):
+  src, dst = tmpdir.join('src'), tmpdir.join('dst')
+  _write(src, 'dag.py', 'x = 1\n')
+  _write(dst, 'dag.py', 'x = 0\n')
+  old_dag = _write(dst, 'old_dag.py', 'y = 1\n')
+  _write(dst, 'old/nested.txt', 'z')
+  pyc_warmup.compile_sources([old_dag], processes=1)
+  # Bytecode left behind by a source deleted before the migration.
+  _write(dst, 'sub/__pycache__/b.cpython-37.pyc', 'stale')
+
+  result = _sync(src, dst)
+  assert result.deleted == ['old/nested.txt', 'old_dag.py']
+  assert _files(dst) == [manifest_sync.MANIFEST_NAME, 'dag.py']
+  assert dst.join('dag.py').read() == 'x = 1\n'
+  assert not _sync(src, dst).deleted
+
+
+def test_rejects_unsafe_object_names(tmpdir):
+  dst = tmpdir.join('dst')
+
+  class UnsafeStorage(manifest_sync.Storage):
+
+    def list_versions(self):
+      return {'../escaped.py': '1', '/etc/absolute.py': '1',
+              'sub/../../up.py': '1', 'ok..py': '1'}
+
+    def download(self, path, destination):
+      with open(destination, 'w') as destination_file:
+        destination_file.write(path)
+
+  result = _sync(None, dst, UnsafeStorage())
+  assert sorted(result.failed) == [
+      '../escaped.py', '/etc/absolute.py', 'sub/../../up.py']
+  assert result.changed == ['ok..py']
+  assert sorted(os.listdir(str(tmpdir))) == ['dst']
+  assert 'ok..py' in manifest_sync.ManifestSync(
+      None, str(dst)).read_manifest()
+
+
+def test_retries_failed_downloads(tmpdir):
+  src, dst = tmpdir.join('src'), tmpdir.join('dst')
+  _write(src, 'a.py', 'a = 1\n')
+  storage = manifest_sync.LocalDirStorage(str(src))
+  download = storage.download
+
+  def failing_download(path, destination):
+    raise IOError('transient')
+
+  storage.download = failing_download
+  result = _sync(src, dst, storage)
+  assert list(result.failed) == ['a.py']
+  assert _files(dst) == [manifest_sync.MANIFEST_NAME]
+
+  storage.download = download
+  assert _sync(src, dst, storage).changed == ['a.py']
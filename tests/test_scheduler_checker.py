@@ -0,0 +1,66 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for scheduler_checker."""
+
+import sys
+
+import pytest
+
+import scheduler_checker
+
+
+@pytest.fixture
+def composer_env(monkeypatch):
+  for key in (scheduler_checker.GCP_PROJECT,
+              scheduler_checker.COMPOSER_LOCATION,
+              scheduler_checker.COMPOSER_ENVIRONMENT):
+    monkeypatch.setenv(key, 'test')
+
+
+def test_logging_api_failure_is_unknown_freshness(composer_env, monkeypatch,
+                                                  tmpdir):
+  source = scheduler_checker.StackdriverSource(
+      exclusion_cache_path=str(tmpdir.join('exclusion.json')))
+
+  def fail():
+    raise ImportError('No module named google.cloud')
+
+  monkeypatch.setattr(source, '_latest_log_timestamp', fail)
+  assert source.latest_timestamp() is None
+  assert scheduler_checker.is_fresh(source, 300)
+
+
+def test_file_source_requires_heartbeat_file(monkeypatch):
+  monkeypatch.setattr(sys, 'argv', ['scheduler_checker.py', '--source', 'file'])
+  with pytest.raises(SystemExit) as exit_info:
+    scheduler_checker.main()
+  assert exit_info.value.code == 2
+
+
+def test_missing_env_var_fails_with_message(monkeypatch):
+  monkeypatch.delenv(scheduler_checker.GCP_PROJECT, raising=False)
+  monkeypatch.setattr(sys, 'argv', ['scheduler_checker.py'])
+  with pytest.raises(SystemExit) as exit_info:
+    scheduler_checker.main()
+  assert 'GCP_PROJECT' in str(exit_info.value.code)
+
+
+def test_stage_keeps_system_exit():
+  def exit_stage():
+    sys.exit('bad configuration')
+
+  stage = scheduler_checker.Stage('exit', exit_stage)
+  assert scheduler_checker.run_stages([stage], 5) == []
+  assert isinstance(stage.error, SystemExit)
+  assert stage.error.code == 'bad configuration'
@@ -0,0 +1,100 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for sync_sql_ip.ServiceReconciler."""
+
+import pytest
+
+pytest.importorskip('kubernetes')
+
+from kubernetes import client as k8s_client
+
+import sync_sql_ip
+
+
+class FakeApi(object):
+  """Holds a single ExternalName Service."""
+
+  def __init__(self, external_name):
+    self.external_name = external_name
+    self.patches = []
+
+  def service(self):
+    return k8s_client.V1Service(spec=k8s_client.V1ServiceSpec(
+        type='ExternalName', external_name=self.external_name))
+
+  def read_namespaced_service(self, unused_name, unused_namespace):
+    return self.service()
+
+  def patch_namespaced_service(self, unused_name, unused_namespace, body):
+    self.patches.append(body.spec.external_name)
+    self.external_name = body.spec.external_name
+
+  def list_namespaced_service(self, *unused_args, **unused_kwargs):
+    raise NotImplementedError()
+
+
+class StopWatching(BaseException):
+  """Ends a watch loop; not caught by its error handling."""
+
+
+def test_reconcile_patches_only_on_change():
+  api = FakeApi('10.0.0.5')
+  reconciler = sync_sql_ip.ServiceReconciler(api=api)
+  assert not reconciler.reconcile('10.0.0.5')
+  assert reconciler.reconcile('10.0.0.7')
+  assert api.patches == ['10.0.0.7']
+  assert not reconciler.reconcile('10.0.0.7')
+
+
+def test_watch_reconciles_on_events(monkeypatch):
+  api = FakeApi('10.0.0.5')
+
+  class FakeWatch(object):
+
+    def stream(self, *unused_args, **unused_kwargs):
+      yield {'type': 'MODIFIED', 'object': api.service()}
+      yield {'type': 'DELETED', 'object': None}
+
+  monkeypatch.setattr(sync_sql_ip.k8s_watch, 'Watch', FakeWatch)
+  # Answers the initial lookup and the MODIFIED event, then ends the watch at
+  # the start of the next watch request.
+  addresses = iter(['10.0.0.5', '10.0.0.9'])
+
+  def find_address():
+    for address in addresses:
+      return address
+    raise StopWatching()
+
+  with pytest.raises(StopWatching):
+    sync_sql_ip.ServiceReconciler(api=api).watch(find_address)
+  assert api.patches == ['10.0.0.9']
+
+
+def test_watch_survives_lookup_errors(monkeypatch):
+  api = FakeApi('10.0.0.5')
+  sleeps = []
+
+  def sleep(seconds):
+    sleeps.append(seconds)
+    if len(sleeps) == 2:
+      raise StopWatching()
+
+  def find_address():
+    raise RuntimeError('DB unreachable')
+
+  monkeypatch.setattr(sync_sql_ip.time, 'sleep', sleep)
+  with pytest.raises(StopWatching):
+    sync_sql_ip.ServiceReconciler(api=api).watch(find_address)
+  assert sleeps == [sync_sql_ip.CONNECT_TIMEOUT] * 2
+  assert not api.patches
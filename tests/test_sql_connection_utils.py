@@ -0,0 +1,132 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the address cache and scan of sync_sql_ip.SqlConnectionUtils."""
+
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('kubernetes')
+
+import sync_sql_ip
+
+
+class ProbedUtils(sync_sql_ip.SqlConnectionUtils):
+  """Answers probes from a set of working addresses instead of the network."""
+
+  def __init__(self, working, **kwargs):
+    super(ProbedUtils, self).__init__(
+        sync_sql_ip.SqlCredentials('airflow', 'user', 'password'),
+        reconciler=object(), **kwargs)
+    self.working = set(working)
+    self.probed = []
+
+  def _is_working_address(self, address):
+    self.probed.append(str(address))
+    return str(address) in self.working
+
+  def _handshake(self, address):
+    return self._is_working_address(address)
+
+
+def test_revalidates_in_memory_without_cache_file():
+  utils = ProbedUtils(['10.0.0.5'])
+  assert utils.find_working_ip_address('10.0.0.0/29') == '10.0.0.5'
+  scanned = len(utils.probed)
+  del utils.probed[:]
+  assert utils.find_working_ip_address('10.0.0.0/29') == '10.0.0.5'
+  assert scanned > 1
+  assert utils.probed == ['10.0.0.5']
+
+
+def test_rescans_when_the_address_moves():
+  utils = ProbedUtils(['10.0.0.5'])
+  utils.find_working_ip_address('10.0.0.0/29')
+  utils.working = set(['10.0.0.3'])
+  del utils.probed[:]
+  assert utils.find_working_ip_address('10.0.0.0/29') == '10.0.0.3'
+  assert utils.probed[0] == '10.0.0.5'
+
+
+def test_cache_file_survives_a_new_instance(tmpdir):
+  cache_path = str(tmpdir.join('sql_cache.json'))
+  ProbedUtils(['10.0.0.5'], cache_path=cache_path).find_working_ip_address(
+      '10.0.0.0/29')
+  utils = ProbedUtils(['10.0.0.5'], cache_path=cache_path)
+  assert utils.find_working_ip_address('10.0.0.0/29') == '10.0.0.5'
+  assert utils.probed == ['10.0.0.5']
+
+
+def test_failed_cache_write_leaves_no_temporary_file(tmpdir):
+  # Renaming a file onto a directory fails.
+  cache_path = tmpdir.mkdir('sql_cache.json')
+  utils = ProbedUtils(['10.0.0.5'], cache_path=str(cache_path))
+  utils.write_cache('10.0.0.5')
+  assert tmpdir.listdir() == [cache_path]
+
+
+class SlowProbedUtils(ProbedUtils):
+  """Holds each failing probe until released, tracking the probes in flight."""
+
+  def __init__(self, working, **kwargs):
+    super(SlowProbedUtils, self).__init__(working, **kwargs)
+    self.release = threading.Event()
+    self.lock = threading.Lock()
+    self.in_flight = 0
+    self.max_in_flight = 0
+
+  def _is_working_address(self, address):
+    with self.lock:
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+    try:
+      if not super(SlowProbedUtils, self)._is_working_address(address):
+        self.release.wait(5)
+        return False
+      return True
+    finally:
+      with self.lock:
+        self.in_flight -= 1
+
+
+def test_parallel_scan_returns_without_waiting_for_other_probes():
+  utils = SlowProbedUtils(['10.0.0.2'], concurrency=4)
+  try:
+    started = time.time()
+    assert utils._scan_parallel(sync_sql_ip.ip_network(u'10.0.0.0/29')) == (
+        '10.0.0.2')
+    # The failing probes are still held for seconds.
+    assert time.time() - started < 1
+  finally:
+    utils.release.set()
+
+
+def test_parallel_scan_without_working_address():
+  utils = SlowProbedUtils([], concurrency=3)
+  utils.release.set()
+  assert utils._scan_parallel(
+      sync_sql_ip.ip_network(u'10.0.0.0/29')) is None
+  assert sorted(utils.probed) == ['10.0.0.{}'.format(i) for i in range(8)]
+
+
+def test_parallel_scan_stays_within_its_concurrency():
+  utils = SlowProbedUtils([], concurrency=3)
+  timer = threading.Timer(0.2, utils.release.set)
+  timer.start()
+  assert utils._scan_parallel(
+      sync_sql_ip.ip_network(u'10.0.0.0/28')) is None
+  timer.join()
+  assert utils.max_in_flight == 3
+  assert len(utils.probed) == 16
@@ -0,0 +1,50 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the status file of sync_supervisor."""
+
+import json
+import os
+import threading
+
+import sync_supervisor
+
+
+def test_write_status(tmpdir):
+  job = sync_supervisor.Job('dags', ['true'], interval=10, timeout=10)
+  job.run_once()
+  status_file = tmpdir.join('status.json')
+  sync_supervisor.Supervisor([job], str(status_file)).write_status()
+  assert json.loads(status_file.read())['dags']['last_exit_code'] == 0
+  assert os.listdir(str(tmpdir)) == ['status.json']
+
+
+def test_failed_status_write_keeps_the_job_running(tmpdir, monkeypatch):
+
+  def rename(unused_src, unused_dst):
+    raise OSError('disk full')
+
+  monkeypatch.setattr(sync_supervisor.os, 'rename', rename)
+  job = sync_supervisor.Job('dags', ['true'], interval=0, timeout=10)
+  supervisor = sync_supervisor.Supervisor(
+      [job], str(tmpdir.join('status.json')))
+  stop = threading.Event()
+
+  def on_finished(finished_job):
+    supervisor.write_status(finished_job)
+    if finished_job.runs == 2:
+      stop.set()
+
+  job.loop(stop, on_finished)
+  assert job.runs == 2
+  assert not os.listdir(str(tmpdir))
@@ -0,0 +1,122 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for worker_drain."""
+
+import worker_drain
+
+PODS = ['worker-a', 'worker-b', 'worker-c', 'worker-d']
+
+
+def _fleet(queued, running):
+  return {'scheduled': 0, 'queued': queued,
+          'hosts': dict(('{}.cluster.local'.format(pod), {'running': count})
+                        for pod, count in running.items())}
+
+
+def _cordoned(drain_plan):
+  return sorted(entry['pod'] for entry in drain_plan if entry['cordon'])
+
+
+class FakeApi(object):
+
+  def __init__(self):
+    self.patches = {}
+
+  def patch_namespaced_pod(self, pod, unused_namespace, body):
+    self.patches[pod] = body['metadata']['annotations']
+
+
+class FakeInspect(object):
+
+  def __init__(self, control):
+    self.control = control
+
+  def active_queues(self):
+    return dict(('celery@{}'.format(pod),
+                 [{'name': 'default'}] if consuming else [])
+                for pod, consuming in self.control.consuming.items())
+
+
+class FakeControl(object):
+
+  def __init__(self, consuming):
+    self.consuming = dict(consuming)
+
+  def inspect(self, timeout=None):
+    return FakeInspect(self)
+
+  def add_consumer(self, unused_queue, destination):
+    self.consuming[destination[0].split('@')[1]] = True
+
+  def cancel_consumer(self, unused_queue, destination):
+    self.consuming[destination[0].split('@')[1]] = False
+
+
+def test_ranks_least_loaded_first():
+  drain_plan = worker_drain.plan(
+      PODS, _fleet(0, {'worker-a': 3, 'worker-b': 1, 'worker-c': 2}))
+  assert [entry['pod'] for entry in drain_plan] == [
+      'worker-d', 'worker-b', 'worker-c', 'worker-a']
+  assert [entry['deletion_cost'] for entry in drain_plan] == [0, 1, 2, 3]
+  assert not _cordoned(drain_plan)
+
+
+def test_cordons_only_pods_a_scale_down_removes():
+  # 12 tasks fit two workers, so two of the four are removed.
+  drain_plan = worker_drain.plan(
+      PODS, _fleet(4, {'worker-a': 5, 'worker-b': 3}), cordon=3)
+  assert _cordoned(drain_plan) == ['worker-c', 'worker-d']
+
+
+def test_cordon_is_bounded_by_the_flag():
+  drain_plan = worker_drain.plan(PODS, _fleet(0, {}), cordon=1)
+  assert len(_cordoned(drain_plan)) == 1
+
+
+def test_no_cordon_when_demand_needs_every_worker():
+  drain_plan = worker_drain.plan(
+      PODS, _fleet(20, {'worker-a': 8, 'worker-b': 4}), cordon=4)
+  assert not _cordoned(drain_plan)
+
+
+def test_uncordons_when_demand_rises():
+  control = FakeControl({'worker-a': True, 'worker-b': True})
+  drainer = worker_drain.WorkerDrainer(api=FakeApi(), celery_control=control)
+  pods = ['worker-a', 'worker-b']
+  drain_plan = worker_drain.plan(pods, _fleet(0, {'worker-a': 1}), cordon=1)
+  drainer.apply(drain_plan, {}, drainer.consumers())
+  assert control.consuming == {'worker-a': True, 'worker-b': False}
+  assert drainer.api.patches['worker-b'][worker_drain.CORDON_ANNOTATION] == (
+      'true')
+
+  annotations = {'worker-b': {worker_drain.CORDON_ANNOTATION: 'true'}}
+  drain_plan = worker_drain.plan(pods, _fleet(10, {'worker-a': 1}), cordon=1)
+  drainer.apply(drain_plan, annotations, drainer.consumers())
+  assert control.consuming == {'worker-a': True, 'worker-b': True}
+  assert drainer.api.patches['worker-b'][
+      worker_drain.CORDON_ANNOTATION] is None
+
+
+def test_cordons_again_a_restarted_worker():
+  # The annotation says cordoned, but the restarted worker consumes again.
+  control = FakeControl({'worker-a': True, 'worker-b': True})
+  api = FakeApi()
+  drainer = worker_drain.WorkerDrainer(api=api, celery_control=control)
+  annotations = {'worker-b': {worker_drain.CORDON_ANNOTATION: 'true',
+                              worker_drain.DELETION_COST_ANNOTATION: '0'}}
+  drain_plan = worker_drain.plan(['worker-a', 'worker-b'],
+                                 _fleet(0, {'worker-a': 1}), cordon=1)
+  assert drainer.apply(drain_plan, annotations, drainer.consumers()) == [
+      'worker-a']
+  assert control.consuming['worker-b'] is False